@@ -0,0 +1,199 @@
+from __future__ import division, print_function, absolute_import
+import numpy as np
+import tensorflow as tf
+import ml_rfi.helper_functions as hf
+from ml_rfi.AmpModel import AmpFCN
+from ml_rfi.AmpPhsModel import AmpPhsFCN
+from time import time
+import platform
+import multiprocessing
+import json
+import sys
+import os
+import subprocess
+
+args = sys.argv[1:]
+
+# Arguments order nwf out_file baseline_file
+try:
+    nwf = int(args[0])          # number of waterfalls per stage
+except:
+    nwf = 64
+try:
+    out_file = args[1]          # JSON results
+except:
+    out_file = 'bench_results.json'
+try:
+    baseline_file = args[2]     # earlier results to compare against, no comparison when missing
+except:
+    baseline_file = ''
+seed = 0
+fold_factor = 16
+psize = 16
+fold_factors = [8,16,32]
+pad_sizes = [16,32]
+batch_size = 32              # patches per next_train batch
+forward_batches = [1,4,16]   # waterfalls per forward pass, fold_factor patches each
+repeats = 5                  # timings per stage, the best is kept
+regression_tolerance = 0.10  # fractional slowdown against the baseline reported as a regression
+exec_profile = 'cpu_profile.json' # session configuration for the forward passes, as in pipelineDFCN.py
+entry_points = ['preprocessing','metrics','dataset','layers','helper_functions','AmpPhsModel']
+heavy_modules = ['tensorflow','sklearn','scipy','pyuvdata','h5py','matplotlib']
+results = {}
+
+def synthetic_waterfalls(nwf,ntimes=60,nfreqs=1024,seed=0):
+    """
+    Random complex waterfall visibilities and flags, so no HERA data files are needed.
+    """
+    rng = np.random.RandomState(seed)
+    data = (rng.randn(nwf,ntimes,nfreqs) + 1j*rng.randn(nwf,ntimes,nfreqs)).astype(np.complex64)
+    flags = (rng.rand(nwf,ntimes,nfreqs) > 0.95).astype(np.int32)
+    return data,flags
+
+def import_time(module):
+    """
+    Cold import time of an ml_rfi module in a fresh interpreter, and the heavy dependencies it loaded.
+    """
+    code = ('import sys,time; sys.path.insert(0,{0!r}); t0 = time.time(); import {1}; t = time.time() - t0; '
+            'print("%f|%s" % (t," ".join([m for m in {2!r} if m in sys.modules])))').format(
+                os.path.join(os.path.dirname(os.path.abspath(__file__)),'ml_rfi'),module,heavy_modules)
+    t,loaded = subprocess.check_output([sys.executable,'-c',code]).decode().strip().split('\n')[-1].split('|')
+    return float(t),loaded
+
+def rate(func,nwf):
+    """
+    Best-of-repeats waterfalls per second for func processing nwf waterfalls.
+    """
+    best = np.inf
+    for i in range(repeats):
+        t0 = time()
+        func()
+        best = min(best,time() - t0)
+    return nwf/best
+
+def record(name,value,unit='waterfalls/s'):
+    results[name] = {'value': float(value),'unit': unit}
+    print('  {0:32s} {1:12.2f} {2}'.format(name,value,unit))
+
+def forward_model(model,nch):
+    """
+    A randomly initialized network in its own graph and session, so forward passes need no checkpoint.
+    Output: function of a folded batch returning the logits
+    """
+    graph = tf.Graph()
+    with graph.as_default():
+        tf.set_random_seed(seed)
+        vis_input = tf.placeholder(tf.float32, shape=[None, None, None, nch])
+        mode_bn = tf.placeholder(tf.bool)
+        RFI_guess = model(vis_input,mode_bn=mode_bn,d_out=0.)
+        init = tf.group(tf.global_variables_initializer(),tf.local_variables_initializer())
+    sess = tf.Session(graph=graph,config=hf.session_config(hf.load_profile(exec_profile)))
+    sess.run(init)
+    graph.finalize()
+    return lambda batch_x: sess.run(RFI_guess, feed_dict={vis_input: batch_x, mode_bn: True})
+
+def compare(results,baseline):
+    """
+    Prints each stage against the baseline. Rates (units per second) regress when they drop,
+    times when they grow, by more than regression_tolerance.
+    Output: names of the regressed stages
+    """
+    regressed = []
+    print('Comparison against {0}'.format(baseline_file))
+    print('  {0:32s} {1:>12s} {2:>12s} {3:>8s}'.format('stage','baseline','current','change'))
+    for name in sorted(results):
+        if name not in baseline['results']:
+            continue
+        old = baseline['results'][name]['value']
+        new = results[name]['value']
+        change = (new - old)/old if old > 0 else 0.
+        if results[name]['unit'].endswith('/s'):
+            slower = change < -regression_tolerance
+        else:
+            slower = change > regression_tolerance
+        if slower:
+            regressed.append(name)
+        print('  {0:32s} {1:12.2f} {2:12.2f} {3:+7.1f}% {4}'.format(name,old,new,100.*change,'REGRESSION' if slower else ''))
+    return regressed
+
+data,flags = synthetic_waterfalls(nwf,seed=seed)
+print('Folding {0} waterfalls of shape {1}'.format(nwf,np.shape(data[0])))
+for fold_factor_ in fold_factors:
+    for psize_ in pad_sizes:
+        def fold_loop():
+            return np.array(list(map(hf.fold,data,nwf*[fold_factor_],nwf*[psize_],nwf*[True])))
+        def fold_batch():
+            return hf.fold_batch(data,fold_factor_,psize_,deterministic=True)
+        def unfold_loop():
+            return [hf.unfoldl(f_labels[i*fold_factor_:(i+1)*fold_factor_],fold_factor_,psize_) for i in range(nwf)]
+        def unfold_batch():
+            return hf.unfoldl_batch(f_labels,fold_factor_,psize_)
+        f_labels = hf.foldl_batch(flags,fold_factor_,psize_)
+        identical = np.array_equal(fold_loop().reshape((-1,)+f_labels.shape[1:]+(3,)),fold_batch())
+        print('fold_factor {0} psize {1}: bit identical {2}'.format(fold_factor_,psize_,identical))
+        record('fold/ff{0}_ps{1}'.format(fold_factor_,psize_),rate(fold_loop,nwf))
+        record('fold_batch/ff{0}_ps{1}'.format(fold_factor_,psize_),rate(fold_batch,nwf))
+        record('unfoldl/ff{0}_ps{1}'.format(fold_factor_,psize_),rate(unfold_loop,nwf))
+        record('unfoldl_batch/ff{0}_ps{1}'.format(fold_factor_,psize_),rate(unfold_batch,nwf))
+
+print('Preprocessing stages (fold_factor {0}, psize {1})'.format(fold_factor,psize))
+record('normalize',rate(lambda: [hf.normalize(d,deterministic=True) for d in data],nwf))
+record('normalize_batch',rate(lambda: hf.normalize_batch(data,deterministic=True),nwf))
+record('normphs',rate(lambda: [hf.normphs(d) for d in data],nwf))
+record('foldl',rate(lambda: [hf.foldl(f,fold_factor,psize) for f in flags],nwf))
+record('foldl_batch',rate(lambda: hf.foldl_batch(flags,fold_factor,psize),nwf))
+f_data,f_labels = hf.fold_waterfalls(data,flags,'AmpPhs',fold_factor,psize,deterministic=True)
+record('expand_dataset',rate(lambda: hf.expand_dataset(f_data,f_labels,rng=np.random.RandomState(seed)),len(f_data)),'patches/s')
+
+print('Synthetic waterfalls (generator throughput on one core)')
+sim = hf.WaterfallSimulator(seed=seed)
+record('simulate',rate(lambda: sim(nwf),nwf))
+record('simulate+fold',rate(lambda: hf.fold_waterfalls(*(sim(nwf)+('AmpPhs',fold_factor,psize))),nwf))
+
+print('Training batches of {0} patches'.format(batch_size))
+dset = hf.RFIDataset()
+for augment in [False,True]:
+    dset.load_patches(f_data,f_labels,f_data,f_labels,batch_size,augment=augment,seed=seed)
+    record('next_train/augment_{0}'.format(augment),rate(lambda: [dset.next_train() for i in range(10)],10),'batches/s')
+
+print('Forward passes of randomly initialized networks')
+for name,model,nch in [('AmpPhsFCN',AmpPhsFCN,2),('AmpFCN',AmpFCN,1)]:
+    predict = forward_model(model,nch)
+    for nb in forward_batches:
+        batch_x = hf.fold_batch(data[:nb],fold_factor,psize,deterministic=True,dtype=np.float32,nch=nch)
+        predict(batch_x)
+        record('{0}/batch_{1}'.format(name,nb),rate(lambda: predict(batch_x),nb))
+
+print('ROC statistics')
+rng = np.random.RandomState(seed)
+logit_diff = rng.randn(nwf,60,1024)
+record('ROC_stats',rate(lambda: [hf.ROC_stats(flags[i],logit_diff[i].reshape(1,-1)) for i in range(nwf)],nwf))
+
+print('Cold import of each entry point')
+for module in entry_points:
+    t,loaded = import_time(module)
+    record('import/'+module,t,'s')
+    print('    loads: {0}'.format(loaded))
+
+with open(out_file,'w') as f:
+    json.dump({'config': {'nwf': nwf,
+                          'seed': seed,
+                          'fold_factor': fold_factor,
+                          'psize': psize,
+                          'batch_size': batch_size,
+                          'repeats': repeats,
+                          'python': platform.python_version(),
+                          'numpy': np.__version__,
+                          'tensorflow': getattr(tf,'__version__',''),
+                          'machine': {'hostname': platform.node(),'processor': platform.processor(),'cpu_count': multiprocessing.cpu_count()}},
+               'results': results},f,indent=1,sort_keys=True)
+print('Results saved to '+out_file)
+
+if baseline_file:
+    with open(baseline_file) as f:
+        baseline = json.load(f)
+    regressed = compare(results,baseline)
+    if len(regressed) > 0:
+        print('{0} stages regressed by more than {1:.0f}%: {2}'.format(len(regressed),100*regression_tolerance,', '.join(regressed)))
+        sys.exit(1)
+    print('No regressions beyond {0:.0f}%.'.format(100*regression_tolerance))
@@ -0,0 +1,134 @@
+from __future__ import division, print_function, absolute_import
+import numpy as np
+import tensorflow as tf
+import ml_rfi.helper_functions as hf
+from time import time
+import json
+import sys
+import os
+from ml_rfi.AmpModel import AmpFCN
+from ml_rfi.AmpPhsModel import AmpPhsFCN
+
+args = sys.argv[1:]
+
+# Arguments order model_name chtypes frozen_file
+try:
+    model_name = args[0]
+except:
+    model_name = 'AmpPhsv9SimRealv13_64BSizeDynamicVis'
+try:
+    chtypes = args[1]
+except:
+    chtypes = 'AmpPhs'
+try:
+    frozen_file = args[2]
+except:
+    frozen_file = './'+model_name+'/frozen_model.pb'
+if chtypes == 'AmpPhs':
+    ch_input = 2
+else:
+    ch_input = 1
+pad_size = 16
+f_factor = 16
+bench_tiles = 16 # 60x1024 tiles per latency batch, as max_tiles in pipelineDFCN.py
+bench_runs = 10
+max_flag_mismatch = 0.01 # fraction of flags the frozen model may change against the checkpoint before the export is refused
+checkpoint,step = hf.latest_checkpoint('./'+model_name)
+if checkpoint is None:
+    raise ValueError("No Model Found. Export killed.")
+print(checkpoint)
+
+def build_model(mode_bn):
+    vis_input = tf.placeholder(tf.float32, shape=[None, None, None, ch_input], name='vis_input')
+    if chtypes == 'Amp':
+        RFI_guess = AmpFCN(vis_input,mode_bn=mode_bn,d_out=0.)
+    elif chtypes == 'AmpPhs':
+        RFI_guess = AmpPhsFCN(vis_input,mode_bn=mode_bn,d_out=0.)
+    return vis_input,tf.identity(RFI_guess,name='RFI_guess')
+
+def latency(run):
+    """
+    First-batch and median warm per-batch latency in seconds.
+    """
+    t0 = time()
+    run()
+    first = time() - t0
+    times = []
+    for i in range(bench_runs):
+        t0 = time()
+        run()
+        times.append(time() - t0)
+    return first,np.median(times)
+
+# Export: inference mode batch norm (moving statistics) and dropout, which is then stripped
+export_start = time()
+with tf.Graph().as_default() as graph:
+    vis_input,RFI_guess = build_model(False)
+    saver = tf.train.Saver()
+    with tf.Session() as sess:
+        saver.restore(sess, checkpoint)
+        graph_def = graph.as_graph_def()
+        nnodes = len(graph_def.node)
+        graph_def = tf.graph_util.convert_variables_to_constants(sess,graph_def,['RFI_guess'])
+graph_def = tf.graph_util.remove_training_nodes(graph_def,protected_nodes=['vis_input','RFI_guess'])
+graph_def,nfolded = hf.fold_batch_norms(graph_def,['RFI_guess'])
+ndropout = len([node for node in graph_def.node if node.op.startswith('Random')])
+# Only moved into place once it is checked against the checkpoint below
+with tf.gfile.GFile(frozen_file+'.tmp','wb') as f:
+    f.write(graph_def.SerializeToString())
+print('Froze {0} in {1:.1f} s'.format(checkpoint,time() - export_start))
+print('Graph nodes {0} -> {1}, {2} batch norms folded, {3} random (dropout) ops left'.format(nnodes,len(graph_def.node),nfolded,ndropout))
+
+# Simulated HERA-like waterfalls, so the batch statistics resemble those of real data
+waterfalls = hf.WaterfallSimulator(seed=0)(bench_tiles)[0]
+batch_x = hf.fold_batch(waterfalls,f_factor,pad_size,dtype=np.float32,nch=ch_input)
+
+# Current path: build from Python, initialize, restore the checkpoint
+start = time()
+with tf.Graph().as_default():
+    vis_input = tf.placeholder(tf.float32, shape=[None, None, None, ch_input])
+    mode_bn = tf.placeholder(tf.bool)
+    if chtypes == 'Amp':
+        RFI_guess = AmpFCN(vis_input,mode_bn=mode_bn,d_out=0.)
+    elif chtypes == 'AmpPhs':
+        RFI_guess = AmpPhsFCN(vis_input,mode_bn=mode_bn,d_out=0.)
+    init = tf.group(tf.global_variables_initializer(),tf.local_variables_initializer())
+    saver = tf.train.Saver()
+    sess = tf.Session()
+    sess.run(init)
+    saver.restore(sess, checkpoint)
+    ckpt_startup = time() - start
+    ckpt_first,ckpt_latency = latency(lambda: sess.run(RFI_guess, feed_dict={vis_input: batch_x, mode_bn: True}))
+    # Batch statistics, as runDFCN.py, pipelineDFCN.py and tuneDFCN.py run the checkpoint
+    g_ckpt = sess.run(RFI_guess, feed_dict={vis_input: batch_x, mode_bn: True})
+    sess.close()
+
+# Frozen path
+start = time()
+sess,vis_input,RFI_guess = hf.load_frozen_model(frozen_file+'.tmp')
+frozen_startup = time() - start
+frozen_first,frozen_latency = latency(lambda: sess.run(RFI_guess, feed_dict={vis_input: batch_x}))
+g_frozen = sess.run(RFI_guess, feed_dict={vis_input: batch_x})
+sess.close()
+
+print('Batch of {0} tiles ({1} patches)'.format(bench_tiles,len(batch_x)))
+print('              startup (s)  first batch (s)  batch latency (s)')
+print('checkpoint  {0:12.3f} {1:16.3f} {2:18.4f}'.format(ckpt_startup,ckpt_first,ckpt_latency))
+print('frozen      {0:12.3f} {1:16.3f} {2:18.4f}'.format(frozen_startup,frozen_first,frozen_latency))
+mismatch = np.mean(np.argmax(g_frozen,axis=-1) != np.argmax(g_ckpt,axis=-1))
+print('Max |logit difference| vs checkpoint (batch statistics): {0:.3g}'.format(np.max(np.abs(g_frozen - g_ckpt))))
+print('Flags changed vs checkpoint: {0:.4%}'.format(mismatch))
+if mismatch > max_flag_mismatch:
+    os.remove(frozen_file+'.tmp')
+    # e.g. a checkpoint trained before the moving statistics were updated, which are still 0 and 1
+    raise ValueError("Frozen model changes {0:.2%} of the checkpoint's flags (max {1:.2%}), its batch norm moving statistics do not match the data. Export killed.".format(mismatch,max_flag_mismatch))
+os.rename(frozen_file+'.tmp',frozen_file)
+with open(frozen_file+'.json','w') as f:
+    json.dump({'checkpoint': checkpoint,
+               'chtypes': chtypes,
+               'ch_input': ch_input,
+               'fold_factor': f_factor,
+               'pad_size': pad_size,
+               'folded_batch_norms': nfolded,
+               'flag_mismatch': float(mismatch)},f,indent=1)
+print('Exported {0} to {1}'.format(checkpoint,frozen_file))
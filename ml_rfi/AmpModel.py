@@ -1,16 +1,7 @@
 from __future__ import division, print_function, absolute_import
-import matplotlib
-matplotlib.use("AGG")
-import matplotlib.pyplot as plt
 import numpy as np
 import tensorflow as tf
-from glob import glob
-import helper_functions as hf
-import os
-import sys
-from copy import copy
-import h5py
-
+import layers as hf
 
 
 def AmpFCN(x, reuse=None, mode_bn=True, d_out=0.):
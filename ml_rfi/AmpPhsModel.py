@@ -1,18 +1,7 @@
 from __future__ import division, print_function, absolute_import
-import matplotlib
-matplotlib.use("AGG")
-import matplotlib.pyplot as plt
 import numpy as np
 import tensorflow as tf
-from glob import glob
-import helper_functions as hf
-from time import time
-import os
-from sklearn.metrics import roc_curve
-from sklearn.metrics import confusion_matrix
-import sys
-from copy import copy
-import h5py
+import layers as hf
 
 
 def AmpPhsFCN(x, reuse=None, mode_bn=True, d_out=0.):
@@ -28,25 +17,25 @@ def AmpPhsFCN(x, reuse=None, mode_bn=True, d_out=0.):
         print('Input',sh)
         # Amplitude branch of the D-FCN
         #slayer1 = hf.stacked_layer(tf.reshape(input_layer[:,:,:,:1],[-1,sh[1],sh[2],1]),8*s,kt_amp,kt_amp,activation,[2,2],[2,2],bnorm=True,mode=mode_bn)
-        slayer1 = hf.stacked_layer(input_layer[:,:,:,:1],8*s,kt_amp,kt_amp,activation,[2,2],[2,2],bnorm=True,mode=mode_bn)
-        slayer2 = hf.stacked_layer(slayer1,s*16,kt_amp,kt_amp,activation,[2,2],[2,2],bnorm=True,mode=mode_bn)
-        slayer3 = hf.stacked_layer(slayer2,s*32,kt_amp,kt_amp,activation,[2,2],[2,2],bnorm=True,mode=mode_bn,dropout=0.)
+        slayer1 = hf.stacked_layer(input_layer[:,:,:,:1],8*s,kt_amp,kt_amp,activation,[2,2],[2,2],bnorm=True,mode=mode_bn,name='amp_layer1')
+        slayer2 = hf.stacked_layer(slayer1,s*16,kt_amp,kt_amp,activation,[2,2],[2,2],bnorm=True,mode=mode_bn,name='amp_layer2')
+        slayer3 = hf.stacked_layer(slayer2,s*32,kt_amp,kt_amp,activation,[2,2],[2,2],bnorm=True,mode=mode_bn,name='amp_layer3',dropout=0.)
         s3sh = slayer3.get_shape().as_list()
-        slayer4 = tf.layers.dropout(hf.stacked_layer(slayer3,s*64,kt_amp,kt_amp,activation,[2,2],[2,2],bnorm=True,mode=mode_bn),rate=0.)
-        slayer5 = hf.stacked_layer(slayer4,s*128,kt_amp,kt_amp,activation,[2,2],[2,2],bnorm=True,mode=mode_bn,dropout=0.)
+        slayer4 = tf.layers.dropout(hf.stacked_layer(slayer3,s*64,kt_amp,kt_amp,activation,[2,2],[2,2],bnorm=True,mode=mode_bn,name='amp_layer4'),rate=0.)
+        slayer5 = hf.stacked_layer(slayer4,s*128,kt_amp,kt_amp,activation,[2,2],[2,2],bnorm=True,mode=mode_bn,name='amp_layer5',dropout=0.)
         s5sh = slayer5.get_shape().as_list()
-        slayer6 = hf.stacked_layer(slayer5,s*256,kt_amp,kt_amp,activation,[2,2],[2,2],bnorm=True,mode=mode_bn,maxpool=None)
+        slayer6 = hf.stacked_layer(slayer5,s*256,kt_amp,kt_amp,activation,[2,2],[2,2],bnorm=True,mode=mode_bn,name='amp_layer6',maxpool=None)
 #        s6sh = slayer6.get_shape().as_list()
 #        slayer7 = hf.stacked_layer(slayer6,s*512,1,1,activation,[1,1],[1,1],bnorm=True,dropout=d_out,mode=mode_bn,maxpool=None)
         
         # Phase branch of the D-FCN
         #slayer1b = hf.stacked_layer(tf.reshape(input_layer[:,:,:,1],[-1,sh[1],sh[2],1]),8*s,kt_phs,kt_phs,activation,[2,2],[2,2],bnorm=True,mode=mode_bn,maxpool=False)
-        slayer1b = hf.stacked_layer(input_layer[:,:,:,1:],8*s,kt_phs,kt_phs,activation,[2,2],[2,2],bnorm=True,mode=mode_bn,maxpool=False) 
-        slayer2b = hf.stacked_layer(slayer1b,16*s,kt_phs,kt_phs,activation,[2,2],[2,2],bnorm=True,mode=mode_bn,maxpool=False)
-        slayer3b = hf.stacked_layer(slayer2b,32*s,kt_phs,kt_phs,activation,[2,2],[2,2],bnorm=True,mode=mode_bn,maxpool=False,dropout=0.)
-        slayer4b = tf.layers.dropout(hf.stacked_layer(slayer3b,64*s,kt_phs,kt_phs,activation,[2,2],[2,2],bnorm=True,mode=mode_bn,maxpool=False),rate=0.)
-        slayer5b = hf.stacked_layer(slayer4b,128*s,kt_phs,kt_phs,activation,[2,2],[2,2],bnorm=True,mode=mode_bn,maxpool=False,dropout=0.0)
-        slayer6b = hf.stacked_layer(slayer5b,256*s,kt_phs,kt_phs,activation,[2,2],[2,2],bnorm=True,mode=mode_bn,maxpool=None)    
+        slayer1b = hf.stacked_layer(input_layer[:,:,:,1:],8*s,kt_phs,kt_phs,activation,[2,2],[2,2],bnorm=True,mode=mode_bn,name='phs_layer1',maxpool=False) 
+        slayer2b = hf.stacked_layer(slayer1b,16*s,kt_phs,kt_phs,activation,[2,2],[2,2],bnorm=True,mode=mode_bn,name='phs_layer2',maxpool=False)
+        slayer3b = hf.stacked_layer(slayer2b,32*s,kt_phs,kt_phs,activation,[2,2],[2,2],bnorm=True,mode=mode_bn,name='phs_layer3',maxpool=False,dropout=0.)
+        slayer4b = tf.layers.dropout(hf.stacked_layer(slayer3b,64*s,kt_phs,kt_phs,activation,[2,2],[2,2],bnorm=True,mode=mode_bn,name='phs_layer4',maxpool=False),rate=0.)
+        slayer5b = hf.stacked_layer(slayer4b,128*s,kt_phs,kt_phs,activation,[2,2],[2,2],bnorm=True,mode=mode_bn,name='phs_layer5',maxpool=False,dropout=0.0)
+        slayer6b = hf.stacked_layer(slayer5b,256*s,kt_phs,kt_phs,activation,[2,2],[2,2],bnorm=True,mode=mode_bn,name='phs_layer6',maxpool=None)    
         s3sh = slayer3b.get_shape().as_list()
         s6sh = slayer6b.get_shape().as_list()
 #        slayer7b = hf.stacked_layer(slayer6b,s*512,1,1,activation,[1,1],[1,1],bnorm=True,dropout=0.0,mode=mode_bn,maxpool=None)
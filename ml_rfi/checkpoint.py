@@ -0,0 +1,164 @@
+import numpy as np
+import tensorflow as tf
+import threading
+import json
+import os
+from glob import glob
+from time import time
+
+# Written by CheckpointManager beside the checkpoints of a model directory
+index_name = 'checkpoints.json'
+
+def read_index(model_dir):
+    """
+    The checkpoint index of a model directory, None if it has none.
+    """
+    filename = os.path.join(model_dir,index_name)
+    if not os.path.exists(filename):
+        return None
+    with open(filename) as f:
+        return json.load(f)
+
+def latest_checkpoint(model_dir):
+    """
+    Path and step of the newest checkpoint in model_dir, read from its index. Directories
+    from before the index fall back to parsing the steps out of the model_* file names.
+    Output: checkpoint path or None, step (0 when there is no checkpoint)
+    """
+    index = read_index(model_dir)
+    if index is not None:
+        if index['latest'] is None:
+            return None,0
+        return os.path.join(model_dir,index['checkpoints'][str(index['latest'])]['file']),index['latest']
+    steps = []
+    for filename in glob(os.path.join(model_dir,'model_*')):
+        try:
+            steps.append(int(os.path.basename(filename).split('.')[0].split('_')[1]))
+        except ValueError:
+            continue
+    if len(steps) == 0:
+        return None,0
+    return os.path.join(model_dir,'model_%i.ckpt' % max(steps)),max(steps)
+
+class CheckpointManager():
+    def __init__(self,model_dir,keep_last=5,best_metric='f1',var_list=None):
+        """
+        Saves model_<step>.ckpt checkpoints, readable by a plain tf.train.Saver, from a
+        background thread. save() only copies the variables into a shadow set in the session
+        and snapshots the dataset's samplers; the shadows are written while training goes on.
+        An index of the saved steps and their metrics is kept in model_dir, with the last
+        keep_last checkpoints and the best by best_metric (higher is better) retained.
+        Build it with the rest of the graph, before the variables are initialized: it adds
+        the shadow variables (local, so not saved themselves) and the snapshot op.
+        """
+        self.model_dir = model_dir
+        self.keep_last = keep_last
+        self.best_metric = best_metric
+        if var_list is None:
+            var_list = tf.global_variables()
+        shadows = []
+        with tf.name_scope('checkpoint_snapshot'):
+            for v in var_list:
+                shadows.append(tf.Variable(tf.zeros(v.get_shape(),dtype=v.dtype.base_dtype),trainable=False,
+                                           collections=[tf.GraphKeys.LOCAL_VARIABLES],name=v.op.name.replace('/','_')))
+            self.snapshot = tf.group(*[s.assign(v) for s,v in zip(shadows,var_list)])
+        # Shadows are saved under their variable's name, so the checkpoints restore into the model
+        self.saver = tf.train.Saver(dict([(v.op.name,s) for v,s in zip(var_list,shadows)]),max_to_keep=None)
+        self.lock = threading.Lock()
+        self.thread = None
+        self.error = None
+        self.index = read_index(model_dir)
+        if self.index is None:
+            self.index = {'latest': None,'best': None,'best_metric': best_metric,'checkpoints': {}}
+        if not os.path.exists(model_dir):
+            os.makedirs(model_dir)
+
+    def save(self,sess,step,metrics=None,dataset=None,samplers=None):
+        """
+        Snapshots the variables, and the sampler state of an RFIDataset, at step and writes
+        them in the background. Waits for the previous save first. samplers is a sampler
+        state to save instead of the dataset's current one.
+        Output: seconds the caller was blocked
+        """
+        t0 = time()
+        self.wait()
+        sess.run(self.snapshot)
+        if samplers is None and dataset is not None:
+            samplers = dataset.sampler_state()
+        self.thread = threading.Thread(target=self.write,args=(sess,step,metrics or {},samplers))
+        self.thread.start()
+        return time() - t0
+
+    def write(self,sess,step,metrics,samplers):
+        try:
+            filename = 'model_%i.ckpt' % step
+            path = os.path.join(self.model_dir,filename)
+            self.saver.save(sess,path,write_meta_graph=False,write_state=False)
+            if samplers is not None:
+                np.savez(path+'.sampler.npz',**samplers)
+            # Only checkpoints written in full enter the index
+            with self.lock:
+                checkpoints = self.index['checkpoints']
+                checkpoints[str(step)] = {'file': filename,'step': step,'time': time(),
+                                          'metrics': dict([(k,float(v)) for k,v in metrics.items()])}
+                scored = [c for c in checkpoints.values() if self.best_metric in c['metrics']]
+                if len(scored) > 0:
+                    self.index['best'] = max(scored,key=lambda c: c['metrics'][self.best_metric])['step']
+                self.retain()
+                # With keep_last 0 only the best is left to resume from
+                self.index['latest'] = max([c['step'] for c in checkpoints.values()])
+                self.write_index()
+        except Exception as e:
+            self.error = e
+
+    def retain(self):
+        """
+        Deletes the indexed checkpoints other than the last keep_last and the best, or
+        the last if there are neither.
+        """
+        checkpoints = self.index['checkpoints']
+        steps = sorted([c['step'] for c in checkpoints.values()])
+        keep = set(steps[max(0,len(steps)-self.keep_last):]) if self.keep_last > 0 else set()
+        if self.index['best'] is not None:
+            keep.add(self.index['best'])
+        if len(keep) == 0:
+            # Always something to resume from
+            keep.add(steps[-1])
+        for step in steps:
+            if step in keep:
+                continue
+            for filename in glob(os.path.join(self.model_dir,checkpoints[str(step)]['file']+'.*')):
+                os.remove(filename)
+            del checkpoints[str(step)]
+
+    def write_index(self):
+        # Replaced in one rename, so a reader never sees a partial index
+        filename = os.path.join(self.model_dir,index_name)
+        with open(filename+'.tmp','w') as f:
+            json.dump(self.index,f,indent=1,sort_keys=True)
+        os.rename(filename+'.tmp',filename)
+
+    def wait(self):
+        """
+        Waits for the save in progress, raising any error it hit.
+        """
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error,self.error = self.error,None
+            raise error
+
+    def restore(self,sess,saver,dataset=None):
+        """
+        Restores the latest checkpoint with saver, and the dataset's samplers if they were
+        saved with it.
+        Output: restored step, 0 if there was no checkpoint
+        """
+        path,step = latest_checkpoint(self.model_dir)
+        if path is None:
+            return 0
+        saver.restore(sess,path)
+        if dataset is not None and os.path.exists(path+'.sampler.npz'):
+            dataset.load_samplers(path+'.sampler.npz')
+        return step
@@ -0,0 +1,1498 @@
+import numpy as np
+import h5py
+from time import time
+import os
+import json
+import zlib
+import random
+import threading
+import multiprocessing
+from contextlib import contextmanager
+from collections import deque
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+from preprocessing import fold_batch,foldl_batch,fold_waterfalls,subsample_time_patches,patchwise,Augmenter,expand_dataset,expand_validation_dataset
+from simulate import WaterfallSimulator
+from instrument import timed
+
+def load_pipeline_dset(stage_type):
+    """
+    Additional loading function for specific evaluation datasets.
+    """
+    #f = h5py.File('JK_5Jan2019.h5','r')
+    f = h5py.File('IDR21TrainingData_Raw_vX.h5','r')
+    #f = h5py.File('IDR21InitialFlags_v2.h5','r') 
+    #f = h5py.File('IDR21TrainingData_Raw_v2.h5')
+    #f = h5py.File('IDR21TrainingData.h5','r')
+    #f = h5py.File('RealVisRFI_v5.h5','r')
+    #f = h5py.File('RawRealVis_v1.h5','r')
+    #f = h5py.File('SimVis_Blips_100.h5','r')
+    #f = h5py.File('SimVis_1000_v9.h5','r')
+    try:
+        if stage_type == 'uv':
+            return f['uv']
+        elif stage_type == 'uvO':
+            return f['uvO']
+        elif stage_type == 'uvOC':
+            return f['uvOC']
+        elif stage_type == 'uvOCRS':
+            return f['uvOCRS']
+        elif stage_type == 'uvOCRSD':
+            return f['uvOCRSD']
+    except:
+        return f
+
+class WaterfallStream():
+    def __init__(self,source,chunk_size=32):
+        """
+        Lazy reader over the 'data' and 'flag' datasets of an h5py file or group. Nothing is
+        read from disk until waterfalls are requested by index, and reads are done in chunks
+        of at most chunk_size waterfalls.
+        """
+        self.source = source
+        self.data = source['data']
+        self.flags = source['flag']
+        self.chunk_size = chunk_size
+
+    def __len__(self):
+        return len(self.data)
+
+    def read(self,inds):
+        """
+        Returns the (data, flags) waterfalls at the requested indices, in the requested order.
+        h5py only supports increasing fancy indices, so chunks are read sorted and reordered after.
+        """
+        uinds,inv = np.unique(np.asarray(inds,dtype=int),return_inverse=True)
+        data = np.empty((len(uinds),)+self.data.shape[1:],dtype=self.data.dtype)
+        flags = np.empty((len(uinds),)+self.flags.shape[1:],dtype=self.flags.dtype)
+        for i in range(0,len(uinds),self.chunk_size):
+            chunk = uinds[i:i+self.chunk_size]
+            if chunk[-1] - chunk[0] == len(chunk) - 1:
+                # Contiguous chunks are read as a single hyperslab
+                sel = slice(chunk[0],chunk[-1]+1)
+            else:
+                sel = list(chunk)
+            data[i:i+len(chunk)] = self.data[sel]
+            flags[i:i+len(chunk)] = self.flags[sel]
+        return data[inv],flags[inv]
+
+class PatchCache():
+    def __init__(self,source,fold_factor,psize,chtypes,cache_dir='./patch_cache',chunk_size=32):
+        """
+        Persistent on-disk cache of the folded patches of an h5py waterfall dataset for one
+        (dataset, fold_factor, psize, chtypes) combination. Patches are folded once in
+        deterministic mode, stored as raw float32/uint8 files and memory mapped on later
+        loads. Every chunk of cached waterfalls is checksummed, so when the source file
+        changes the cache is refolded from the first changed chunk, which for an append is
+        only the new waterfalls. The cache directory is keyed on the source's absolute path,
+        and builders in other processes wait on its lock file.
+        """
+        self.source = source
+        self.fold_factor = fold_factor
+        self.psize = psize
+        self.chtypes = chtypes
+        self.chunk_size = chunk_size
+        if chtypes == 'AmpPhs':
+            self.nch = 2
+        elif chtypes == 'Amp':
+            self.nch = 1
+        else:
+            raise ValueError('Patch cache not supported for channel type %s' % chtypes)
+        self.filename = os.path.abspath(source.file.filename)
+        dname = source.name.strip('/').replace('/','_')
+        # Same named files in different directories get their own caches
+        key = '{0}_{1:08x}{2}_{3}_ff{4}_ps{5}'.format(os.path.splitext(os.path.basename(self.filename))[0],
+                                                      zlib.crc32(self.filename.encode('utf-8')) & 0xffffffff,
+                                                      '_'+dname if dname else '',chtypes,fold_factor,psize)
+        self.path = os.path.join(cache_dir,key)
+        self.patch_shape = (2*(psize+2)+60,2*psize+1024/fold_factor)
+        self.update()
+
+    def signature(self):
+        st = os.stat(self.filename)
+        return [st.st_size,st.st_mtime]
+
+    def checksums(self,start,stop):
+        """
+        Checksums of the source waterfalls start to stop, one per chunk of chunk_size
+        waterfalls counted from the first. start is a multiple of chunk_size.
+        """
+        crcs = []
+        for i in range(start,stop,self.chunk_size):
+            j = min(i+self.chunk_size,stop)
+            crc = zlib.crc32(np.ascontiguousarray(self.source['data'][i:j]).tobytes())
+            crc = zlib.crc32(np.ascontiguousarray(self.source['flag'][i:j]).tobytes(),crc)
+            crcs.append(crc & 0xffffffff)
+        return crcs
+
+    @contextmanager
+    def locked(self):
+        """
+        Holds the cache directory's lock file, where the platform has file locks.
+        """
+        with open(os.path.join(self.path,'lock'),'a') as f:
+            if fcntl is not None:
+                fcntl.flock(f,fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f,fcntl.LOCK_UN)
+
+    def update(self):
+        """
+        Validates the cache against the source file, folding any waterfalls that are not
+        yet cached or have changed, then maps the patch files.
+        """
+        if not os.path.exists(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError:
+                # Made by another process in the meantime
+                pass
+        meta_file = os.path.join(self.path,'meta.json')
+        with self.locked():
+            nsrc = len(self.source['data'])
+            n = 0
+            crcs = []
+            if os.path.exists(meta_file):
+                with open(meta_file,'r') as f:
+                    meta = json.load(f)
+                if 'checksums' in meta and meta['signature'] == self.signature() and meta['n'] == nsrc:
+                    n = meta['n']
+                    crcs = meta['checksums']
+                elif 'checksums' in meta and 0 < meta['n'] <= nsrc:
+                    # Keep the cached chunks up to the first one whose waterfalls changed
+                    current = self.checksums(0,meta['n'])
+                    nsame = 0
+                    while nsame < len(current) and current[nsame] == meta['checksums'][nsame]:
+                        nsame += 1
+                    if nsame == len(current):
+                        n = meta['n']
+                        print('Source {0} has grown, appending {1} waterfalls to the patch cache.'.format(self.filename,nsrc-n))
+                    else:
+                        n = nsame*self.chunk_size
+                        print('Source {0} has changed from waterfall {1}, refolding {2} waterfalls.'.format(self.filename,n,nsrc-n))
+                    crcs = meta['checksums'][:nsame]
+                else:
+                    print('Source {0} has changed, rebuilding the patch cache.'.format(self.filename))
+            self.append(n,nsrc,crcs)
+        self.map()
+
+    def append(self,n,nsrc,crcs):
+        """
+        Folds source waterfalls n to nsrc in chunks and appends their patches to the cache
+        files. crcs are the checksums of the cached chunks kept, which end at or before n.
+        """
+        data_file = os.path.join(self.path,'data.f32')
+        labels_file = os.path.join(self.path,'labels.u8')
+        nt,nf = self.patch_shape
+        for fname,rowsize in [(data_file,4*nt*nf*self.nch),(labels_file,nt*nf)]:
+            # Drop anything written after the last complete update
+            with open(fname,'ab') as f:
+                f.truncate(n*self.fold_factor*rowsize)
+        for i in range(n,nsrc,self.chunk_size):
+            j = min(i+self.chunk_size,nsrc)
+            f_data,f_labels = fold_waterfalls(self.source['data'][i:j],self.source['flag'][i:j],self.chtypes,
+                                              self.fold_factor,self.psize,deterministic=True,dtype=np.float32)
+            with open(data_file,'ab') as f:
+                f.write(np.ascontiguousarray(f_data,dtype=np.float32).tobytes())
+            with open(labels_file,'ab') as f:
+                f.write(np.ascontiguousarray(f_labels,dtype=np.uint8).tobytes())
+        # The last kept chunk may have been partial, it is checksummed again with the new waterfalls
+        nfull = min(len(crcs),n//self.chunk_size)
+        crcs = crcs[:nfull] + self.checksums(nfull*self.chunk_size,nsrc)
+        meta = {'source': self.filename,'signature': self.signature(),'n': nsrc,'checksums': crcs,
+                'patch_shape': list(self.patch_shape),'channels': self.nch}
+        with open(os.path.join(self.path,'meta.json.tmp'),'w') as f:
+            json.dump(meta,f)
+        os.rename(os.path.join(self.path,'meta.json.tmp'),os.path.join(self.path,'meta.json'))
+        self.n = nsrc
+
+    def map(self):
+        nt,nf = self.patch_shape
+        npatch = self.n*self.fold_factor
+        if npatch == 0:
+            self.data = np.zeros((0,nt,nf,self.nch),dtype=np.float32)
+            self.labels = np.zeros((0,nt,nf),dtype=np.uint8)
+            return
+        self.data = np.memmap(os.path.join(self.path,'data.f32'),dtype=np.float32,mode='r',shape=(npatch,nt,nf,self.nch))
+        self.labels = np.memmap(os.path.join(self.path,'labels.u8'),dtype=np.uint8,mode='r',shape=(npatch,nt,nf))
+
+    def patches(self):
+        """
+        Returns the memory mapped (patches, labels) for every cached waterfall.
+        """
+        return self.data,self.labels
+
+    def read(self,inds):
+        """
+        Returns the patches and labels of the waterfalls at the requested indices.
+        """
+        rows = (np.asarray(inds,dtype=int)[:,None]*self.fold_factor + np.arange(self.fold_factor)).reshape(-1)
+        return self.data[rows],self.labels[rows]
+
+def dataset_nbytes(dset):
+    """
+    Bytes held by the training and evaluation arrays of a dataset generation (a dict of
+    RFIDataset attributes). Memory mapped arrays count their mapped size.
+    """
+    keys = ['train_data','train_labels','eval_data','eval_labels']
+    return int(np.sum([np.asarray(dset[key]).nbytes for key in keys if key in dset]))
+
+# Bytes per element of each array before patches were kept as float32, labels as uint8
+# and raw flags as uint8 (float64, int32 and the float64 the flags are stored as)
+legacy_itemsize = {'train_data': 8,'eval_data': 8,'train_labels': 4,'eval_labels': 4,'labels_real': 8,'labels_sim': 8}
+
+def is_mapped(arr):
+    """
+    True if an array is a memory map or a view of one.
+    """
+    while isinstance(arr,np.ndarray):
+        if isinstance(arr,np.memmap):
+            return True
+        arr = arr.base
+    return False
+
+def memory_report(dset):
+    """
+    Bytes held in memory by each array of a dataset (a dict of RFIDataset attributes),
+    next to what the same array took with the float64/int32 data path. Arrays left on
+    disk (h5py datasets and memory maps) are not counted.
+    Output: {name: (nbytes, legacy nbytes)}
+    """
+    keys = ['train_data','train_labels','eval_data','eval_labels','data_real','labels_real','data_sim','labels_sim']
+    report = {}
+    for key in keys:
+        arr = dset.get(key)
+        if not isinstance(arr,np.ndarray) or is_mapped(arr):
+            continue
+        if key in legacy_itemsize and not np.iscomplexobj(arr):
+            report[key] = (arr.nbytes,arr.size*legacy_itemsize[key])
+        else:
+            report[key] = (arr.nbytes,arr.nbytes)
+    return report
+
+def print_memory_report(dset):
+    """
+    Prints memory_report per array and in total, in MB.
+    """
+    report = memory_report(dset)
+    for key in sorted(report):
+        print('  {0:14s} {1:10.1f} MB (float64/int32: {2:10.1f} MB)'.format(key,report[key][0]/2.**20,report[key][1]/2.**20))
+    nbytes = np.sum([report[key][0] for key in report])
+    legacy = np.sum([report[key][1] for key in report])
+    print('Dataset memory: {0:.1f} MB (float64/int32: {1:.1f} MB)'.format(nbytes/2.**20,legacy/2.**20))
+
+class BatchPrefetcher():
+    def __init__(self,next_batch,depth=4,workers=1,dtype=np.float32,prepare=None,state=None,restore=None):
+        """
+        Background input pipeline. Worker threads call next_batch, cast the visibilities
+        to the input placeholder dtype and keep up to depth batches queued ahead of the
+        training step. The time the consumer spends blocked on the queue is tracked as
+        the input-bound fraction.
+        Batches are drawn one at a time and handed out in the order they were drawn. With
+        prepare, next_batch only draws and prepare turns the draw into the batch outside the
+        draw lock, so the workers still prepare in parallel. With state, state() is recorded
+        before every draw, for pending_state. With restore as well, stop(rewind=True) passes
+        the pending_state to restore, so the next prefetcher draws the discarded batches again.
+        """
+        self.next_batch = next_batch
+        self.prepare = prepare
+        self.state = state
+        self.restore = restore
+        self.dtype = dtype
+        self.depth = depth
+        self.draw_lock = threading.Lock()
+        self.cond = threading.Condition()
+        self.ready = {}
+        self.states = {}
+        self.ndrawn = 0
+        self.nconsumed = 0
+        self.stop_event = threading.Event()
+        self.reset_stats()
+        self.threads = [threading.Thread(target=self.worker) for i in range(workers)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def worker(self):
+        while not self.stop_event.is_set():
+            try:
+                with self.draw_lock:
+                    seq = self.ndrawn
+                    self.ndrawn += 1
+                    if self.state is not None:
+                        self.states[seq] = self.state()
+                    batch = self.next_batch()
+                if self.prepare is not None:
+                    batch = self.prepare(batch)
+                batch_x,batch_targets = batch
+                batch = (np.asarray(batch_x,dtype=self.dtype),np.asarray(batch_targets,dtype=np.int32))
+            except Exception as e:
+                # Hand the error to the consumer rather than dying silently
+                batch = e
+            with self.cond:
+                while seq >= self.nconsumed + self.depth and not self.stop_event.is_set():
+                    self.cond.wait(0.1)
+                if self.stop_event.is_set():
+                    return
+                self.ready[seq] = batch
+                self.cond.notify_all()
+            if isinstance(batch,Exception):
+                return
+
+    def next(self):
+        """
+        Returns the next queued (batch_x, batch_targets), blocking if none are ready.
+        """
+        t0 = time()
+        with self.cond:
+            while self.nconsumed not in self.ready:
+                self.cond.wait()
+            batch = self.ready.pop(self.nconsumed)
+            self.nconsumed += 1
+            self.cond.notify_all()
+        with self.draw_lock:
+            self.states.pop(self.nconsumed-1,None)
+        t1 = time()
+        if self.start is None:
+            # The first batch includes pipeline warm up, so timing starts after it
+            self.start = t1
+        else:
+            self.wait_time += t1 - t0
+            self.elapsed = t1 - self.start
+        self.nbatches += 1
+        if isinstance(batch,Exception):
+            raise batch
+        return batch
+
+    def pending_state(self):
+        """
+        state() from before the first batch drawn but not yet returned by next(), or the
+        current state() when there is none. Saved with a checkpoint, the batches still
+        queued are drawn again after a resume. Call from the thread calling next().
+        """
+        with self.draw_lock:
+            if self.nconsumed < self.ndrawn:
+                return self.states[self.nconsumed]
+            return self.state()
+
+    def input_bound_fraction(self):
+        """
+        Fraction of wall time since the first batch that the consumer spent waiting for input.
+        """
+        if self.elapsed <= 0.:
+            return 0.
+        return self.wait_time/self.elapsed
+
+    def reset_stats(self):
+        self.start = None
+        self.wait_time = 0.
+        self.elapsed = 0.
+        self.nbatches = 0
+
+    def stop(self,rewind=False):
+        """
+        Stops the workers and discards any queued batches. With rewind, the state is first
+        restored to before the first discarded batch was drawn.
+        """
+        self.stop_event.set()
+        with self.cond:
+            self.cond.notify_all()
+        for thread in self.threads:
+            thread.join()
+        if rewind:
+            if self.restore is None:
+                raise ValueError('Cannot rewind a prefetcher without state and restore.')
+            self.restore(self.pending_state())
+        self.ready = {}
+        self.states = {}
+
+def rng_state(rng):
+    """
+    State of a RandomState as a dict of arrays, for np.savez.
+    """
+    name,keys,pos,has_gauss,cached_gaussian = rng.get_state()
+    return {'rng_keys': keys,
+            'rng_pos': pos,
+            'rng_has_gauss': has_gauss,
+            'rng_cached_gaussian': cached_gaussian}
+
+def set_rng_state(rng,state):
+    """
+    Restores a RandomState from rng_state.
+    """
+    rng.set_state(('MT19937',np.asarray(state['rng_keys']),int(state['rng_pos']),
+                   int(state['rng_has_gauss']),float(state['rng_cached_gaussian'])))
+
+class EpochSampler():
+    def __init__(self,n=0,seed=None,shards=1):
+        """
+        Shuffled batch index sampler. A permutation of the n samples is drawn from its own
+        RandomState at the start of every epoch and handed out as contiguous slices, so
+        every sample is drawn once per epoch. The state can be saved with a checkpoint.
+        With shards > 1 the indices are split into the shards k::shards, each with its own
+        permutation, and every batch is the concatenation of an equal slice of each shard
+        (one per data-parallel tower).
+        """
+        self.rng = np.random.RandomState(seed)
+        self.shards = int(shards)
+        self.perm = None
+        self.epoch = 0
+        self.reset(n)
+
+    def reset(self,n):
+        """
+        Starts a new permutation over n samples at the next batch, after the dataset changed.
+        An epoch in progress (e.g. a streamed window) counts as finished.
+        """
+        if self.perm is not None:
+            self.epoch += 1
+        self.n = int(n)
+        self.perm = None
+        self.pos = np.zeros(self.shards,dtype=int)
+
+    def set_shards(self,shards):
+        """
+        Splits the indices into a new number of shards from the next batch on.
+        """
+        self.shards = int(shards)
+        self.reset(self.n)
+
+    def shard_sizes(self):
+        return [len(range(k,self.n,self.shards)) for k in range(self.shards)]
+
+    def sample(self,batch_size):
+        """
+        Returns the next batch_size indices, batch_size/shards from each shard in shard
+        order, each sorted so gathers run forward through the dataset arrays. A shard running
+        past the end of its epoch is completed from the next. The epoch is counted by shard 0.
+        """
+        if self.n < self.shards or self.n == 0:
+            raise ValueError('Cannot sample {0} shards from a dataset of {1}.'.format(self.shards,self.n))
+        if batch_size % self.shards != 0:
+            raise ValueError('Batch size {0} does not split into {1} shards.'.format(batch_size,self.shards))
+        sizes = self.shard_sizes()
+        if self.perm is None:
+            self.perm = [None]*self.shards
+        batch = []
+        for k in range(self.shards):
+            inds = []
+            left = batch_size//self.shards
+            while left > 0:
+                if self.perm[k] is None or self.pos[k] >= sizes[k]:
+                    if self.perm[k] is not None and k == 0:
+                        self.epoch += 1
+                    self.perm[k] = k + self.shards*self.rng.permutation(sizes[k])
+                    self.pos[k] = 0
+                take = self.perm[k][self.pos[k]:self.pos[k]+left]
+                self.pos[k] += len(take)
+                left -= len(take)
+                inds.append(take)
+            batch.append(np.sort(np.concatenate(inds)))
+        return np.concatenate(batch)
+
+    def get_state(self):
+        """
+        Position, permutation and RNG state as a dict of arrays. Shards that have not
+        started their permutation yet are saved as a position past their end.
+        """
+        sizes = self.shard_sizes()
+        perm = [np.zeros(0,dtype=int)]
+        pos = np.array(self.pos)
+        if self.perm is not None:
+            perm = [p if p is not None else np.zeros(sizes[k],dtype=int) for k,p in enumerate(self.perm)]
+            pos = np.array([pos[k] if p is not None else sizes[k] for k,p in enumerate(self.perm)])
+        state = {'n': self.n,
+                 'shards': self.shards,
+                 'pos': pos,
+                 'epoch': self.epoch,
+                 'perm': np.concatenate(perm)}
+        state.update(rng_state(self.rng))
+        return state
+
+    def set_state(self,state):
+        """
+        Restores a state from get_state. If the dataset size or the number of shards changed
+        since (a reloaded generation), the RNG and epoch are restored and a new permutation
+        is started.
+        """
+        self.epoch = int(state['epoch'])
+        shards = int(state['shards']) if 'shards' in state else 1
+        if int(state['n']) == self.n and shards == self.shards and len(state['perm']) > 0:
+            bounds = np.cumsum([0]+self.shard_sizes())
+            self.perm = [np.asarray(state['perm'][bounds[k]:bounds[k+1]]) for k in range(self.shards)]
+            self.pos = np.atleast_1d(np.asarray(state['pos'],dtype=int)).copy()
+        else:
+            self.perm = None
+            self.pos = np.zeros(self.shards,dtype=int)
+        set_rng_state(self.rng,state)
+
+def synthetic_worker(out,stop_event,geometry,counters,chtypes,chunk_size,seed):
+    """
+    Worker process of SyntheticStream. Simulates chunk_size waterfalls at a time and folds
+    them with the fold geometry current at the time, until stopped.
+    """
+    sim = WaterfallSimulator(seed=seed)
+    while not stop_event.is_set():
+        t0 = time()
+        fold_factor,psize = geometry[:]
+        data,flags = sim(chunk_size)
+        f_data,f_labels = fold_waterfalls(data,flags,chtypes,fold_factor,psize,rng=sim.rng)
+        perm = sim.rng.permutation(len(f_data))
+        chunk = (fold_factor,psize,f_data[perm],f_labels[perm])
+        with counters.get_lock():
+            counters[0] += chunk_size
+            counters[1] += time() - t0
+        while not stop_event.is_set():
+            try:
+                out.put(chunk,timeout=0.1)
+                break
+            except queue.Full:
+                continue
+
+class SyntheticStream():
+    def __init__(self,chtypes,fold_factor,psize,chunk_size=16,workers=2,depth=4,seed=None):
+        """
+        Infinite source of folded training patches from WaterfallSimulator. Worker processes
+        simulate and fold chunk_size waterfalls at a time and keep up to depth chunks queued.
+        Chunks carry the fold geometry they were made with, so set_geometry can change it
+        without restarting the workers.
+        """
+        self.queue = multiprocessing.Queue(maxsize=depth)
+        self.stop_event = multiprocessing.Event()
+        self.geometry = multiprocessing.Array('i',[fold_factor,psize])
+        # Waterfalls simulated and worker seconds spent on them
+        self.counters = multiprocessing.Array('d',[0.,0.])
+        self.lock = threading.Lock()
+        self.pending = deque()
+        self.reused = 0
+        self.start = time()
+        self.procs = [multiprocessing.Process(target=synthetic_worker,args=(self.queue,self.stop_event,self.geometry,self.counters,
+                                                                            chtypes,chunk_size,None if seed is None else seed+i))
+                      for i in range(workers)]
+        for proc in self.procs:
+            proc.daemon = True
+            proc.start()
+
+    def set_geometry(self,fold_factor,psize):
+        self.geometry[:] = [fold_factor,psize]
+
+    def next(self,fold_factor,psize,block=True):
+        """
+        Returns the next chunk of patches folded with fold_factor and psize. Chunks of the
+        stream's current geometry that arrive for another caller are queued in order for
+        whoever asks for that geometry next, chunks of any other geometry are dropped.
+        Without block, returns None when no chunk is ready.
+        Output: (N, Time, Reduced Frequency, Channels) float32, (N, Time*Reduced Frequency) uint8
+        """
+        while True:
+            chunk = None
+            with self.lock:
+                current = tuple(self.geometry[:])
+                kept = deque()
+                for pending in self.pending:
+                    if chunk is None and pending[:2] == (fold_factor,psize):
+                        chunk = pending
+                    elif pending[:2] == current:
+                        kept.append(pending)
+                self.pending = kept
+            if chunk is None:
+                try:
+                    chunk = self.queue.get(block=block)
+                except queue.Empty:
+                    return None
+            if chunk[:2] == (fold_factor,psize):
+                sh = np.shape(chunk[2])
+                return chunk[2],chunk[3].reshape(-1,sh[1]*sh[2])
+            if chunk[:2] == tuple(self.geometry[:]):
+                with self.lock:
+                    self.pending.append(chunk)
+
+    def stats(self):
+        """
+        Waterfalls simulated so far, the rate per core (per worker second) and over all
+        workers since the start, and the number of windows reused while the workers were behind.
+        """
+        with self.counters.get_lock():
+            nwf,busy = self.counters[0],self.counters[1]
+        return {'waterfalls': int(nwf),
+                'per_core': nwf/busy if busy > 0 else 0.,
+                'total': nwf/(time() - self.start),
+                'reused_windows': self.reused}
+
+    def stop(self):
+        """
+        Stops the workers, draining the queue so none is left blocked on it.
+        """
+        self.stop_event.set()
+        while any([proc.is_alive() for proc in self.procs]):
+            try:
+                while True:
+                    self.queue.get_nowait()
+            except queue.Empty:
+                pass
+            for proc in self.procs:
+                proc.join(0.1)
+
+class FlagWriter():
+    def __init__(self,dset,filename=None,mode='or',depth=2):
+        """
+        Persists unfolded flag predictions of a pyuvdata RFIDataset chunk by chunk. Writes
+        run in a background thread so they overlap with the inference of the next chunk.
+        A filename ending in .h5 gets a compact bit-packed flag file, any other filename gets
+        the UVData with the flags written into its flag_array (None only updates flag_array).
+        mode: 'or' combines the predictions with the existing flags, 'replace' overwrites them
+        """
+        if mode not in ['or','replace']:
+            raise ValueError('Unknown flag mode {0}'.format(mode))
+        self.dset = dset
+        self.filename = filename
+        self.mode = mode
+        self.compact = filename is not None and filename.endswith('.h5')
+        self.n = 0
+        self.wait_time = 0.
+        self.error = None
+        self.discard = False
+        self.closed = False
+        if self.compact:
+            self.f = h5py.File(filename,'w')
+            self.f.attrs['mode'] = mode
+        self.queue = queue.Queue(maxsize=depth)
+        self.thread = threading.Thread(target=self.worker)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def worker(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.error is not None or self.discard:
+                continue
+            try:
+                self.write(*item)
+            except Exception as e:
+                # Raised in the consumer on the next put or close
+                self.error = e
+
+    def write(self,keys,flags):
+        if not self.compact:
+            self.dset.write_flags(keys,flags,self.dset.uv.flag_array,mode=self.mode)
+            self.n += len(keys)
+            return
+        if self.mode == 'or':
+            flags = flags | np.array([self.dset.uv.get_flags(key) for key in keys],dtype=bool)
+        if self.n == 0:
+            nwf = self.dset.get_size()
+            packed = (nwf,)+np.shape(np.packbits(flags[0],axis=-1))
+            self.f.attrs['nfreqs'] = np.shape(flags)[-1]
+            self.f.create_dataset('flag',packed,dtype=np.uint8,chunks=(1,)+packed[1:])
+            self.f.create_dataset('antpairs',(nwf,2),dtype=np.int32)
+            self.f.create_dataset('pols',(nwf,),dtype='S4')
+        inds = slice(self.n,self.n+len(keys))
+        self.f['flag'][inds] = np.packbits(flags,axis=-1)
+        self.f['antpairs'][inds] = np.array([key[:2] for key in keys])
+        self.f['pols'][inds] = np.array([key[2] for key in keys],dtype='S4')
+        self.n += len(keys)
+
+    def put(self,keys,flags):
+        """
+        Queues (Chunk, Time, Frequency) flags for the (ant1, ant2, pol) keys, blocking only
+        if depth chunks are already waiting to be written.
+        """
+        if self.error is not None:
+            raise self.error
+        t0 = time()
+        self.queue.put((keys,np.asarray(flags,dtype=bool)))
+        self.wait_time += time() - t0
+
+    def close(self,save=True):
+        """
+        Waits for the queued writes, then closes the flag file or saves the UVData. With
+        save=False, e.g. after a failure, the queued writes are dropped and no output is left
+        behind. Closing again does nothing.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        t0 = time()
+        self.discard = not save
+        self.queue.put(None)
+        self.thread.join()
+        if self.compact:
+            self.f.close()
+        if not save:
+            if self.compact:
+                os.remove(self.filename)
+            return
+        if self.error is not None:
+            raise self.error
+        if not self.compact and self.filename is not None:
+            self.dset.uv.write_miriad(self.filename,clobber=True)
+        self.wait_time += time() - t0
+
+def read_flag_file(filename):
+    """
+    Reads a compact flag file written by FlagWriter.
+    Output: [(ant1, ant2, pol), ...], (Waterfalls, Time, Frequency) boolean flags
+    """
+    with h5py.File(filename,'r') as f:
+        nfreqs = f.attrs['nfreqs']
+        flags = np.unpackbits(f['flag'][:],axis=-1)[...,:nfreqs].astype(bool)
+        pols = [pol if isinstance(pol,str) else pol.decode() for pol in f['pols'][:]]
+        keys = [(int(a1),int(a2),pol) for (a1,a2),pol in zip(f['antpairs'][:],pols)]
+    return keys,flags
+
+def saved_seed(filename):
+    """
+    Seed of the dataset whose state save_samplers wrote to filename, None if it has none.
+    """
+    f = np.load(filename)
+    seed = int(f['seed']) if 'seed' in f.files else None
+    f.close()
+    return seed
+
+class RFIDataset():
+    def __init__(self):
+        """
+        RFI class that handles loading, partitioning, and augmenting datasets.
+        """
+        print('Welcome to the HERA RFI training and evaluation dataset suite.')
+        self.stream = False
+        self.augment = False
+        self.lock = threading.Lock()
+        self.reload_thread = None
+        self.synthetic_stream = None
+
+    def seed_rngs(self,seed,shards=1):
+        """
+        Seeds all of the dataset's randomness from one seed: the dataset RandomState (splits,
+        subsets, windows, expansion and time subsampling), and from its first draws the
+        augmenter, the samplers and the simulator workers. A seed of None draws a fresh one.
+        The seed is kept in self.seed and saved with the sampler state. The training sampler
+        splits its indices into shards, one per data-parallel tower. Reloads draw their fold
+        geometry and the seed of each new generation from a RandomState of their own,
+        reload_rng, so a generation built in the background never races the batches drawn
+        from self.rng.
+        """
+        if seed is None:
+            seed = np.random.randint(2**31)
+        self.seed = int(seed)
+        self.rng = np.random.RandomState(self.seed)
+        augment_seed,train_seed,eval_seed,self.sim_seed,reload_seed = [int(x) for x in self.rng.randint(0,2**31,size=5)]
+        self.reload_rng = np.random.RandomState(reload_seed)
+        self.augmenter = Augmenter(seed=augment_seed)
+        self.train_sampler = EpochSampler(seed=train_seed,shards=shards)
+        self.eval_sampler = EpochSampler(seed=eval_seed)
+
+    @timed('dataset/load')
+    def load(self,tdset,vdset,batch_size,psize,hybrid=False,chtypes='AmpPhs',fold_factor=16,cut=False,patchwise_train=False,expand=False,predict=False,stream=False,window=64,cache_dir=None,augment=False,seed=None,sim_workers=2,shards=1):
+        # load data, shards: data-parallel towers each drawing from their own shard of the training indices
+        if cut:
+            self.cut = 14
+        else:
+            self.cut = 16
+        self.chtypes = chtypes
+        self.batch_size = batch_size
+        self.cache_dir = cache_dir
+        self.augment = augment
+        self.seed_rngs(seed,shards=shards)
+        print('Dataset seed: %i' % self.seed)
+        print('A batch size of %i has been set.' % self.batch_size)
+        if tdset == 'synthetic':
+            # Simulated while training instead of read from a pre-simulated file
+            self.load_synthetic(fold_factor,psize,window if window > 0 else 16,workers=sim_workers,seed=self.sim_seed)
+            return
+
+        if vdset == 'vanilla':
+            f1 = h5py.File('SimVis_2000_v911.h5','r')
+        elif vdset == '':
+            f1 = h5py.File('SimVis_2000_v911.h5','r')
+        else:
+            f1 = load_pipeline_dset(vdset)
+            
+        if tdset == 'v5':
+            f2 = h5py.File('SimVis_v5.h5','r') # Load in simulated data
+        elif tdset == 'v11':
+            f2 = h5py.File('SimVis_1000_v11.h5','r')
+        elif tdset == 'v7':
+            f2 = h5py.File('SimVis_2000_v7.h5','r')
+        elif tdset == 'v8':
+            f2 = h5py.File('SimVis_2000_v8.h5','r')
+        elif tdset == 'v9':
+            f2 = h5py.File('SimVis_1000_v9.h5','r')
+        elif tdset == 'v911':
+            f2 = h5py.File('SimVis_2000_v911.h5','r')
+        elif tdset == 'v12':
+            f2 = h5py.File('SimVis_2000_v12.h5','r')
+        elif tdset == 'v13':
+            # This is v9 + v11 + FineTune
+            f2 = h5py.File('SimVis_2000_v911.h5','r') 
+#            f2 = h5py.File('SimVis_3000_v13.h5','r')
+#            f2 = h5py.File('SimVis_1000_v11.h5','r')
+        elif tdset == 'v4':
+            f2 = h5py.File('SimVisRFI_15_120_v4.h5','r')
+            
+        self.psize = psize # Pixel pad size for individual carved bands
+
+        # We want to augment our training dataset with the entirety of the simulated data
+        # but with only half of the real data. The remaining real data half will become
+        # the evaluation dataset
+        f1_len = len(f1['data'])
+        f1_sub = self.rng.choice(f1_len)
+        f2_len = len(f2['data'])
+        
+        f1_r = int(f1_len)#np.shape(f1['data'][np.random.choice(range())])[0]
+        f2_s = int(f2_len)#np.shape(f2['data'])[0]
+        #if expand:
+        #    f2_s*=2
+        self.dset_size = np.copy(f1_r)+np.copy(f2_s)
+        self.fold_factor = fold_factor
+        print 'Size of real dataset: ',f1_r
+        print ''
+        if stream:
+            # Leave the waterfalls on disk and only fold a window of them at a time
+            self.load_stream(f1,f2,hybrid,window)
+            return
+        # Cut up real dataset and labels
+        samples = range(f1_r)
+        rnd_ind = self.rng.randint(0,f1_r)
+        #if expand:
+        #    data_real,labels_real = expand_validation_dataset(f1['data'][:f1_r,:,:],f1['flag'][:f1_r,:,:])
+        #else:
+        dreal_choice = self.rng.choice(range(0,f1_len),size=f1_r)
+        dsim_choice = self.rng.choice(range(0,f2_len),size=f2_s)
+        use_cache = cache_dir is not None and chtypes in ['AmpPhs','Amp'] and not patchwise_train
+        if not use_cache:
+            # Read each file once, with the binary flags as uint8
+            self.data_real = np.array(f1['data'])
+            self.labels_real = np.asarray(f1['flag'],dtype=np.uint8)
+            self.data_sim = np.array(f2['data'])
+            self.labels_sim = np.asarray(f2['flag'],dtype=np.uint8)
+            data_real = self.data_real[dreal_choice][:f1_r,:,:]
+            labels_real = self.labels_real[dreal_choice][:f1_r,:,:]
+            data_sim = self.data_sim[dsim_choice][:f2_s,:,:]
+            labels_sim = self.labels_sim[dsim_choice][:f2_s,:,:]
+        else:
+            # Raw waterfalls are only needed for prediction, so read them lazily
+            self.data_real = f1['data']
+            self.labels_real = f1['flag']
+            self.data_sim = f2['data']
+            self.labels_sim = f2['flag']
+        self.sim_source = f2
+        time0 = time()
+
+        if use_cache:
+            # Read the bootstrapped waterfalls' patches from disk instead of refolding
+            f_real,f_real_labels = self.patch_cache(f1,fold_factor,self.psize).read(dreal_choice)
+            f_sim,f_sim_labels = self.patch_cache(f2,fold_factor,self.psize).read(dsim_choice)
+            if chtypes == 'AmpPhs':
+                f_sim,f_sim_labels = self.expand(f_sim,f_sim_labels)
+        elif chtypes ==  'AmpPhs':
+            # Folded deterministically like the patch cache, so both give the same training set
+            f_real,f_real_labels = fold_waterfalls(data_real,labels_real,chtypes,fold_factor,self.psize,deterministic=True)
+            del(data_real)
+            del(labels_real)
+            # Cut up sim dataset and labels
+            if patchwise_train:
+                data_sim_patch,labels_sim_patch = patchwise(data_sim,labels_sim,self.rng)
+                data_sim = np.array(np.vstack((data_sim,data_sim_patch)))
+                labels_sim = np.array(np.vstack((labels_sim,labels_sim_patch)))
+                print('data_sim size: {0}'.format(np.shape(data_sim)))
+                f_sim,f_sim_labels = fold_waterfalls(data_sim,labels_sim,chtypes,fold_factor,self.psize,deterministic=True)
+                #f_sim,f_sim_labels = expand_dataset(f_sim,f_sim_labels)
+                print('Expanded training dataset size: {0}'.format(np.shape(f_sim)))
+            else:
+                f_sim,f_sim_labels = fold_waterfalls(data_sim,labels_sim,chtypes,fold_factor,self.psize,deterministic=True)
+                f_sim,f_sim_labels = self.expand(f_sim,f_sim_labels)
+                del(data_sim)
+                del(labels_sim)
+        elif chtypes in ['AmpPhs2','Phs']:
+            f_real,f_real_labels = fold_waterfalls(data_real,labels_real,chtypes,fold_factor,self.psize,deterministic=True)
+            # Cut up sim dataset and labels
+            f_sim,f_sim_labels = fold_waterfalls(data_sim,labels_sim,chtypes,fold_factor,self.psize,deterministic=True)
+        elif chtypes == 'Amp':
+            f_real,f_real_labels = fold_waterfalls(data_real,labels_real,chtypes,fold_factor,self.psize,deterministic=True)
+            print('f_real: ',np.shape(f_real))
+            if patchwise_train:
+                data_sim_patch,labels_sim_patch = patchwise(data_sim,labels_sim,self.rng)
+                data_sim = np.array(np.vstack((data_sim,data_sim_patch)))
+                labels_sim = np.array(np.vstack((labels_sim,labels_sim_patch)))
+                f_sim,f_sim_labels = fold_waterfalls(data_sim,labels_sim,chtypes,fold_factor,self.psize,deterministic=True)
+                #f_sim,f_sim_labels = expand_dataset(f_sim,f_sim_labels)
+            else:
+                f_sim,f_sim_labels = fold_waterfalls(data_sim,labels_sim,chtypes,fold_factor,self.psize,deterministic=True)
+            
+        print 'Training dataset loaded.'
+        print 'Training dataset size: ',np.shape(f_real)
+
+        print 'Simulated training dataset loaded.'
+        print 'Training dataset size: ',np.shape(f_sim)
+        
+        real_sh = np.shape(f_real)
+
+        if chtypes == 'AmpPhsCmp':
+            d_type = np.complex64
+        else:
+            d_type = np.float32
+        real_len = np.shape(f_real)[0]        
+        if hybrid:
+            print('Hybrid training dataset selected.')
+            # We want to mix the real and simulated datasets
+            # and then keep some real datasets for evaluation
+            real_len = np.shape(f_real)[0]
+            self.eval_data = np.asarray(f_real[:int(real_len/2),:,:,:],dtype=d_type)
+            self.eval_labels = np.asarray(f_real_labels[:int(real_len/2),:,:],dtype=np.uint8).reshape(-1,real_sh[1]*real_sh[2])
+            
+            train_data = np.vstack((f_real[int(real_len/2):,:,:,:],f_sim)).astype(d_type,copy=False)
+            train_labels = np.vstack((f_real_labels[int(real_len/2):,:,:],f_sim_labels)).astype(np.uint8,copy=False)
+            hybrid_len = np.shape(train_data)[0]
+            mix_ind = self.rng.permutation(hybrid_len)
+
+            self.train_data = train_data[mix_ind,:,:,:]
+            self.train_labels = train_labels[mix_ind,:,:].reshape(-1,real_sh[1]*real_sh[2])
+            self.eval_len = np.shape(self.eval_data)[0]
+            self.train_len = np.shape(self.train_data)[0]
+        else:
+            # Format evaluation dataset
+            sim_len = np.shape(f_sim)[0]
+            self.eval_data = np.asarray(f_sim[int(sim_len*.8):,:,:,:],dtype=d_type)
+            self.eval_labels = np.asarray(f_sim_labels[int(sim_len*.8):,:,:],dtype=np.uint8).reshape(-1,real_sh[1]*real_sh[2])
+            eval1 = np.shape(self.eval_data)[0]
+
+            # Format training dataset
+            self.train_data = np.asarray(f_sim[:int(sim_len*.8),:,:,:],dtype=d_type)
+            self.train_labels = np.asarray(f_sim_labels[:int(sim_len*.8),:,:],dtype=np.uint8).reshape(-1,real_sh[1]*real_sh[2])
+
+            train0 = np.shape(self.train_data)[0]
+            self.test_data = self.eval_data[rnd_ind,:,:,:].reshape(1,real_sh[1],real_sh[2],real_sh[3])
+            self.test_labels = self.eval_labels[rnd_ind,:].reshape(1,real_sh[1]*real_sh[2])
+            self.eval_len = np.shape(self.eval_data)[0]
+            self.train_len = np.shape(self.train_data)[0]
+        self.train_sampler.reset(self.train_len)
+        self.eval_sampler.reset(self.eval_len)
+        print_memory_report(self.__dict__)
+
+    def load_patches(self,train_data,train_labels,eval_data,eval_labels,batch_size,chtypes='AmpPhs',augment=False,seed=None):
+        """
+        Installs already folded in-memory patches (e.g. synthetic ones) as the training and
+        evaluation datasets, in the float32/uint8 layout load produces.
+        Input: (N, Time, Reduced Frequency, Channels), (N, Time, Reduced Frequency)
+        """
+        self.chtypes = chtypes
+        self.batch_size = batch_size
+        self.augment = augment
+        self.seed_rngs(seed)
+        sh = np.shape(train_data)
+        self.train_data = np.asarray(train_data,dtype=np.float32)
+        self.train_labels = np.asarray(train_labels,dtype=np.uint8).reshape(-1,sh[1]*sh[2])
+        self.eval_data = np.asarray(eval_data,dtype=np.float32)
+        self.eval_labels = np.asarray(eval_labels,dtype=np.uint8).reshape(-1,sh[1]*sh[2])
+        self.train_len = len(self.train_data)
+        self.eval_len = len(self.eval_data)
+        self.dset_size = self.train_len + self.eval_len
+        self.train_sampler.reset(self.train_len)
+        self.eval_sampler.reset(self.eval_len)
+
+    def load_synthetic(self,fold_factor,psize,window=16,workers=2,seed=None,eval_waterfalls=64):
+        """
+        Streaming backend for load with simulated training data. Each training window of
+        window waterfalls comes from a SyntheticStream, and the current window is gone over
+        again when the workers are behind rather than stalling training. Evaluation uses a
+        fixed simulated set of eval_waterfalls, also used for prediction.
+        """
+        self.stream = True
+        self.window = window
+        self.time_subsample = False
+        self.fold_factor = fold_factor
+        self.psize = psize
+        self.data_real,self.labels_real = WaterfallSimulator(seed=None if seed is None else seed+workers)(eval_waterfalls)
+        self.synthetic_stream = SyntheticStream(self.chtypes,fold_factor,psize,chunk_size=window,workers=workers,seed=seed)
+        self.fill_window('train',block=True)
+        self.eval_data,self.eval_labels = self.fold_synthetic_eval(fold_factor,psize)
+        self.eval_len = len(self.eval_data)
+        self.eval_served = 0
+        self.eval_sampler.reset(self.eval_len)
+        self.dset_size = self.train_len + self.eval_len
+        print('Simulating training windows of %i waterfalls on %i workers.' % (window,workers))
+        print('Training window size: ',np.shape(self.train_data))
+        self.test_data = self.eval_data[:1]
+        self.test_labels = self.eval_labels[:1]
+        print_memory_report(self.__dict__)
+
+    def fold_synthetic_eval(self,fold_factor,psize,rng=None):
+        """
+        Folds the fixed simulated evaluation waterfalls.
+        """
+        if rng is None:
+            rng = self.rng
+        f_data,f_labels = fold_waterfalls(self.data_real,self.labels_real,self.chtypes,fold_factor,psize,rng=rng)
+        sh = np.shape(f_data)
+        return f_data,f_labels.reshape(-1,sh[1]*sh[2])
+
+    def load_stream(self,f1,f2,hybrid,window,chunk_size=32):
+        """
+        Streaming backend for load. Waterfalls are kept on disk and read, folded and
+        augmented one window of waterfalls at a time, so memory scales with the window
+        size rather than the dataset size.
+        """
+        self.stream = True
+        self.window = window
+        self.time_subsample = False
+        self.data_real = f1['data']
+        self.labels_real = f1['flag']
+        self.data_sim = f2['data']
+        self.labels_sim = f2['flag']
+        real = WaterfallStream(f1,chunk_size=chunk_size)
+        sim = WaterfallStream(f2,chunk_size=chunk_size)
+        self.stream_caches = {}
+        if self.cache_dir is not None:
+            self.stream_caches = {real: self.patch_cache(f1,self.fold_factor,self.psize),
+                                  sim: self.patch_cache(f2,self.fold_factor,self.psize)}
+        if hybrid:
+            print('Hybrid training dataset selected.')
+            # Half of the real data is kept for evaluation, the rest is mixed with the simulated data
+            real_half = int(len(real)/2)
+            self.stream_splits = {'train': [(real,np.arange(real_half,len(real))),(sim,np.arange(len(sim)))],
+                                  'eval': [(real,np.arange(real_half))]}
+        else:
+            sim_inds = self.rng.permutation(len(sim))
+            sim_cut = int(len(sim)*.8)
+            self.stream_splits = {'train': [(sim,sim_inds[:sim_cut])],
+                                  'eval': [(sim,sim_inds[sim_cut:])]}
+        self.fill_window('train')
+        self.fill_window('eval')
+        print('Streaming a window of %i waterfalls per split.' % self.window)
+        print('Training window size: ',np.shape(self.train_data))
+        self.test_data = self.eval_data[:1]
+        self.test_labels = self.eval_labels[:1]
+        print_memory_report(self.__dict__)
+
+    def fold_window(self,split,fold_factor,psize,time_subsample,caches,rng=None):
+        """
+        Reads a random window of waterfalls for the 'train' or 'eval' split from disk, or
+        from their patch caches, and folds them into flattened patches and labels.
+        rng defaults to the dataset RandomState.
+        """
+        if rng is None:
+            rng = self.rng
+        sources = self.stream_splits[split]
+        lens = [len(inds) for src,inds in sources]
+        total = int(np.sum(lens))
+        picks = rng.choice(total,size=min(self.window,total),replace=False)
+        f_data = []
+        f_labels = []
+        offset = 0
+        for (src,inds),n in zip(sources,lens):
+            sel = np.sort(picks[(picks >= offset) & (picks < offset+n)] - offset)
+            offset += n
+            if len(sel) == 0:
+                continue
+            if src in caches:
+                f_data_,f_labels_ = caches[src].read(inds[sel])
+                if time_subsample:
+                    f_data_,f_labels_ = subsample_time_patches(f_data_,f_labels_,psize,rng)
+            else:
+                data,labels = src.read(inds[sel])
+                if time_subsample:
+                    t0 = rng.randint(0,20)
+                    t1 = rng.randint(40,60)
+                    data = np.pad(data[:,t0:t1,:],((0,0),(t0,60-t1),(0,0)),mode='reflect')
+                    labels = np.pad(labels[:,t0:t1,:],((0,0),(t0,60-t1),(0,0)),mode='reflect')
+                f_data_,f_labels_ = fold_waterfalls(data,labels,self.chtypes,fold_factor,psize,rng=rng)
+                del(data)
+                del(labels)
+            f_data.append(f_data_)
+            f_labels.append(f_labels_)
+        f_data = np.concatenate(f_data)
+        f_labels = np.concatenate(f_labels)
+        if self.chtypes == 'AmpPhs':
+            f_data,f_labels = self.expand(f_data,f_labels,rng=rng)
+        sh = np.shape(f_data)
+        f_data = np.asarray(f_data,dtype=np.float32)
+        f_labels = np.asarray(f_labels,dtype=np.uint8).reshape(-1,sh[1]*sh[2])
+        return f_data,f_labels
+
+    @timed('dataset/fill_window')
+    def fill_window(self,split,block=False):
+        """
+        Replaces the current window of the 'train' or 'eval' split with a new one.
+        """
+        if self.synthetic_stream is not None:
+            chunk = None
+            if split == 'train':
+                chunk = self.synthetic_stream.next(self.fold_factor,self.psize,block=block)
+            if chunk is None:
+                # Workers behind, or the fixed evaluation set: another pass over the current window
+                if split == 'train':
+                    self.synthetic_stream.reused += 1
+                    self.train_served = 0
+                    self.train_sampler.reset(self.train_len)
+                else:
+                    self.eval_served = 0
+                    self.eval_sampler.reset(self.eval_len)
+                return
+            f_data,f_labels = chunk
+        else:
+            f_data,f_labels = self.fold_window(split,self.fold_factor,self.psize,self.time_subsample,self.stream_caches)
+        if split == 'train':
+            self.train_data = f_data
+            self.train_labels = f_labels
+            self.train_len = len(f_data)
+            self.train_served = 0
+            self.train_sampler.reset(self.train_len)
+        else:
+            self.eval_data = f_data
+            self.eval_labels = f_labels
+            self.eval_len = len(f_data)
+            self.eval_served = 0
+            self.eval_sampler.reset(self.eval_len)
+
+    def expand(self,data,labels,rng=None):
+        """
+        Up-front dataset augmentation, skipped when batches are augmented as they are drawn.
+        """
+        if self.augment:
+            return data,labels
+        return expand_dataset(data,labels,rng=self.rng if rng is None else rng)
+
+    def patch_cache(self,source,fold_factor,psize):
+        """
+        Opens (building or extending if needed) the on-disk patch cache of an h5py waterfall dataset.
+        """
+        return PatchCache(source,fold_factor,psize,self.chtypes,cache_dir=self.cache_dir)
+
+    @timed('dataset/build_generation')
+    def build_generation(self,fold_factor,psize,time_subsample=False,batch=None,rng=None):
+        """
+        Folds a new generation of the training and evaluation datasets without touching
+        the one currently in use. Returns the attributes that swap installs. Every random
+        draw comes from rng, by default a new generation_rng.
+        """
+        if rng is None:
+            rng = self.generation_rng()
+        gen = {'fold_factor': fold_factor,'psize': psize,'time_subsample': time_subsample}
+        if self.synthetic_stream is not None:
+            # The workers move on to the new geometry, the current window is kept until the swap
+            self.synthetic_stream.set_geometry(fold_factor,psize)
+            gen['train_data'],gen['train_labels'] = self.synthetic_stream.next(fold_factor,psize)
+            gen['eval_data'],gen['eval_labels'] = self.fold_synthetic_eval(fold_factor,psize,rng=rng)
+            return gen
+        if self.stream:
+            # Nothing is held in memory beyond the current windows, so only those are refolded
+            caches = self.stream_caches
+            if self.cache_dir is not None:
+                caches = dict([(src,self.patch_cache(src.source,fold_factor,psize)) for src in caches])
+            gen['stream_caches'] = caches
+            gen['train_data'],gen['train_labels'] = self.fold_window('train',fold_factor,psize,time_subsample,caches,rng=rng)
+            gen['eval_data'],gen['eval_labels'] = self.fold_window('eval',fold_factor,psize,time_subsample,caches,rng=rng)
+            return gen
+        d_type = np.float32
+        f1_r = int(len(self.data_real))
+        f2_s = int(len(self.data_sim))
+        if batch:
+            dreal_choice = rng.choice(range(0,f1_r),size=batch)
+            dsim_choice = rng.choice(range(0,f2_s),size=batch)
+        else:
+            dreal_choice = rng.choice(range(0,f1_r),size=f1_r)
+            dsim_choice = rng.choice(range(0,f2_s),size=f2_s)
+            
+        if self.cache_dir is not None:
+            cache = self.patch_cache(self.sim_source,fold_factor,psize)
+            if time_subsample:
+                # The same bootstrapped waterfalls as the uncached time subsampling
+                f_sim,f_sim_labels = cache.read(dsim_choice)
+                print('Permuting dataset along time and frequency.')
+                f_sim,f_sim_labels = subsample_time_patches(f_sim,f_sim_labels,psize,rng)
+                f_sim,f_sim_labels = self.expand(f_sim,f_sim_labels,rng=rng)
+            else:
+                f_sim,f_sim_labels = cache.patches()
+        elif time_subsample:
+            t0 = rng.randint(0,20)
+            t1 = rng.randint(40,60)
+            pad_t0 = t0
+            pad_t1 = 60 - t1
+#            data_real = np.pad(self.data_real[:,t0:t1,:,:],((0,0),(pad_t0,pad_t1),(0,0),(0,0)),mode='constant')
+#            labels_real = np.pad(self.labels_real[:,t0:t1,:],((0,0),(pad_t0,pad_t1),(0,0)),mode='constant')
+            data_sim = np.pad(self.data_sim[dsim_choice][:,t0:t1,:],((0,0),(pad_t0,pad_t1),(0,0)),mode='reflect')
+            labels_sim = np.pad(self.labels_sim[dsim_choice][:,t0:t1,:],((0,0),(pad_t0,pad_t1),(0,0)),mode='reflect')
+            f_sim,f_sim_labels = fold_waterfalls(data_sim,labels_sim,'AmpPhs',fold_factor,psize,rng=rng)
+            print('Permuting dataset along time and frequency.')
+            f_sim,f_sim_labels = self.expand(f_sim,f_sim_labels,rng=rng)
+        else:
+            f_sim,f_sim_labels = fold_waterfalls(self.data_sim,self.labels_sim,'AmpPhs',fold_factor,psize,rng=rng)
+            #f_sim,f_sim_labels = expand_dataset(f_sim,f_sim_labels)
+            
+        sim_len = np.shape(f_sim)[0]
+        sim_sh = np.shape(f_sim)
+        print('Sim Shape',sim_sh)
+        gen['eval_data'] = np.asarray(f_sim[int(sim_len*.8):,:,:,:],dtype=d_type).reshape(-1,sim_sh[1],sim_sh[2],2)
+        gen['eval_labels'] = np.asarray(f_sim_labels[int(sim_len*.8):,:,:],dtype=np.uint8).reshape(-1,sim_sh[1]*sim_sh[2])
+        # Format training dataset
+        gen['train_data'] = np.asarray(f_sim[:int(sim_len*.8),:,:,:],dtype=d_type).reshape(-1,sim_sh[1],sim_sh[2],2)
+        gen['train_labels'] = np.asarray(f_sim_labels[:int(sim_len*.8),:,:],dtype=np.uint8).reshape(-1,sim_sh[1]*sim_sh[2])
+        return gen
+
+    @timed('dataset/swap')
+    def swap(self,gen):
+        """
+        Atomically installs a dataset generation from build_generation.
+        """
+        with self.lock:
+            for key in gen:
+                setattr(self,key,gen[key])
+            self.train_len = np.shape(self.train_data)[0]
+            self.eval_len = np.shape(self.eval_data)[0]
+            self.train_served = 0
+            self.eval_served = 0
+            self.train_sampler.reset(self.train_len)
+            self.eval_sampler.reset(self.eval_len)
+
+    def generation_rng(self):
+        """
+        RandomState of the next dataset generation, seeded from reload_rng.
+        """
+        with self.lock:
+            return np.random.RandomState(self.reload_rng.randint(2**31))
+
+    def draw_geometry(self,psizes,fold_factors):
+        """
+        Draws the pad size and fold factor of the next generation from reload_rng.
+        """
+        with self.lock:
+            return int(self.reload_rng.choice(psizes)),int(self.reload_rng.choice(fold_factors))
+
+    def reload(self,fold_factor,psize,time_subsample=False,batch=None):
+        self.swap(self.build_generation(fold_factor,psize,time_subsample=time_subsample,batch=batch))
+
+    def reload_async(self,fold_factor,psize,time_subsample=False,batch=None):
+        """
+        Non-blocking reload. The next dataset generation is built in a background thread
+        while batches keep being drawn from the current one, and is installed by swap_reload.
+        """
+        self.reload_result = None
+        # Seeded here, so the generation does not depend on when the thread runs
+        rng = self.generation_rng()
+        def build():
+            t0 = time()
+            try:
+                self.reload_result = (self.build_generation(fold_factor,psize,time_subsample=time_subsample,batch=batch,rng=rng),time() - t0)
+            except Exception as e:
+                self.reload_result = e
+        self.reload_thread = threading.Thread(target=build)
+        self.reload_thread.daemon = True
+        self.reload_thread.start()
+
+    def reload_ready(self):
+        """
+        True once a generation started by reload_async has finished building.
+        """
+        return self.reload_thread is not None and not self.reload_thread.is_alive()
+
+    def swap_reload(self):
+        """
+        Swaps in the generation built by reload_async, waiting for it if it is not done yet.
+        Returns the swap time, the build time and the bytes held by both generations at the swap.
+        """
+        t0 = time()
+        self.reload_thread.join()
+        self.reload_thread = None
+        if isinstance(self.reload_result,Exception):
+            raise self.reload_result
+        gen,build_time = self.reload_result
+        self.reload_result = None
+        both_nbytes = dataset_nbytes(self.__dict__) + dataset_nbytes(gen)
+        self.swap(gen)
+        del(gen)
+        return time() - t0,build_time,both_nbytes
+        
+    @timed('dataset/load_pyuvdata')
+    def load_pyuvdata(self,filename,chtypes,fold_factor,psize):
+        import pyuvdata
+        uv = pyuvdata.UVData()
+        uv.read_miriad(filename)
+        self.uv = uv
+        self.antpairs = uv.get_antpairs()
+        self.pols = uv.get_pols()
+        self.dset_size = len(self.antpairs)*len(self.pols)
+        self.chtypes = chtypes
+        self.fold_factor = fold_factor #16
+        self.psize = psize #68
+
+    def iter_pyuvdata(self,chunk_size=32):
+        """
+        Iterates over every baseline and polarization of the loaded UVData, chunk_size
+        waterfalls at a time, so only one chunk is ever held for inference.
+        Yields: [(ant1, ant2, pol), ...], (Chunk, Time, Frequency)
+        """
+        keys = [antpair+(pol,) for antpair in self.antpairs for pol in self.pols]
+        for i in range(0,len(keys),chunk_size):
+            chunk = keys[i:i+chunk_size]
+            yield chunk,np.array([self.uv.get_data(key) for key in chunk])
+
+    def write_flags(self,keys,flags,flag_array,mode='replace'):
+        """
+        Writes unfolded (Chunk, Time, Frequency) flag predictions for the (ant1, ant2, pol)
+        keys into an array shaped like the UVData flag_array, either replacing or OR-ing
+        with what is already there.
+        """
+        import pyuvdata
+        pol_nums = list(self.uv.polarization_array)
+        for key,flag in zip(keys,flags):
+            blts = self.uv.antpair2ind(key[0],key[1])
+            pol_ind = pol_nums.index(pyuvdata.utils.polstr2num(key[2]))
+            if flag_array.ndim == 4:
+                # (Nblts, Nspws, Nfreqs, Npols)
+                inds = (blts,0,slice(None),pol_ind)
+            else:
+                inds = (blts,slice(None),pol_ind)
+            if mode == 'or':
+                flag_array[inds] |= flag
+            else:
+                flag_array[inds] = flag
+        
+    def next_train(self):
+        return self.prepare_train(self.draw_train())
+
+    @timed('dataset/draw_train')
+    def draw_train(self):
+        """
+        Draws the next training batch and the seed of its augmentation, every random draw
+        in the order batches are drawn.
+        """
+        with self.lock:
+            if self.stream:
+                # Move on to a new window once the current one has been seen about once
+                if self.train_served >= self.train_len:
+                    self.fill_window('train')
+                self.train_served += self.batch_size
+            rand_batch = self.train_sampler.sample(self.batch_size)
+            batch_x,batch_targets = self.train_data[rand_batch,:,:,:],self.train_labels[rand_batch,:]
+            augment_seed = self.augmenter.rng.randint(2**31) if self.augment else None
+        return batch_x,batch_targets,augment_seed
+
+    @timed('dataset/prepare_train')
+    def prepare_train(self,drawn):
+        """
+        Augments a batch from draw_train. Batches may be prepared concurrently by several
+        prefetch threads.
+        """
+        batch_x,batch_targets,augment_seed = drawn
+        if augment_seed is not None:
+            # Fresh augmentations for every batch instead of an augmented copy of the dataset
+            augmenter = Augmenter(seed=augment_seed,noise=self.augmenter.noise,blur=self.augmenter.blur,flip=self.augmenter.flip)
+            sh = np.shape(batch_x)
+            batch_x,batch_targets = augmenter(batch_x,batch_targets.reshape(sh[:3]))
+            batch_targets = batch_targets.reshape(sh[0],-1)
+        # Labels are held as uint8 and only expanded for the int32 targets placeholder
+        return batch_x,batch_targets.astype(np.int32)
+
+    def prefetcher(self,depth=4,workers=1):
+        """
+        BatchPrefetcher of training batches, whose pending_state is the sampler state to
+        save with a checkpoint.
+        """
+        return BatchPrefetcher(self.draw_train,depth=depth,workers=workers,prepare=self.prepare_train,
+                               state=self.sampler_state,restore=self.rewind_train)
+
+    def sampler_state(self,train_state=None):
+        """
+        Snapshot of the training and evaluation sampler states, the dataset and augmenter
+        RNG states and the seed as one dict of arrays, taken between batches. Everything but
+        the evaluation sampler can be taken from an earlier snapshot, train_state.
+        """
+        state = {'seed': self.seed}
+        with self.lock:
+            for split,sampler in [('train',self.train_sampler),('eval',self.eval_sampler)]:
+                for key,value in sampler.get_state().items():
+                    state[split+'_'+key] = value
+            for name,rng in [('dataset',self.rng),('augment',self.augmenter.rng),('reload',self.reload_rng)]:
+                for key,value in rng_state(rng).items():
+                    state[name+'_'+key] = value
+        if train_state is not None:
+            state.update([(key,value) for key,value in train_state.items() if not key.startswith('eval_')])
+        return state
+
+    def rewind_train(self,state):
+        """
+        Restores the training sampler and the RNGs the training draws use (dataset and
+        augmenter) from a sampler_state snapshot. The evaluation sampler and reload_rng,
+        drawn from by the training loop itself, are left where they are.
+        """
+        with self.lock:
+            self.train_sampler.set_state(dict([(key[len('train_'):],state[key]) for key in state if key.startswith('train_')]))
+            for name,rng in [('dataset',self.rng),('augment',self.augmenter.rng)]:
+                set_rng_state(rng,dict([(key[len(name)+1:],state[key]) for key in state if key.startswith(name+'_')]))
+
+    def save_samplers(self,filename,state=None):
+        """
+        Saves the sampler states, or a snapshot from sampler_state, to an npz file to sit beside a checkpoint.
+        """
+        if state is None:
+            state = self.sampler_state()
+        np.savez(filename,**state)
+
+    def load_samplers(self,filename):
+        """
+        Restores the states saved by save_samplers, so a resumed run continues the same batches.
+        Load with the saved seed (see saved_seed) for the same split and expansion as well.
+        """
+        f = np.load(filename)
+        for split,sampler in [('train',self.train_sampler),('eval',self.eval_sampler)]:
+            sampler.set_state(dict([(key[len(split)+1:],f[key]) for key in f.files if key.startswith(split+'_')]))
+        for name,rng in [('dataset',self.rng),('augment',self.augmenter.rng),('reload',self.reload_rng)]:
+            if name+'_rng_keys' in f.files:
+                set_rng_state(rng,dict([(key[len(name)+1:],f[key]) for key in f.files if key.startswith(name+'_')]))
+        f.close()
+
+    def change_batch_size(self,new_bs):
+        self.batch_size = new_bs
+    
+    @timed('dataset/next_eval')
+    def next_eval(self):
+        with self.lock:
+            if self.stream:
+                if self.eval_served >= self.eval_len:
+                    self.fill_window('eval')
+                self.eval_served += self.batch_size
+            rand_batch = self.eval_sampler.sample(self.batch_size)
+            batch_x,batch_targets = self.eval_data[rand_batch,:,:,:],self.eval_labels[rand_batch,:]
+        return batch_x,batch_targets.astype(np.int32)
+
+    def iter_predict(self,batch_size=16):
+        """
+        Iterates in order over the whole prediction dataset, folding batch_size waterfalls
+        together for a single forward pass.
+        Yields: (Batch, Time, Frequency) waterfalls, (Batch*FoldFactor, Time, Reduced Frequency, Channels),
+                (Batch*FoldFactor, Time, Reduced Frequency) labels
+        """
+        if self.chtypes == 'AmpPhs':
+            nch = 2
+        elif self.chtypes == 'Amp':
+            nch = 1
+        for i in range(0,len(self.data_real),batch_size):
+            data = np.asarray(self.data_real[i:i+batch_size])
+            labels = np.asarray(self.labels_real[i:i+batch_size])
+            yield data,fold_batch(data,self.fold_factor,self.psize,dtype=np.float32,nch=nch),foldl_batch(labels,self.fold_factor,self.psize)
+
+    def random_test(self,samples):
+        ind = np.sort(self.rng.choice(np.shape(self.eval_data)[0],size=samples,replace=False))
+        if self.chtypes == 'Amp':
+            ch = 1
+        elif self.chtypes == 'AmpPhs':
+            ch = 2
+        elif self.chtypes == 'AmpPhs2':
+            ch = 3
+        return self.eval_data[ind,:,:,:].reshape(samples,self.psize,self.psize,ch),self.eval_labels[ind,:].reshape(samples,self.psize*self.psize).astype(np.int32)
+
+    def get_size(self):
+        # Return dataset size
+        return self.dset_size
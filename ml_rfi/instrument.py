@@ -0,0 +1,193 @@
+import numpy as np
+import threading
+import json
+import sys
+import functools
+from time import time
+from contextlib import contextmanager
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Histogram bucket upper edges in seconds, 10 per decade from 1 us to 1000 s
+bucket_limits = list(10**np.arange(-6.,3.05,0.1))
+
+def peak_rss():
+    """
+    Peak resident set size of this process so far in bytes, 0 where it is not available.
+    """
+    if resource is None:
+        return 0
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    if sys.platform == 'darwin':
+        return rss
+    return rss*1024
+
+class StageStats():
+    def __init__(self,state=None):
+        """
+        Wall time histogram, call count and memory of one named stage. rss_growth is the most
+        a single call raised the process's peak RSS, the stage's own footprint beyond what ran
+        before it. process_peak_rss is the process's peak RSS seen at the end of a call, which
+        includes everything else the process has held.
+        """
+        self.count = 0
+        self.total = 0.
+        self.sum_squares = 0.
+        self.min = np.inf
+        self.max = 0.
+        self.buckets = np.zeros(len(bucket_limits)+1,dtype=np.int64)
+        self.process_peak_rss = 0
+        self.rss_growth = 0
+        if state is not None:
+            self.merge(state)
+
+    def add(self,seconds,rss_before,rss_after):
+        self.count += 1
+        self.total += seconds
+        self.sum_squares += seconds**2
+        self.min = min(self.min,seconds)
+        self.max = max(self.max,seconds)
+        self.buckets[np.searchsorted(bucket_limits,seconds)] += 1
+        self.process_peak_rss = max(self.process_peak_rss,rss_after)
+        self.rss_growth = max(self.rss_growth,rss_after - rss_before)
+
+    def merge(self,state):
+        """
+        Adds in the stats of another StageStats, e.g. from a worker process, given as state().
+        """
+        self.count += state['count']
+        self.total += state['total']
+        self.sum_squares += state['sum_squares']
+        if state['count'] > 0:
+            self.min = min(self.min,state['min'])
+        self.max = max(self.max,state['max'])
+        self.buckets += np.asarray(state['buckets'],dtype=np.int64)
+        self.process_peak_rss = max(self.process_peak_rss,state['process_peak_rss'])
+        self.rss_growth = max(self.rss_growth,state['rss_growth'])
+
+    def percentile(self,q):
+        """
+        Upper bucket edge below which a fraction q of the calls fell.
+        """
+        if self.count == 0:
+            return 0.
+        i = np.searchsorted(np.cumsum(self.buckets),q*self.count)
+        return min(self.max,(bucket_limits+[self.max])[i])
+
+    def state(self):
+        return {'count': self.count,
+                'total': self.total,
+                'sum_squares': self.sum_squares,
+                'min': self.min if self.count > 0 else 0.,
+                'max': self.max,
+                'mean': self.total/self.count if self.count > 0 else 0.,
+                'p50': self.percentile(0.5),
+                'p90': self.percentile(0.9),
+                'p99': self.percentile(0.99),
+                'buckets': self.buckets.tolist(),
+                'process_peak_rss': self.process_peak_rss,
+                'rss_growth': self.rss_growth}
+
+class Instrumentation():
+    def __init__(self):
+        """
+        Registry of named stages timed with stage() or timed(). Safe to record into from
+        several threads; worker processes keep their own and send state() to be merged.
+        """
+        self.lock = threading.Lock()
+        self.stages = {}
+
+    def add(self,name,seconds,rss_before=0,rss_after=0):
+        with self.lock:
+            if name not in self.stages:
+                self.stages[name] = StageStats()
+            self.stages[name].add(seconds,rss_before,rss_after)
+
+    @contextmanager
+    def stage(self,name):
+        """
+        Times the enclosed block as a call of stage name.
+        """
+        rss = peak_rss()
+        t0 = time()
+        try:
+            yield
+        finally:
+            self.add(name,time() - t0,rss,peak_rss())
+
+    def timed(self,name):
+        """
+        Decorator timing every call of a function as stage name.
+        """
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args,**kwargs):
+                rss = peak_rss()
+                t0 = time()
+                try:
+                    return func(*args,**kwargs)
+                finally:
+                    self.add(name,time() - t0,rss,peak_rss())
+            return wrapper
+        return decorator
+
+    def get(self,name):
+        """
+        StageStats of a stage, empty if it has not run.
+        """
+        with self.lock:
+            return self.stages.get(name,StageStats())
+
+    def state(self,reset=False):
+        """
+        Plain dict of every stage's stats, optionally starting over afterwards.
+        """
+        with self.lock:
+            state = dict([(name,stats.state()) for name,stats in self.stages.items()])
+            if reset:
+                self.stages = {}
+        return state
+
+    def merge(self,state):
+        with self.lock:
+            for name in state:
+                if name not in self.stages:
+                    self.stages[name] = StageStats()
+                self.stages[name].merge(state[name])
+
+    def summary(self):
+        """
+        Table of the stages by total time.
+        """
+        lines = ['{0:32s} {1:>8s} {2:>10s} {3:>10s} {4:>10s} {5:>10s} {6:>10s}'.format('stage','calls','total s','mean ms','p90 ms','max ms','growth MB')]
+        for name,s in sorted(self.state().items(),key=lambda item: -item[1]['total']):
+            lines.append('{0:32s} {1:8d} {2:10.2f} {3:10.3f} {4:10.3f} {5:10.3f} {6:10.1f}'.format(
+                name,s['count'],s['total'],1e3*s['mean'],1e3*s['p90'],1e3*s['max'],s['rss_growth']/1e6))
+        return '\n'.join(lines)
+
+    def save(self,filename):
+        with open(filename,'w') as f:
+            json.dump({'bucket_limits': bucket_limits,'stages': self.state()},f,indent=1,sort_keys=True)
+
+    def add_summaries(self,writer,step,prefix='stages/'):
+        """
+        Writes every stage's wall time histogram, mean, calls and RSS growth to a tf.summary.FileWriter.
+        """
+        import tensorflow as tf
+        values = []
+        for name,s in self.state().items():
+            histo = tf.HistogramProto(min=s['min'],max=s['max'],num=s['count'],sum=s['total'],sum_squares=s['sum_squares'],
+                                      bucket_limit=bucket_limits+[sys.float_info.max],bucket=s['buckets'])
+            values.extend([tf.Summary.Value(tag=prefix+name+'/seconds',histo=histo),
+                           tf.Summary.Value(tag=prefix+name+'/mean_ms',simple_value=1e3*s['mean']),
+                           tf.Summary.Value(tag=prefix+name+'/calls',simple_value=s['count']),
+                           tf.Summary.Value(tag=prefix+name+'/rss_growth_mb',simple_value=s['rss_growth']/1e6)])
+        writer.add_summary(tf.Summary(value=values),step)
+
+# Shared by ml_rfi and the scripts
+instruments = Instrumentation()
+stage = instruments.stage
+timed = instruments.timed
@@ -0,0 +1,461 @@
+import numpy as np
+import tensorflow as tf
+import json
+import os
+import multiprocessing
+
+def tfnormalize(X):
+    """
+    Skip connection layer normalization.
+    """
+    sh = np.shape(X)
+    X_norm = tf.contrib.layers.layer_norm(X,trainable=False)
+    return X
+
+def stacked_layer(input_layer,num_filter_layers,kt,kf,activation,stride,pool,bnorm=True,name='None',dropout=None,maxpool=True,mode=True):
+    """
+    Creates a 3x stacked layer of convolutional layers. Each layer uses the same kernel size.
+    Batch normalized output is default and recommended for faster convergence, although
+    not every may require it (???).
+    Its ops are grouped under the name scope name (default stacked_layer, made unique), which
+    leaves variable names and so checkpoints unchanged.
+    Input: Tensor Variable (Batch*FoldFactor, Time, Reduced Frequency, Input Filter Layers)
+    Output: Tensor Variable (Batch*FoldFactor, Time/2, Reduced Frequency/2, num_filter_layers)
+    """
+    with tf.name_scope(None if name == 'None' else name,'stacked_layer'):
+        return _stacked_layer(input_layer,num_filter_layers,kt,kf,activation,stride,pool,bnorm,dropout,maxpool,mode)
+
+def _stacked_layer(input_layer,num_filter_layers,kt,kf,activation,stride,pool,bnorm,dropout,maxpool,mode):
+    conva = tf.layers.conv2d(inputs=input_layer,
+                             filters=num_filter_layers,
+                             kernel_size=[kt,kt],
+                             strides=[1,1],
+                             padding="same",
+                             activation=activation)
+    if kt - 2<0:
+        kt = 3
+    if dropout is not None:
+        convb = tf.layers.dropout(tf.layers.conv2d(inputs=conva,
+                             filters=num_filter_layers,
+                             kernel_size=[kt-2,kt-2],
+                             strides=[1,1],
+                             padding="same",
+                                                   activation=activation), rate=dropout)                         
+    else:
+        convb = tf.layers.conv2d(inputs=conva,
+                             filters=num_filter_layers,
+                             kernel_size=[kt-2,kt-2],
+                             strides=[1,1],
+                             padding="same",
+                                                   activation=activation)
+    shb = convb.get_shape().as_list()
+
+    convc = tf.layers.conv2d(inputs=convb,
+                             filters=num_filter_layers,
+                             kernel_size=(1,1),
+                             padding="same",
+                             activation=activation)
+    if bnorm:
+    	#bnorm_conv = tf.contrib.layers.batch_norm(convc,scale=True,center=True)
+        bnorm_conv = tf.layers.batch_normalization(convc,scale=True,center=True,training=mode,fused=True)
+    else:
+    	bnorm_conv = convc
+    if maxpool:
+        pool = tf.layers.max_pooling2d(inputs=bnorm_conv,
+                                    pool_size=pool,
+                                       strides=stride)
+    elif maxpool==None:
+        pool = bnorm_conv
+    else:
+        pool = tf.layers.average_pooling2d(inputs=bnorm_conv,
+                                           pool_size=pool,
+                                           strides=stride)
+        
+    return pool
+
+def fold_batch_norms(graph_def,output_nodes):
+    """
+    Folds the inference mode FusedBatchNorm nodes of a frozen GraphDef into constants.
+    The batch norms in stacked_layer follow the activation rather than the convolution,
+    so each becomes a per-channel multiply and add with precomputed scale and offset.
+    Nodes no longer reachable from output_nodes are dropped.
+    Output: GraphDef, number of folded batch norms
+    """
+    nodes = dict([(node.name,node) for node in graph_def.node])
+    def const(name):
+        node = nodes[name.split(':')[0]]
+        while node.op == 'Identity':
+            node = nodes[node.input[0].split(':')[0]]
+        return tf.make_ndarray(node.attr['value'].tensor)
+    out = tf.GraphDef()
+    out.versions.CopyFrom(graph_def.versions)
+    nfolded = 0
+    for node in graph_def.node:
+        if node.op not in ['FusedBatchNorm','FusedBatchNormV2','FusedBatchNormV3'] \
+           or node.attr['is_training'].b or node.attr['data_format'].s not in [b'',b'NHWC']:
+            out.node.extend([node])
+            continue
+        x,gamma,beta,mean,var = node.input[:5]
+        scale = const(gamma)/np.sqrt(const(var)+node.attr['epsilon'].f)
+        offset = const(beta) - const(mean)*scale
+        dtype = node.attr['T']
+        for name,value in [('scale',scale),('offset',offset)]:
+            c = out.node.add()
+            c.op = 'Const'
+            c.name = node.name+'/folded_'+name
+            c.attr['dtype'].CopyFrom(dtype)
+            c.attr['value'].tensor.CopyFrom(tf.make_tensor_proto(value.astype(tf.as_dtype(dtype.type).as_numpy_dtype)))
+        mul = out.node.add()
+        mul.op = 'Mul'
+        mul.name = node.name+'/folded_mul'
+        mul.input.extend([x,node.name+'/folded_scale'])
+        mul.attr['T'].CopyFrom(dtype)
+        # Keeps the batch norm's name so its consumers are rewired for free
+        add = out.node.add()
+        add.op = 'Add'
+        add.name = node.name
+        add.input.extend([mul.name,node.name+'/folded_offset'])
+        add.attr['T'].CopyFrom(dtype)
+        nfolded += 1
+    return tf.graph_util.extract_sub_graph(out,output_nodes),nfolded
+
+def load_frozen_model(filename,config=None):
+    """
+    Starts an inference session directly from a frozen model written by exportDFCN.py,
+    with no graph building, variable initialization or checkpoint restore.
+    Output: session, vis_input placeholder, RFI_guess logits
+    """
+    graph_def = tf.GraphDef()
+    with tf.gfile.GFile(filename,'rb') as f:
+        graph_def.ParseFromString(f.read())
+    graph = tf.Graph()
+    with graph.as_default():
+        tf.import_graph_def(graph_def,name='')
+    sess = tf.Session(graph=graph,config=config)
+    return sess,graph.get_tensor_by_name('vis_input:0'),graph.get_tensor_by_name('RFI_guess:0')
+
+def load_profile(filename=None,**defaults):
+    """
+    Execution profile for a script's sessions: device ('cpu' or 'gpu'), gpu index, number of
+    worker processes (nworkers), intra_op_threads and inter_op_threads per session (0 lets
+    TensorFlow choose) and max_tiles per sess.run. Profiles from tuneDFCN.py also name the
+    model_kind they were tuned for. Starts from the built in defaults, then the script's
+    defaults, then the profile saved in filename by tuneDFCN.py if it exists.
+    """
+    profile = {'device': 'cpu','gpu': 0,'nworkers': 1,'intra_op_threads': 0,'inter_op_threads': 1,'max_tiles': 16}
+    profile.update(defaults)
+    if filename and os.path.exists(filename):
+        with open(filename) as f:
+            profile.update(json.load(f)['profile'])
+    return profile
+
+def session_config(profile):
+    """
+    Session configuration for an execution profile. Call before the first session is created.
+    CPU profiles hide the GPUs and size the thread pools, GPU profiles pick the visible GPU
+    and let its memory grow.
+    """
+    if profile['device'] == 'gpu':
+        os.environ['CUDA_VISIBLE_DEVICES'] = str(profile['gpu'])
+        config = tf.ConfigProto()
+        config.gpu_options.allow_growth = True
+        return config
+    os.environ['CUDA_VISIBLE_DEVICES'] = ''
+    if profile['intra_op_threads'] > 0:
+        # MKL builds size their OpenMP pool from this rather than the session config
+        os.environ['OMP_NUM_THREADS'] = str(profile['intra_op_threads'])
+    return tf.ConfigProto(intra_op_parallelism_threads=profile['intra_op_threads'],
+                          inter_op_parallelism_threads=profile['inter_op_threads'],
+                          device_count={'GPU': 0})
+
+def quantize_frozen_model(filename,calibration,batch_size,mode='int8'):
+    """
+    Post-training quantization of a frozen model from exportDFCN.py with the TensorFlow Lite
+    converter. In 'int8' mode weights are quantized and activation ranges are calibrated by
+    running batches of folded patches through the model; ops without an int8 kernel stay in
+    float. 'float16' only halves the weights. The model keeps float input and logits, and is
+    converted for a fixed batch_size of patches.
+    Input: (N, Time, Reduced Frequency, Channels) calibration patches
+    Output: serialized TensorFlow Lite model
+    """
+    calibration = np.asarray(calibration,dtype=np.float32)
+    input_shape = [batch_size]+list(np.shape(calibration)[1:])
+    converter = tf.lite.TFLiteConverter.from_frozen_graph(filename,['vis_input'],['RFI_guess'],
+                                                          input_shapes={'vis_input': input_shape})
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if mode == 'int8':
+        def representative_dataset():
+            # Calibration batches wrap around the sample to the converted batch size
+            for i in range(0,len(calibration),batch_size):
+                inds = np.arange(i,i+batch_size) % len(calibration)
+                yield [calibration[inds]]
+        converter.representative_dataset = tf.lite.RepresentativeDataset(representative_dataset)
+    elif mode == 'float16':
+        converter.target_spec.supported_types = [tf.float16]
+    else:
+        raise ValueError('Quantization mode %s is not supported, use int8 or float16' % mode)
+    return converter.convert()
+
+class QuantizedModel():
+    def __init__(self,filename,num_threads=None):
+        """
+        Inference on a TensorFlow Lite model from quantize_frozen_model. Called like
+        sess.run(RFI_guess) on a batch of folded patches, which is split into or zero
+        padded to the batch size the model was converted for.
+        """
+        try:
+            self.interpreter = tf.lite.Interpreter(model_path=filename,num_threads=num_threads)
+        except TypeError:
+            # Older interpreters take no thread count and run single threaded
+            self.interpreter = tf.lite.Interpreter(model_path=filename)
+        self.interpreter.allocate_tensors()
+        self.input_index = self.interpreter.get_input_details()[0]['index']
+        self.output_index = self.interpreter.get_output_details()[0]['index']
+        self.batch_size = self.interpreter.get_input_details()[0]['shape'][0]
+
+    def __call__(self,batch_x):
+        """
+        Input: (Batch*FoldFactor, Time, Reduced Frequency, Channels)
+        Output: (Batch*FoldFactor, Time*Reduced Frequency, Classes) logits
+        """
+        batch_x = np.asarray(batch_x,dtype=np.float32)
+        out = []
+        for i in range(0,len(batch_x),self.batch_size):
+            chunk = batch_x[i:i+self.batch_size]
+            n = len(chunk)
+            if n < self.batch_size:
+                chunk = np.concatenate([chunk,np.zeros((self.batch_size-n,)+chunk.shape[1:],dtype=np.float32)])
+            self.interpreter.set_tensor(self.input_index,chunk)
+            self.interpreter.invoke()
+            out.append(np.copy(self.interpreter.get_tensor(self.output_index)[:n]))
+        return np.concatenate(out)
+
+def tf_unfoldl(data_fold,ch_fold=16,padding=2):
+    """
+    TensorFlow version of unfoldl_batch, so unfolding can be fetched in the same sess.run
+    as the model. Any trailing axes (e.g. logits) are carried through.
+    Input: Tensor (Batch*FoldFactor, Time, Reduced Frequency, ...)
+    Output: Tensor (Batch, Time, Frequency, ...)
+    """
+    ndims = data_fold.get_shape().ndims
+    sh = tf.shape(data_fold)
+    data_unpad = data_fold[:,padding+2:sh[1]-padding-2,padding:sh[2]-padding]
+    ush = tf.shape(data_unpad)
+    rest = ush[3:]
+    _data = tf.reshape(data_unpad,tf.concat([[sh[0]//ch_fold,ch_fold,ush[1],ush[2]],rest],0))
+    _data = tf.transpose(_data,[0,2,1,3]+list(range(4,ndims+1)))
+    return tf.reshape(_data,tf.concat([[sh[0]//ch_fold,ush[1],ch_fold*ush[2]],rest],0))
+
+def prediction_ops(RFI_guess,vis_input,fold_factor=16,padding=2):
+    """
+    Builds the prediction post-processing once as graph ops, fetched together with
+    RFI_guess instead of adding new ops for every waterfall.
+    Output: dict of unfolded 'logits' (Batch, Time, Frequency, Classes), argmax 'flags' and
+            RFI minus no-RFI 'logit_diff' (Batch, Time, Frequency)
+    """
+    sh = tf.shape(vis_input)
+    # The networks flatten their logits to (Batch*FoldFactor, Time*Reduced Frequency, Classes)
+    logits = tf_unfoldl(tf.reshape(RFI_guess,[sh[0],sh[1],sh[2],-1]),fold_factor,padding)
+    return {'logits': logits,
+            'flags': tf.argmax(logits,axis=-1),
+            'logit_diff': logits[:,:,:,1] - logits[:,:,:,0]}
+
+def tower_devices(cluster_hosts):
+    """
+    Devices of the data-parallel towers, the CPU of each task of a 'worker' cluster job.
+    """
+    return ['/job:worker/task:%i/cpu:0' % k for k in range(len(cluster_hosts))]
+
+def serve_tower(cluster_hosts,task_index,config):
+    """
+    Worker task of a data-parallel cluster, serving its tower's ops to task 0 until stopped.
+    """
+    server = tf.train.Server(tf.train.ClusterSpec({'worker': cluster_hosts}),job_name='worker',task_index=task_index,config=config)
+    server.join()
+
+def local_cluster(ntowers,config,port=2222):
+    """
+    Data-parallel cluster of one process per tower on this node. CPU devices of one TF1
+    process share its thread pools, so towers need processes of their own to run in
+    parallel. The intra-op threads (all cores if 0) are split between the towers. Starts
+    the worker tasks 1..ntowers-1 on localhost ports from port on, which stop with this process.
+    Output: cluster hosts, session config of every task (task 0 included), worker processes
+    """
+    nthreads = config.intra_op_parallelism_threads or multiprocessing.cpu_count()
+    tower_config = tf.ConfigProto()
+    tower_config.CopyFrom(config)
+    tower_config.intra_op_parallelism_threads = max(1,nthreads//ntowers)
+    os.environ['OMP_NUM_THREADS'] = str(tower_config.intra_op_parallelism_threads)
+    cluster_hosts = ['localhost:%i' % (port+k) for k in range(ntowers)]
+    procs = [multiprocessing.Process(target=serve_tower,args=(cluster_hosts,k,tower_config)) for k in range(1,ntowers)]
+    for proc in procs:
+        proc.daemon = True
+        proc.start()
+    return cluster_hosts,tower_config,procs
+
+def average_gradients(tower_grads):
+    """
+    Averages each variable's gradient over the towers, the synchronization point of
+    data-parallel training.
+    Input: list over towers of [(gradient, variable), ...]
+    Output: [(gradient, variable), ...]
+    """
+    average = []
+    for grads_and_vars in zip(*tower_grads):
+        grads = [g for g,v in grads_and_vars if g is not None]
+        if len(grads) == 0:
+            average.append((None,grads_and_vars[0][1]))
+        else:
+            average.append((tf.add_n(grads)/len(grads),grads_and_vars[0][1]))
+    return average
+
+def data_parallel_model(model,vis_input,targets,optimizer,devices,scope='FCN',**kwargs):
+    """
+    Builds model once per device, all sharing the variables of the first tower. The batch
+    is split into len(devices) contiguous blocks, tower k training on block k, which is
+    shard k of the training indices for batches from a sharded EpochSampler. The tower
+    gradients are averaged before the optimizer applies them, so every step is synchronous
+    and the variables, and so the checkpoints, are those of the single model. Each tower's
+    batch norm moving statistics updates run before the step is applied. The batch needs
+    at least one patch per tower.
+    Output: logits of all the towers in batch order, train op
+    """
+    ntowers = len(devices)
+    batch_inds = tf.range(tf.shape(vis_input)[0])
+    shards = batch_inds*ntowers//tf.shape(vis_input)[0]
+    inputs = tf.dynamic_partition(vis_input,shards,ntowers)
+    labels = tf.dynamic_partition(targets,shards,ntowers)
+    logits = []
+    tower_grads = []
+    update_ops = []
+    for k,device in enumerate(devices):
+        with tf.device(device), tf.name_scope('tower_%i' % k) as tower_scope:
+            guess = model(inputs[k],reuse=True if k > 0 else None,**kwargs)
+            loss = tf.losses.sparse_softmax_cross_entropy(labels=labels[k],logits=guess,loss_collection=None)
+            var_list = tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES,scope=scope)
+            tower_grads.append(optimizer.compute_gradients(loss,var_list=var_list))
+            update_ops.extend(tf.get_collection(tf.GraphKeys.UPDATE_OPS,scope=tower_scope))
+            logits.append(guess)
+    with tf.device(devices[0]), tf.control_dependencies(update_ops):
+        train_op = optimizer.apply_gradients(average_gradients(tower_grads))
+        return tf.concat(logits,axis=0),train_op
+
+def profiled_layer(node_name):
+    """
+    Layer an op belongs to for LayerProfiler: the scope directly under the model's FCN
+    scope (e.g. amp_layer3, conv2d_transpose_1, concat_2), or the top scope for ops
+    outside the model, over all the towers. Gradient ops are attributed to their layer's
+    backward pass.
+    """
+    parts = node_name.split('/')
+    backward = False
+    # The towers of data-parallel training add up to the one model
+    while len(parts) > 1 and (parts[0] == 'gradients' or parts[0].startswith('tower_')):
+        backward = backward or parts[0] == 'gradients'
+        parts = parts[1:]
+    if parts[0] == 'FCN' and len(parts) > 1:
+        layer = parts[1]
+    else:
+        layer = parts[0]
+    if backward:
+        return layer+' (backward)'
+    return layer
+
+class LayerProfiler():
+    def __init__(self,steps,out_dir,graph=None,prefix=''):
+        """
+        Traces the sess.run calls of the given steps with RunMetadata. Each traced step is
+        written as a Chrome trace (chrome://tracing) to out_dir, and compute time and output
+        memory are added up per op type and per layer (see profiled_layer). The summary table
+        is rewritten to out_dir after every traced step. With no steps nothing is traced, and
+        sess.run gets no extra arguments.
+        """
+        self.steps = set(steps)
+        self.out_dir = out_dir
+        self.prefix = prefix
+        self.no_trace = {}
+        self.op_types = {}
+        if graph is not None:
+            self.op_types = dict([(op.name,op.type) for op in graph.get_operations()])
+        self.nsteps = 0
+        self.ops = {}     # op type: [microseconds, calls, output bytes]
+        self.layers = {}  # layer: [microseconds, ops, output bytes]
+        self.peak_bytes = 0
+        if len(self.steps) > 0 and not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+
+    def options(self,step):
+        """
+        Keyword arguments for the sess.run of step, empty unless it is traced.
+        """
+        if step not in self.steps:
+            return self.no_trace
+        return {'options': tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE),
+                'run_metadata': tf.RunMetadata()}
+
+    def collect(self,step,run_kwargs):
+        """
+        Adds the trace of a step run with options(step) to the totals.
+        """
+        if 'run_metadata' not in run_kwargs:
+            return
+        from tensorflow.python.client import timeline
+        step_stats = run_kwargs['run_metadata'].step_stats
+        with open(os.path.join(self.out_dir,'%stimeline_step_%i.json' % (self.prefix,step)),'w') as f:
+            f.write(timeline.Timeline(step_stats).generate_chrome_trace_format(show_memory=True))
+        devices = [dev for dev in step_stats.dev_stats if '/stream:' not in dev.device or dev.device.endswith('/stream:all')]
+        if any([dev.device.endswith('/stream:all') for dev in devices]):
+            # GPU kernel times are in stream:all, the GPU device itself only records their launches
+            devices = [dev for dev in devices if 'GPU' not in dev.device or dev.device.endswith('/stream:all')]
+        for dev in devices:
+            for node in dev.node_stats:
+                name = node.node_name.split(':')[0]
+                if name in ['_SOURCE','_SINK']:
+                    continue
+                micros = node.op_end_rel_micros - node.op_start_rel_micros
+                nbytes = sum([out.tensor_description.allocation_description.allocated_bytes for out in node.output])
+                for mem in node.memory:
+                    self.peak_bytes = max(self.peak_bytes,mem.peak_bytes)
+                op_type = self.op_types.get(name)
+                if op_type is None:
+                    # Ops not in the graph given, e.g. frozen models, take the type from the timeline label
+                    label = node.timeline_label
+                    op_type = label.split(' = ')[1].split('(')[0] if ' = ' in label else 'unknown'
+                for totals,key in [(self.ops,op_type),(self.layers,profiled_layer(name))]:
+                    if key not in totals:
+                        totals[key] = [0,0,0]
+                    totals[key][0] += micros
+                    totals[key][1] += 1
+                    totals[key][2] += nbytes
+        self.nsteps += 1
+        self.write()
+
+    def summary(self,top=25):
+        """
+        Table of the top layers and op types by compute time, averaged over the traced steps.
+        """
+        n = float(max(1,self.nsteps))
+        lines = ['Profile over {0} traced steps, peak allocator memory {1:.1f} MB'.format(self.nsteps,self.peak_bytes/1e6)]
+        for title,totals in [('layer',self.layers),('op type',self.ops)]:
+            total = max(1,sum([t[0] for t in totals.values()]))
+            lines.append('{0:40s} {1:>10s} {2:>7s} {3:>8s} {4:>12s}'.format(title,'ms/step','%','ops/step','MB out/step'))
+            for key in sorted(totals,key=lambda k: -totals[k][0])[:top]:
+                micros,count,nbytes = totals[key]
+                lines.append('{0:40s} {1:10.3f} {2:7.2f} {3:8.1f} {4:12.2f}'.format(key,micros/1e3/n,100.*micros/total,
+                                                                             count/n,nbytes/1e6/n))
+        return '\n'.join(lines)
+
+    def write(self):
+        """
+        Writes the summary table and the per step averages as JSON to out_dir.
+        """
+        with open(os.path.join(self.out_dir,self.prefix+'profile_summary.txt'),'w') as f:
+            f.write(self.summary(top=None)+'\n')
+        with open(os.path.join(self.out_dir,self.prefix+'profile_summary.json'),'w') as f:
+            n = float(max(1,self.nsteps))
+            json.dump({'steps': self.nsteps,
+                       'peak_bytes': self.peak_bytes,
+                       'layers': dict([(k,{'ms': v[0]/1e3/n,'ops': v[1]/n,'output_bytes': v[2]/n})
+                                       for k,v in self.layers.items()]),
+                       'op_types': dict([(k,{'ms': v[0]/1e3/n,'calls': v[1]/n,'output_bytes': v[2]/n})
+                                         for k,v in self.ops.items()])},f,indent=1,sort_keys=True)
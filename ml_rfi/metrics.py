@@ -0,0 +1,176 @@
+import numpy as np
+
+def batch_accuracy(labels,predictions):
+    """
+    Returns the RFI class accuracy.
+    """
+    import tensorflow as tf
+    labels = tf.cast(labels,dtype=tf.int64)
+    predictions = tf.cast(predictions,dtype=tf.int64)
+    correct = tf.reduce_sum(tf.cast(tf.equal(tf.add(labels,predictions),2),dtype=tf.int64))
+    total = tf.reduce_sum(labels)
+    return tf.divide(correct,total)
+
+def accuracy(labels,predictions):
+    """
+    Numpy version of RFI class accuracy.
+    """
+    correct = 1.*np.sum((labels+predictions)==2)
+    total = 1.*np.sum(labels==1)
+    print('correct',correct)
+    print('total',total)
+    try:
+        return correct/total
+    except:
+        return 1.
+
+def MCC(tp,tn,fp,fn):
+    """
+    Calculates the Mathews Correlation Coefficient.
+    """
+    if tp==0 and fn ==0:
+        return (tp*tn - fp*fn)
+    else:
+        return (tp*tn - fp*fn)/np.sqrt((1.*(tp+fp)*(tp+fn)*(tn+fp)*(tn+fn)))
+
+def f1(tp,tn,fp,fn):
+    """
+    Calculates the F1 Score.
+    """
+    precision = tp/(1.*(tp+fp))
+    recall = tp/(1.*(tp+fn))
+    return 2.*precision*recall/(precision+recall)
+
+def f2(tp,tn,fp,fn):
+    """
+    Calculates the F2 Score, weighting recall above precision.
+    """
+    precision = tp/(1.*(tp+fp))
+    recall = tp/(1.*(tp+fn))
+    return 5.*precision*recall/(4.*precision+recall)
+
+def accuracy_drop(baseline,candidate,max_f2_drop=0.01,max_mcc_drop=0.01):
+    """
+    Regression check of a candidate model (e.g. quantized) against a baseline, from the
+    (tp, tn, fp, fn) confusion counts of each pooled over the same samples.
+    Output: F2 drop, MCC drop, True if either drop is above its maximum
+    """
+    f2_drop = f2(*baseline) - f2(*candidate)
+    mcc_drop = MCC(*baseline) - MCC(*candidate)
+    return f2_drop,mcc_drop,bool(f2_drop > max_f2_drop or mcc_drop > max_mcc_drop)
+
+def SNRvsTPR(data,true_flags,flags,SNR=np.linspace(0.,4.,30)):
+    """
+    Calculates the signal-to-noise ratio versus true positive rate (recall).
+    Flagged samples are sorted by amplitude once, so each SNR cut only moves a pointer
+    along them and updates the noise level and confusion counts from running sums.
+    """
+    data = np.asarray(data,dtype=np.float64).reshape(-1)
+    truth = np.asarray(true_flags).astype(bool).reshape(-1)
+    pred = np.asarray(flags).astype(bool).reshape(-1)
+    noise = np.where(truth,0.,data)
+    s1,s2 = np.sum(noise),np.sum(noise**2)
+    # Samples with data*flags == 0 have an SNR map of -inf and fall under every cut
+    base = (data*pred) == 0
+    b_tp,b_fp = np.sum(base & truth & pred),np.sum(base & ~truth & pred)
+    b_fn,b_tn = np.sum(base & truth & ~pred),np.sum(base & ~truth & ~pred)
+    b_s1,b_s2,b_nz = np.sum(noise[base]),np.sum(noise[base]**2),np.sum(noise[base] != 0)
+    cand = np.where(pred & (data > 0))[0]
+    order = np.argsort(data[cand])
+    d_sorted = data[cand][order]
+    t_sorted = truth[cand][order]
+    cum_tp = np.concatenate([[0],np.cumsum(t_sorted)])
+    cum_fp = np.concatenate([[0],np.cumsum(~t_sorted)])
+    n_sorted = np.where(t_sorted,0.,d_sorted)
+    cum_s1 = np.concatenate([[0.],np.cumsum(n_sorted)])
+    cum_s2 = np.concatenate([[0.],np.cumsum(n_sorted**2)])
+    cum_nz = np.concatenate([[0],np.cumsum(n_sorted != 0)])
+    nz = np.sum(noise != 0)
+    snr_tprs = []
+    m = 0
+    for k,snr_ in enumerate(SNR):
+        # Samples under earlier cuts have been zeroed out of the noise estimate
+        z1,z2,znz = cum_s1[m],cum_s2[m],cum_nz[m]
+        if k > 0:
+            z1,z2,znz = z1 + b_s1,z2 + b_s2,znz + b_nz
+        if znz == nz:
+            # No noise left, so the SNR map is nan everywhere and nothing is under the cut
+            snr_tprs.append(np.nan)
+            continue
+        std = np.sqrt(max((s2 - z2)/data.size - ((s1 - z1)/data.size)**2,0.))
+        m = max(m,np.searchsorted(d_sorted,std*10**snr_,side='left'))
+        tp,fp,fn,tn = b_tp + cum_tp[m],b_fp + cum_fp[m],b_fn,b_tn
+        if tp + fp + fn + tn == 0:
+            snr_tprs.append(np.nan)
+            continue
+        if tp + fp + fn == 0 or fp + fn + tn == 0:
+            # A single class under the cut, as a 1x1 confusion matrix
+            tn = tp + fp + fn + tn
+            tp = 1e-10
+            fp = 1e-10
+            fn = 1e-10
+        snr_tprs.append(MCC(tp,tn,fp,fn))
+    return snr_tprs
+
+def hard_thresh(layer,thresh=0.5):
+    """
+    Thresholding function for predicting based on raw FCN output.
+    """
+    layer_sigmoid = 1./(1. + np.exp(-layer))
+    return np.where(layer_sigmoid > thresh, np.ones_like(layer),np.zeros_like(layer))
+
+def softmax(X):
+    return np.exp(X)/np.sum(np.exp(X),axis=-1)
+
+class ROCAccumulator():
+    def __init__(self,thresholds=np.linspace(-1,4.,30)):
+        """
+        Incrementally accumulated ROC statistics over any number of waterfalls. Each update
+        bins the sigmoid scores against the thresholds in one pass and reads out in O(T),
+        instead of a confusion matrix per threshold. The binning is a binary search, so
+        O(N log T), but with a few tens of thresholds it measures faster than computing
+        bins arithmetically from evenly spaced thresholds. Results are returned in the
+        order the thresholds were given.
+        """
+        self.thresholds = np.asarray(thresholds,dtype=np.float64)
+        self.order = np.argsort(self.thresholds,kind='mergesort')
+        self.sorted = self.thresholds[self.order]
+        # Scores in bin k are above the first k sorted thresholds
+        self.pos = np.zeros(len(self.thresholds)+1,dtype=np.int64)
+        self.neg = np.zeros(len(self.thresholds)+1,dtype=np.int64)
+
+    def update(self,ground_truth,logits):
+        truth = np.reshape(ground_truth,[-1]).astype(bool)
+        scores = 1./(1. + np.exp(-np.reshape(logits,[-1])))
+        bins = np.searchsorted(self.sorted,scores,side='left')
+        self.pos += np.bincount(bins[truth],minlength=len(self.pos))
+        self.neg += np.bincount(bins[~truth],minlength=len(self.neg))
+
+    def counts(self):
+        """
+        Output: tp, tn, fp, fn arrays, one entry per threshold
+        """
+        inverse = np.argsort(self.order)
+        tp = np.cumsum(self.pos[::-1])[::-1][1:][inverse]
+        fp = np.cumsum(self.neg[::-1])[::-1][1:][inverse]
+        return tp,np.sum(self.neg) - fp,fp,np.sum(self.pos) - tp
+
+    def stats(self):
+        """
+        Output: FPR, TPR, MCC and F2 lists over the thresholds, and the best F2 threshold
+        """
+        tp,tn,fp,fn = [1.*c for c in self.counts()]
+        with np.errstate(divide='ignore',invalid='ignore'):
+            recall = tp/(tp+fn)
+            precision = tp/(tp+fp)
+            FPR = fp/(fp+tn)
+            F2 = 5.*recall*precision/(4.*precision + recall)
+            MCC_arr = np.where((tp == 0) & (fn == 0),tp*tn - fp*fn,
+                               (tp*tn - fp*fn)/np.sqrt((tp+fp)*(tp+fn)*(tn+fp)*(tn+fn)))
+        best_thresh = self.thresholds[np.nanargmax(F2)]
+        return list(FPR),list(recall),list(MCC_arr),list(F2),best_thresh
+
+def ROC_stats(ground_truth,logits,thresholds=np.linspace(-1,4.,30)):
+    roc = ROCAccumulator(thresholds)
+    roc.update(ground_truth,logits)
+    return roc.stats()
@@ -0,0 +1,444 @@
+import numpy as np
+import random
+from instrument import timed
+
+def transpose(X):
+    """
+    Transpose for use in the map functions.
+    """
+    return X.T
+
+def normalize(X,deterministic=False):
+    """
+    Normalization for the log amplitude required in the folding process.
+    Zero amplitudes are replaced by small random values, or by a fixed 1e-8 floor
+    in deterministic mode so the same waterfall always gives the same patch.
+    """
+    sh = np.shape(X)
+    absX = np.abs(X)
+    if deterministic:
+        absX = np.where(absX <= 0., 1e-8, absX)
+    else:
+        absX = np.where(absX <= 0., (1e-8)*np.random.randn(sh[0],sh[1]),absX)
+    LOGabsX = np.nan_to_num(np.log10(absX))
+    return np.nan_to_num((LOGabsX-np.nanmean(LOGabsX))/np.nanstd(np.abs(LOGabsX)))
+
+def normphs(X):
+    """                                                                                                                                           
+    Normalization for the phase in the folding proces.
+    """
+    sh = np.shape(X)
+    
+#    diff = [np.sin(np.angle(X[:,i+1])) - np.sin(np.angle(X[:,i])) for i in range(sh[1]-1)]
+#    diff.append(np.sin(np.angle(X[:,-1])) - np.sin(np.angle(X[:,-2])))
+    return np.array(np.sin(np.angle(X)))#np.array(diff).T
+
+def foldl(data,ch_fold=16,padding=2):
+    """
+    Folding function for carving up a waterfall visibility flags for prediction in the FCN.
+    """
+    sh = np.shape(data)
+    _data = data.T.reshape(ch_fold,sh[1]/ch_fold,-1)
+    _DATA = np.array(map(transpose,_data))
+    _DATApad = np.array(map(np.pad,_DATA,len(_DATA)*[((padding+2,padding+2),(padding,padding))],len(_DATA)*['reflect']))#np.array(map(pad,_DATA))
+    return _DATApad
+
+def pad(data,padding=2):
+    """
+    Padding function applied to folded spectral windows.
+    Reflection is default padding.
+    """
+    sh = np.shape(data)
+    t_pad = (sh[1] - sh[0])/2
+    data_pad = np.pad(data,pad_width=((t_pad+padding,t_pad+padding),(padding,padding)),mode='reflect')
+    return data_pad
+
+def unpad(data,diff=4,padding=2):
+    """
+    Unpadding function for recovering flag predictions.
+    """
+    sh = np.shape(data)
+    t_unpad = sh[0]
+    return data[padding[0]:sh[0]-padding[0],padding[1]:sh[1]-padding[1]]#data[padding/2+diff/2:,padding:][:-padding/2-diff/2,:-padding][padding/2:,:][:-padding/2,:]
+                      
+
+def fold(data,ch_fold=16,padding=2,deterministic=False):
+    """
+    Folding function for carving waterfall visibilities with additional normalized log 
+    and phase channels.
+    Input: (Batch, Time, Frequency)
+    Output: (Batch*FoldFactor, Time, Reduced Frequency, Channels) 
+    """
+    sh = np.shape(data)
+    _data = data.T.reshape(ch_fold,sh[1]/ch_fold,-1)
+    _DATA = np.array(map(transpose,_data))
+    _DATApad = np.array(map(np.pad,_DATA,len(_DATA)*[((padding+2,padding+2),(padding,padding))],len(_DATA)*['reflect']))#np.array(map(pad,_DATA))
+    DATA = np.stack((np.array(map(normalize,_DATApad,len(_DATApad)*[deterministic])),np.array(map(normphs,_DATApad)),np.mod(np.array(map(normphs,_DATApad)),np.pi)),axis=-1)
+    return DATA
+
+def unfoldl(data_fold,ch_fold=16,padding=2):
+    """
+    Unfolding function for recombining the carved label (flag) frequency windows back into a complete 
+    waterfall visibility.
+    Input: (Batch*FoldFactor, Time, Reduced Frequency, Channels)
+    Output: (Batch, Time, Frequency)
+    """
+    data_unpad = np.array(map(unpad,data_fold,len(data_fold)*[ch_fold],len(data_fold)*[(padding+2,padding)]))
+    ch_fold,ntimes,dfreqs = np.shape(data_unpad)
+    data_ = np.array(map(transpose,data_unpad))
+    _data = data_.reshape(ch_fold*dfreqs,ntimes).T
+    return _data
+
+def normalize_batch(X,deterministic=False,rng=np.random):
+    """
+    Batched version of normalize, each (Time, Frequency) patch of X is normalized
+    by its own log amplitude mean and standard deviation. Random zero amplitude
+    replacements are drawn from rng.
+    Input: (N, Time, Frequency)
+    """
+    sh = np.shape(X)
+    absX = np.abs(X)
+    if deterministic:
+        absX = np.where(absX <= 0., 1e-8, absX)
+    else:
+        absX = np.where(absX <= 0., (1e-8)*rng.randn(*sh),absX)
+    # Patch statistics are taken over contiguous rows so they sum in the same order as normalize.
+    # nan_to_num leaves no NaNs, so mean/std match the nanmean/nanstd used there.
+    LOGabsX = np.nan_to_num(np.log10(absX)).reshape(sh[0],-1)
+    mean = np.mean(LOGabsX,axis=1)[:,None]
+    std = np.std(np.abs(LOGabsX),axis=1)[:,None]
+    return np.nan_to_num((LOGabsX-mean)/std).reshape(sh)
+
+@timed('preprocessing/foldl_batch')
+def foldl_batch(data,ch_fold=16,padding=2):
+    """
+    Batched version of foldl using a single strided reshape and reflection pad.
+    Input: (Batch, Time, Frequency)
+    Output: (Batch*FoldFactor, Time, Reduced Frequency)
+    """
+    data = np.asarray(data)
+    if data.ndim == 2:
+        data = data[None]
+    nb,nt,nf = np.shape(data)
+    _data = data.reshape(nb,nt,ch_fold,nf/ch_fold).transpose(0,2,1,3).reshape(nb*ch_fold,nt,nf/ch_fold)
+    return np.pad(_data,((0,0),(padding+2,padding+2),(padding,padding)),mode='reflect')
+
+@timed('preprocessing/fold_batch')
+def fold_batch(data,ch_fold=16,padding=2,deterministic=False,dtype=None,nch=3,rng=np.random):
+    """
+    Batched version of fold, carving a whole block of waterfall visibilities at once.
+    Only the first nch of the (log amplitude, phase, phase mod pi) channels are computed,
+    and dtype (e.g. np.float32) overrides the output precision of fold.
+    In deterministic mode the output is identical to fold.
+    Input: (Batch, Time, Frequency)
+    Output: (Batch*FoldFactor, Time, Reduced Frequency, Channels)
+    """
+    _DATApad = foldl_batch(data,ch_fold,padding)
+    amp = normalize_batch(_DATApad,deterministic,rng)
+    if dtype is None:
+        dtype = amp.dtype
+    DATA = np.empty(np.shape(_DATApad)+(nch,),dtype=dtype)
+    DATA[...,0] = amp
+    del(amp)
+    if nch > 1:
+        DATA[...,1] = normphs(_DATApad)
+    if nch > 2:
+        DATA[...,2] = np.mod(DATA[...,1],np.pi)
+    return DATA
+
+@timed('preprocessing/unfoldl_batch')
+def unfoldl_batch(data_fold,ch_fold=16,padding=2):
+    """
+    Batched version of unfoldl. Any trailing axes (e.g. logits) are carried through.
+    Input: (Batch*FoldFactor, Time, Reduced Frequency, ...)
+    Output: (Batch, Time, Frequency, ...)
+    """
+    data_fold = np.asarray(data_fold)
+    sh = np.shape(data_fold)
+    data_unpad = data_fold[:,padding+2:sh[1]-padding-2,padding:sh[2]-padding]
+    ntimes,dfreqs = np.shape(data_unpad)[1:3]
+    rest = sh[3:]
+    _data = data_unpad.reshape((sh[0]/ch_fold,ch_fold,ntimes,dfreqs)+rest)
+    _data = _data.transpose((0,2,1,3)+tuple(range(4,4+len(rest))))
+    return _data.reshape((sh[0]/ch_fold,ntimes,ch_fold*dfreqs)+rest)
+
+def tile_starts(n,size,overlap):
+    """
+    Start indices of tiles of length size covering n samples, overlapping by at least overlap.
+    """
+    if n <= size:
+        return [0]
+    return list(range(0,n-size,size-overlap))+[n-size]
+
+def tile_weights(size,overlap):
+    """
+    1D blending window of a tile, ramping up over the overlap at both ends.
+    """
+    w = np.ones(size)
+    if overlap > 0:
+        ramp = np.arange(1,overlap+1)/float(overlap+1)
+        w[:overlap] = ramp
+        w[size-overlap:] = np.minimum(w[size-overlap:],ramp[::-1])
+    return w
+
+def tile_predict(data,predict,fold_factor=16,padding=2,tile_shape=(60,1024),overlap=(20,128),max_tiles=8,nch=3,unfolded=False):
+    """
+    Predicts waterfalls of any (Time, Frequency) shape by covering them with overlapping
+    tiles of the trained shape. At most max_tiles tiles are folded and run through predict
+    at a time, and the unfolded logits are blended in the overlaps with tile_weights.
+    Waterfalls smaller than a tile are reflected up to the tile shape.
+    Input: (Batch, Time, Frequency) complex waterfalls,
+           predict: (Tiles*FoldFactor, Time, Reduced Frequency, nch) -> (..., Classes) logits,
+           or with unfolded=True already unfolded (Tiles, Time, Frequency, Classes) logits
+    Output: (Batch, Time, Frequency, Classes) blended logits
+    """
+    tt,tf_ = tile_shape
+    ot,of = overlap
+    if tf_ % fold_factor != 0:
+        raise ValueError('Tile frequency size {0} is not divisible by fold factor {1}'.format(tf_,fold_factor))
+    if ot >= tt or of >= tf_:
+        raise ValueError('Tile overlap {0} must be smaller than the tile shape {1}'.format(overlap,tile_shape))
+    data = np.asarray(data)
+    nb,ntimes,nfreqs = np.shape(data)
+    nt,nf = max(ntimes,tt),max(nfreqs,tf_)
+    if (nt,nf) != (ntimes,nfreqs):
+        data = np.pad(data,((0,0),(0,nt-ntimes),(0,nf-nfreqs)),mode='reflect')
+    t_starts = tile_starts(nt,tt,ot)
+    f_starts = tile_starts(nf,tf_,of)
+    tiles = [(i,t,f) for i in range(nb) for t in t_starts for f in f_starts]
+    weight = np.outer(tile_weights(tt,ot),tile_weights(tf_,of)).astype(np.float32)
+    wsum = np.zeros((nt,nf),dtype=np.float32)
+    for t in t_starts:
+        for f in f_starts:
+            wsum[t:t+tt,f:f+tf_] += weight
+    logits = None
+    for j in range(0,len(tiles),max_tiles):
+        chunk = tiles[j:j+max_tiles]
+        batch = np.array([data[i,t:t+tt,f:f+tf_] for i,t,f in chunk])
+        g = predict(fold_batch(batch,fold_factor,padding,dtype=np.float32,nch=nch))
+        if not unfolded:
+            g = unfoldl_batch(g,fold_factor,padding)
+        if logits is None:
+            logits = np.zeros((nb,nt,nf)+np.shape(g)[3:],dtype=np.float32)
+        for (i,t,f),g_ in zip(chunk,g):
+            logits[i,t:t+tt,f:f+tf_] += weight[:,:,np.newaxis]*g_
+    logits /= wsum[:,:,np.newaxis]
+    return logits[:,:ntimes,:nfreqs]
+
+def stride(input_data,input_labels):
+    """
+    Takes an input waterfall visibility with labels and strides across frequency,
+    producing (Nchan - 64)/S new waterfalls to be folded.
+    """
+    spw_hw = 32 #spectral window half width
+    nchans = 1024
+    fold = nchans/(2*spw_hw)
+    sample_spws = random.sample(range(0,60),fold)
+    
+    x = np.array([input_data[:,i-spw_hw:i+spw_hw] for i in range(spw_hw,1024-spw_hw,(nchans-2*spw_hw)/60)])
+    x_labels = np.array([input_labels[:,i-spw_hw:i+spw_hw] for i in range(spw_hw,1024-spw_hw,(nchans-2*spw_hw)/60)])
+    X = np.array([x[i].T for i in sample_spws])
+    X_labels = np.array([x_labels[i].T for i in sample_spws]) 
+    X_ = X.reshape(-1,60).T
+    X_labels = X_labels.reshape(-1,60).T
+    return X_,X_labels
+    
+
+def stride_batch(data,labels,rng=np.random,spw_hw=32):
+    """
+    Batched version of stride. Every waterfall gets its own random set of spectral
+    windows, gathered for the whole batch with a single fancy index.
+    Input: (Batch, Time, Frequency)
+    Output: (Batch, Time, Frequency)
+    """
+    data = np.asarray(data)
+    labels = np.asarray(labels)
+    nb,nt,nchans = np.shape(data)
+    fold = nchans/(2*spw_hw)
+    centers = np.arange(spw_hw,nchans-spw_hw,(nchans-2*spw_hw)/60)
+    # Random sample of fold windows without replacement for each waterfall
+    sample_spws = np.argsort(rng.rand(nb,len(centers)),axis=1)[:,:fold]
+    finds = ((centers[sample_spws]-spw_hw)[:,:,None] + np.arange(2*spw_hw)).reshape(nb,1,-1)
+    binds = np.arange(nb)[:,None,None]
+    tinds = np.arange(nt)[None,:,None]
+    return data[binds,tinds,finds],labels[binds,tinds,finds]
+
+def patchwise(data,labels,rng=np.random):
+    """
+    A spectral window is strided over the visibility
+    augmenting the existing training or evaluation
+    datasets.
+    """
+    data_strided,labels_strided = stride_batch(data,labels,rng)
+    return data_strided,labels_strided.astype(int)
+
+def gaussian_blur_batch(X,sigma,truncate=4.0):
+    """
+    Batched equivalent of ndimage.gaussian_filter with a separate sigma for every sample.
+    All axes but the first are blurred, with reflection at the edges.
+    Input: (Batch, ...), (Batch,)
+    """
+    sigma = np.asarray(sigma,dtype=np.float64)
+    radius = int(truncate*np.max(sigma)+0.5)
+    X = np.array(X,copy=True)
+    if radius == 0:
+        return X
+    x = np.arange(-radius,radius+1)
+    r = (truncate*sigma+0.5).astype(int)[:,None]
+    s = np.where(sigma > 0.,sigma,1.)[:,None]
+    kernels = np.where(np.abs(x)[None,:] <= r,np.exp(-0.5/s**2*x[None,:]**2),0.)
+    kernels /= np.sum(kernels,axis=1)[:,None]
+    for axis in range(1,X.ndim):
+        pad = X.ndim*[(0,0)]
+        pad[axis] = (radius,radius)
+        Xpad = np.pad(X,pad,mode='symmetric')
+        n = np.shape(X)[axis]
+        out = np.zeros_like(X)
+        for k in range(2*radius+1):
+            sl = X.ndim*[slice(None)]
+            sl[axis] = slice(k,k+n)
+            out += kernels[:,k].reshape((-1,)+(X.ndim-1)*(1,))*Xpad[tuple(sl)]
+        X = out
+    return X
+
+class Augmenter():
+    def __init__(self,seed=None,rng=None,noise=True,blur=True,flip=True):
+        """
+        Vectorized augmentation of batches of folded patches with the gaussian noise, gaussian
+        blurring and time/frequency reflections of expand_dataset. All draws come from
+        its own RandomState, so a seed reproduces the augmentation stream.
+        """
+        if rng is None:
+            rng = np.random.RandomState(seed)
+        self.rng = rng
+        self.noise = noise
+        self.blur = blur
+        self.flip = flip
+
+    def __call__(self,data,labels):
+        """
+        Returns augmented copies of a batch.
+        Input: (Batch, Time, Reduced Frequency, Channels), (Batch, Time, Reduced Frequency)
+        """
+        data = np.array(data,copy=True)
+        labels_dtype = np.asarray(labels).dtype
+        labels = np.asarray(labels,dtype=np.float64)
+        nb,nt,nf,nch = np.shape(data)
+        if self.noise:
+            order = self.rng.choice(np.logspace(-4,-1,10),size=nb)[:,None,None]
+            noise = self.rng.randn(nb,nt,nf)+1j*self.rng.randn(nb,nt,nf)
+            data[:,:,:,0] += order*np.abs(noise)
+            if nch > 1:
+                data[:,:,:,1] += order*np.angle(noise)
+            del(noise)
+        if self.blur:
+            blur_sigma = self.rng.uniform(0.,0.5,size=nb)
+            data = gaussian_blur_batch(data,blur_sigma)
+            labels = np.where(gaussian_blur_batch(labels,blur_sigma) > .1,1.,0.)
+        if self.flip:
+            # Time reversal, frequency reversal or both, in the proportions of expand_dataset
+            rnd_num = self.rng.rand(nb)
+            flip_t = ((rnd_num < .3) | (rnd_num >= .6))[:,None,None]
+            flip_f = (rnd_num >= .3)[:,None,None]
+            data = np.where(flip_t[:,:,:,None],data[:,::-1],data)
+            data = np.where(flip_f[:,:,:,None],data[:,:,::-1],data)
+            labels = np.where(flip_t,labels[:,::-1],labels)
+            labels = np.where(flip_f,labels[:,:,::-1],labels)
+        return data,labels.astype(labels_dtype)
+
+def expand_dataset(data,labels,rng=None,chunk_size=256):
+    """
+    Comprehensive data augmentation function. Uses reflections, patchwise, gaussian noise, and
+    gaussian blurring, to improve robustness of the DFCN model which increases performance
+    when applied to real data.
+    Bloat factor is how large to increase the dataset size.
+    Samples are drawn with replacement and augmented chunk_size at a time by an Augmenter.
+    """
+    bloat = 1
+    sh = np.shape(data)
+    augmenter = Augmenter(rng=rng if rng is not None else np.random)
+    inds = augmenter.rng.randint(0,sh[0],size=bloat*sh[0])
+    out_data = np.empty((len(inds),)+sh[1:],dtype=data.dtype)
+    out_labels = np.empty((len(inds),)+np.shape(labels)[1:],dtype=labels.dtype)
+    for i in range(0,len(inds),chunk_size):
+        # h5py and memory maps read fastest with sorted indices
+        chunk = np.sort(inds[i:i+chunk_size])
+        out_data[i:i+len(chunk)],out_labels[i:i+len(chunk)] = augmenter(data[chunk],labels[chunk])
+    return out_data,out_labels
+
+def expand_validation_dataset(data,labels):
+    """
+    Validation dataset augmentation trick for expanding a small dataset with a 
+    well known ground truth.
+    """
+    bloat = 10
+    sh = np.shape(data)
+    out_data = []
+    out_labels = []
+    for i in range(bloat*sh[0]):
+        rnd_data_ind = np.random.randint(0,sh[0])
+        spi = np.random.uniform(-2.7,-.1)
+        nos_jy = np.random.rand(sh[1],sh[2])+1j*np.random.rand(sh[1],sh[2])
+        nos_jy *= ((np.linspace(0.1,0.2,1024)/.1)**(spi))
+        nos_jy *= random.sample(np.logspace(-3,-1),1)[0]*np.nanmean(np.abs(data[rnd_data_ind]))
+        data_ = np.copy(data[rnd_data_ind]) + nos_jy
+        labels_ = np.copy(labels[rnd_data_ind])
+        if np.random.rand() > .5:
+            data_ = data_[::-1,:]
+            labels_ = labels_[::-1,:]
+        if np.random.rand() > .5:
+            data_ = data_[:,::-1]
+            labels_ = labels_[:,::-1]
+        if np.random.rand() > .5:
+            data_,labels_ = patchwise([data_],[labels_])
+        out_data.append(data_.reshape(-1,1024))
+        out_labels.append(labels_.reshape(-1,1024))
+    return out_data,out_labels
+
+@timed('preprocessing/fold_waterfalls')
+def fold_waterfalls(data,labels,chtypes,fold_factor,psize,deterministic=False,dtype=np.float32,labels_dtype=np.uint8,chunk_size=64,rng=np.random):
+    """
+    Folds a block of waterfall visibilities and their flags into training patches,
+    chunk_size waterfalls at a time through the batched folding functions. Flags are
+    binary, so the folded labels are kept as uint8 whatever dtype they come in.
+    Channels by chtypes: Amp (log amplitude), AmpPhs (and phase), AmpPhs2 (and phase
+    mod pi) or Phs (phase only).
+    Input: (Batch, Time, Frequency)
+    Output: (Batch*FoldFactor, Time, Reduced Frequency, Channels), (Batch*FoldFactor, Time, Reduced Frequency)
+    """
+    # Channels folded and the first one kept
+    if chtypes == 'AmpPhs':
+        nch,first = 2,0
+    elif chtypes == 'Amp':
+        nch,first = 1,0
+    elif chtypes == 'AmpPhs2':
+        nch,first = 3,0
+    elif chtypes == 'Phs':
+        nch,first = 2,1
+    else:
+        raise ValueError('Folding not supported for channel type %s' % chtypes)
+    nwf,ntimes,nfreqs = np.shape(data)
+    sh = (nwf*fold_factor,2*(psize+2)+ntimes,2*psize+nfreqs/fold_factor)
+    f_data = np.empty(sh+(nch-first,),dtype=dtype)
+    f_labels = np.empty(sh,dtype=labels_dtype)
+    for i in range(0,nwf,chunk_size):
+        j = min(i+chunk_size,nwf)
+        f_data[i*fold_factor:j*fold_factor] = fold_batch(data[i:j],fold_factor,psize,deterministic=deterministic,nch=nch,rng=rng)[...,first:]
+        f_labels[i*fold_factor:j*fold_factor] = foldl_batch(labels[i:j],fold_factor,psize)
+    return f_data,f_labels
+
+def subsample_time_patches(data,labels,psize,rng=np.random):
+    """
+    Time subsampling applied directly to folded patches. A random range of the unpadded
+    integrations is kept and reflection padded back to the full patch height.
+    Input: (N, Time, Reduced Frequency, Channels), (N, Time, Reduced Frequency)
+    """
+    tpad = psize + 2
+    ntimes = np.shape(data)[1] - 2*tpad
+    t0 = rng.randint(0,ntimes/3)
+    t1 = rng.randint(2*ntimes/3,ntimes)
+    data_ = np.pad(data[:,tpad+t0:tpad+t1],((0,0),(t0,ntimes-t1),(0,0),(0,0)),mode='reflect')
+    labels_ = np.pad(labels[:,tpad+t0:tpad+t1],((0,0),(t0,ntimes-t1),(0,0)),mode='reflect')
+    data_ = np.pad(data_,((0,0),(tpad,tpad),(0,0),(0,0)),mode='reflect')
+    labels_ = np.pad(labels_,((0,0),(tpad,tpad),(0,0)),mode='reflect')
+    return data_,labels_
@@ -0,0 +1,106 @@
+import numpy as np
+
+# Frequencies (MHz) of narrowband transmitters seen in the HERA band, e.g. ORBCOMM at 137-138 MHz
+station_freqs = [101.3,137.2,137.5,137.8,141.9,149.9,175.1,181.0,187.5]
+
+class WaterfallSimulator():
+    def __init__(self,ntimes=60,nfreqs=1024,freq_range=(100.,200.),int_time=10.7,nsrc=4,seed=None,rng=None):
+        """
+        HERA-like complex visibilities with labelled RFI, simulated a batch of waterfalls
+        at a time. Each waterfall is a few smooth-spectrum fringing point sources through a
+        bandpass with thermal noise, plus narrowband stations, broadband bursts and speckle.
+        The flags mark every sample RFI was added to. All draws come from its own RandomState.
+        """
+        if rng is None:
+            rng = np.random.RandomState(seed)
+        self.rng = rng
+        self.ntimes = ntimes
+        self.nfreqs = nfreqs
+        self.nsrc = nsrc
+        self.freqs = np.linspace(freq_range[0],freq_range[1],nfreqs,endpoint=False)
+        self.times = int_time*np.arange(ntimes)
+        self.station_chans = [int(round((f - freq_range[0])/(freq_range[1] - freq_range[0])*nfreqs)) for f in station_freqs
+                              if freq_range[0] <= f < freq_range[1]]
+
+    def sky(self,nb):
+        """
+        Sum of nsrc point sources with power law spectra, fringing with their delay and fringe rate.
+        Output: (Batch, Time, Frequency) complex
+        """
+        rng = self.rng
+        vis = np.zeros((nb,self.ntimes,self.nfreqs),dtype=np.complex64)
+        nu = (self.freqs/150.)[None,None,:]
+        for i in range(self.nsrc):
+            amp = 10**rng.uniform(0.,2.,size=nb)[:,None,None]
+            alpha = rng.uniform(-3.,-0.5,size=nb)[:,None,None]
+            delay = rng.uniform(-400.,400.,size=nb)[:,None,None]*1e-9     # s, within the horizon of a ~120 m baseline
+            rate = rng.uniform(-2e-3,2e-3,size=nb)[:,None,None]            # Hz
+            # The fringe separates into a frequency and a time factor, so no exp over the whole waterfall
+            spec = (amp*nu**alpha*np.exp(2j*np.pi*delay*self.freqs[None,None,:]*1e6)).astype(np.complex64)
+            fringe = np.exp(2j*np.pi*(rate*self.times[None,:,None] + rng.rand(nb)[:,None,None])).astype(np.complex64)
+            vis += spec*fringe
+        return vis
+
+    def bandpass(self,nb):
+        """
+        Smooth gain with a ripple and rolled off band edges.
+        Output: (Batch, 1, Frequency)
+        """
+        rng = self.rng
+        x = np.linspace(-1.,1.,self.nfreqs)[None,:]
+        edges = 0.5*(np.tanh((x + 0.92)/0.02) - np.tanh((x - 0.92)/0.02))
+        ripple = 1. + rng.uniform(0.,0.1,size=nb)[:,None]*np.sin(2*np.pi*rng.uniform(3.,12.,size=nb)[:,None]*x + 2*np.pi*rng.rand(nb)[:,None])
+        slope = 1. + rng.uniform(-0.3,0.3,size=nb)[:,None]*x
+        return (edges*ripple*slope)[:,None,:]
+
+    def rfi(self,nb,noise):
+        """
+        Narrowband stations (persistent or intermittent, 1-3 channels), broadband bursts
+        (1-2 integrations over a part of the band) and speckle, tens to thousands of times
+        the noise level.
+        Input: (Batch,) noise level
+        Output: (Batch, Time, Frequency) complex RFI, (Batch, Time, Frequency) bool mask
+        """
+        rng = self.rng
+        nt,nf = self.ntimes,self.nfreqs
+        amp = np.zeros((nb,nt,nf),dtype=np.float32)
+        t = np.arange(nt)[None,:,None]
+        f = np.arange(nf)[None,None,:]
+        for chan in self.station_chans:
+            on = rng.rand(nb) < 0.5
+            width = rng.randint(1,4,size=nb)[:,None,None]
+            # Persistent stations cover every integration, intermittent ones a random block
+            t0 = np.where(rng.rand(nb) < 0.6,0,rng.randint(0,nt,size=nb))[:,None,None]
+            t1 = np.where(t0[:,0,0] == 0,nt,rng.randint(1,nt+1,size=nb))[:,None,None]
+            mask = on[:,None,None] & (f >= chan) & (f < chan + width) & (t >= t0) & (t < np.maximum(t1,t0 + 1))
+            amp = np.where(mask,10**rng.uniform(1.,3.,size=nb)[:,None,None]*noise[:,None,None],amp)
+        for i in range(3):
+            on = rng.rand(nb) < 0.3
+            t0 = rng.randint(0,nt,size=nb)[:,None,None]
+            dt = rng.randint(1,3,size=nb)[:,None,None]
+            f0 = rng.randint(0,nf,size=nb)[:,None,None]
+            df = (rng.uniform(0.2,1.,size=nb)*nf).astype(int)[:,None,None]
+            mask = on[:,None,None] & (t >= t0) & (t < t0 + dt) & (f >= f0) & (f < f0 + df)
+            amp = np.where(mask,10**rng.uniform(1.,2.5,size=nb)[:,None,None]*noise[:,None,None],amp)
+        density = 10**rng.uniform(-4.,-2.5,size=nb)[:,None,None]
+        speckle = np.nonzero(rng.rand(nb,nt,nf) < density)
+        amp[speckle] = 10**rng.uniform(1.,2.,size=len(speckle[0]))*noise[speckle[0]]
+        flags = amp > 0
+        rfi = np.zeros((nb,nt,nf),dtype=np.complex64)
+        rfi[flags] = amp[flags]*np.exp(2j*np.pi*rng.rand(np.sum(flags)))
+        return rfi,flags
+
+    def __call__(self,nb):
+        """
+        Simulates a batch of waterfalls.
+        Output: (Batch, Time, Frequency) complex64 visibilities, (Batch, Time, Frequency) uint8 flags
+        """
+        rng = self.rng
+        vis = self.sky(nb)*self.bandpass(nb).astype(np.float32)
+        noise = np.mean(np.abs(vis),axis=(1,2))*10**rng.uniform(-2.,-1.,size=nb)
+        sigma = (noise/np.sqrt(2)).astype(np.float32)[:,None,None]
+        vis.real += sigma*rng.randn(nb,self.ntimes,self.nfreqs).astype(np.float32)
+        vis.imag += sigma*rng.randn(nb,self.ntimes,self.nfreqs).astype(np.float32)
+        rfi,flags = self.rfi(nb,noise)
+        vis += rfi
+        return vis,flags.astype(np.uint8)
@@ -1,26 +1,22 @@
 from __future__ import division, print_function, absolute_import
-import matplotlib
-matplotlib.use("AGG")
-import matplotlib.pyplot as plt
 import numpy as np
 import tensorflow as tf
 from glob import glob
 import ml_rfi.helper_functions as hf
 from time import time
 import os
-from sklearn.metrics import roc_curve
-from sklearn.metrics import confusion_matrix
 import sys
-from copy import copy
-import h5py
+import json
+import multiprocessing
 from ml_rfi.AmpModel import AmpFCN
 from ml_rfi.AmpPhsModel import AmpPhsFCN
 
-# Run on a single GPU
-os.environ["CUDA_VISIBLE_DEVICES"]="1"
 args = sys.argv[1:]
 
-filename = '../zen.2458098.45361.xx.HH.uv'
+# Arguments: pyuvdata files or globs to flag, e.g. '../zen.2458098.*.xx.HH.uv'
+files = sorted(set([f for arg in args for f in glob(arg)]))
+if len(files) == 0:
+    files = ['../zen.2458098.45361.xx.HH.uv']
 chtypes = 'AmpPhs'
 ch_input = 2
 FCN_version = 'v100'
@@ -31,75 +27,211 @@ mods = 'test'
 pad_size = 16#68
 f_factor = 16
 slice_size = 16
+bl_chunk = 32 # waterfalls (baseline-polarizations) read per chunk
+tile_shape = (60,1024) # trained (Ntimes, Nfreqs) of a tile
+tile_overlap = (20,128) # minimum tile overlap, blended in the stitched logits
+exec_profile = 'cpu_profile.json' # execution profile tuned by tuneDFCN.py, these defaults are used without one
+profile = hf.load_profile(exec_profile,device='cpu',nworkers=4,intra_op_threads=max(1,multiprocessing.cpu_count()//4),max_tiles=16)
+max_tiles = profile['max_tiles'] # tiles folded per sess.run, bounding the memory in flight
+nworkers = profile['nworkers'] # worker processes, each holding its own warm session
+nthreads = profile['intra_op_threads'] # TF threads per worker
+save_plots = False
+flag_format = 'h5' # 'h5' for a compact flag file, 'uv' to save the UVData with the flags in its flag_array
+flag_mode = 'or' # 'or' with the existing flags or 'replace' them
+out_dir = './'
+frozen_model = '' # frozen model from exportDFCN.py, used instead of the checkpoint when set
+quantized_model = '' # int8/float16 TensorFlow Lite model from quantizeDFCN.py, used instead of either when set
+model_kind = 'quantized' if quantized_model else 'frozen' if frozen_model else 'checkpoint'
+if profile.get('model_kind',model_kind) != model_kind:
+    # The frozen and checkpoint paths run different graphs, so their best settings differ
+    print('Warning: {0} was tuned for the {1} model, flagging with the {2} model.'.format(exec_profile,profile['model_kind'],model_kind))
+trace_steps = [] # sess.run calls of each worker traced per layer with RunMetadata, e.g. range(2,6); none costs nothing
 #model_name = 'AmpPhsv9SimRealv13_64BSize_ExpandedDataset_Softmax_1x_DOUT0.8_Converge_teval' #chtypes+FCN_version+tdset_type+edset_type+tdset_version+'_'+'64'+'BSize'+mods
 #model_name = 'AmpPhsv9SimRealv13_64BSizeNew'
 model_name = 'AmpPhsv9SimRealv13_64BSizeDynamicVis'
 #model_name = 'Ampv7SimRealv13_64BSize_ExpandedDataset_Softmax_1x_DOUT0.8_Converge_teval'
-model_dir = glob("./"+model_name+"/model_*")
+checkpoint,step = hf.latest_checkpoint('./'+model_name)
+# Checked before any worker starts, an error raised in a Pool initializer hangs the pool
+if model_kind == 'checkpoint':
+    if checkpoint is None:
+        raise ValueError("No Model Found. Pipeline killed.")
+    print(checkpoint)
+elif not os.path.exists(quantized_model or frozen_model):
+    raise ValueError("No {0} model found at {1}. Pipeline killed.".format(model_kind,quantized_model or frozen_model))
+# Files already flagged by this model, one JSON line each, so interrupted runs resume
+manifest = 'flag_manifest_'+model_name+'.jsonl'
 
-try:
-    models2sort = [int(model_dir[i].split('/')[2].split('.')[0].split('_')[1]) for i in range(len(model_dir))]
-    model_ind = np.argmax(models2sort)
-    model = 'model_'+str(models2sort[model_ind])+'.ckpt'
-    print(model)
-except:
-    print('Cannot find model.')
+def init_worker():
+    """
+    Builds the network and restores the model once per worker process, so every
+    file handed to that worker reuses the same warm session.
+    """
+    global sess, vis_input, mode_bn, d_out, RFI_guess, post, quant, profiler, nruns
+    config = hf.session_config(profile)
+    quant = None
+    nruns = 0
+    if quantized_model:
+        quant = hf.QuantizedModel(quantized_model,num_threads=nthreads or None)
+        print('Quantized model '+quantized_model+' loaded by worker {0}.'.format(os.getpid()))
+        return
+    if frozen_model:
+        sess,vis_input,RFI_guess = hf.load_frozen_model(frozen_model,config=config)
+        mode_bn = None
+        with sess.graph.as_default():
+            post = hf.prediction_ops(RFI_guess,vis_input,f_factor,pad_size)
+        sess.graph.finalize()
+        profiler = hf.LayerProfiler(trace_steps,'./'+model_name+'_profile/',graph=sess.graph,prefix='worker%i_' % os.getpid())
+        print('Frozen model '+frozen_model+' loaded by worker {0}.'.format(os.getpid()))
+        return
+    vis_input = tf.placeholder(tf.float32, shape=[None, None, None, ch_input])#2*(pad_size+2)+60, 2*pad_size+1024/f_factor, ch_input])
+    mode_bn = tf.placeholder(tf.bool)
+    d_out = tf.placeholder(tf.float32)
 
-vis_input = tf.placeholder(tf.float32, shape=[None, None, None, ch_input])#2*(pad_size+2)+60, 2*pad_size+1024/f_factor, ch_input])
-mode_bn = tf.placeholder(tf.bool)
-d_out = tf.placeholder(tf.float32)
-kernel_size = tf.placeholder(tf.int32)
+    # Initialize Network
+    if chtypes == 'Amp':
+        RFI_guess = AmpFCN(vis_input,mode_bn=mode_bn,d_out=d_out)
+    elif chtypes == 'AmpPhs':
+        RFI_guess = AmpPhsFCN(vis_input,mode_bn=mode_bn,d_out=d_out)
 
-# Initialize Network
-if chtypes == 'Amp':
-    RFI_guess = AmpFCN(vis_input,mode_bn=mode_bn,d_out=d_out)
-elif chtypes == 'AmpPhs':
-    RFI_guess = AmpPhsFCN(vis_input,mode_bn=mode_bn,d_out=d_out)
+    # Unfolding runs in the graph, fetched with RFI_guess
+    post = hf.prediction_ops(RFI_guess,vis_input,f_factor,pad_size)
 
-# Initialize the variables (i.e. assign their default value)                                                                                      
-init = tf.group(tf.global_variables_initializer(),tf.local_variables_initializer())
-
-# Load dataset
-dset = hf.RFIDataset()
-dset_start_time = time()
-dset.load_pyuvdata(filename,chtypes,f_factor,pad_size)
-#dset.load(tdset_version,vdset,batch_size,pad_size,chtypes=chtypes)
-dset_load_time = (time() - dset_start_time)/dset.get_size() # per visibility
-saver = tf.train.Saver()
-with tf.Session() as sess:    
-    # Run the initializer                                                                                                                         
+    # Initialize the variables (i.e. assign their default value)
+    init = tf.group(tf.global_variables_initializer(),tf.local_variables_initializer())
+    saver = tf.train.Saver()
+    sess = tf.Session(config=config)
+    # Run the initializer
     sess.run(init)
-    # Check to see if model exists                                                                                                                 
-    if len(model_dir) > 0:
-        print('Model exists. Loading last save.')
-        saver.restore(sess, './'+model_name+'/'+model)
-        print('Model '+'./'+model_name+'/'+model + ' loaded.')
-    else:
-        raise ValueError("No Model Found. Pipeline killed.")        
+    # The parent has checked the checkpoint exists
+    saver.restore(sess, checkpoint)
+    print('Model '+checkpoint + ' loaded by worker {0}.'.format(os.getpid()))
+    # Nothing may add ops from here on, so per-chunk latency stays constant
+    sess.graph.finalize()
+    profiler = hf.LayerProfiler(trace_steps,'./'+model_name+'_profile/',graph=sess.graph,prefix='worker%i_' % os.getpid())
+
+def predict(batch_x):
+    global nruns
+    if quant is not None:
+        # The interpreter runs the model alone, unfolding is done in NumPy
+        g = quant(batch_x)
+        return hf.unfoldl_batch(g.reshape(np.shape(batch_x)[:3]+(-1,)),f_factor,pad_size)
+    feed_dict = {vis_input: batch_x}
+    if mode_bn is not None:
+        # Frozen models have batch norm folded and no training switch
+        feed_dict[mode_bn] = True
+    run_kwargs = profiler.options(nruns)
+    g = sess.run(post['logits'], feed_dict=feed_dict, **run_kwargs)
+    profiler.collect(nruns,run_kwargs)
+    nruns += 1
+    return g
+
+def flag_file(filename):
+    """
+    Flags every baseline and polarization of one pyuvdata file.
+    Output: dict of timing and flag-occupancy statistics for the manifest
+    """
+    writer = None
+    try:
+        time0 = time()
+        rss0 = hf.peak_rss()
+        # Load dataset
+        dset = hf.RFIDataset()
+        dset.load_pyuvdata(filename,chtypes,f_factor,pad_size)
+        load_time = time() - time0
+        if flag_format == 'h5':
+            outfile = os.path.join(out_dir,os.path.basename(filename.rstrip('/'))+'.dfcn.h5')
+        else:
+            # HERA style suffix for a processed miriad file
+            outfile = os.path.join(out_dir,os.path.basename(filename.rstrip('/'))+'D')
+        # Flags are written chunk by chunk while the next chunk is predicted
+        writer = hf.FlagWriter(dset,outfile,mode=flag_mode)
+        nflagged = dict([(pol,0) for pol in dset.pols])
+        nsamples = dict([(pol,0) for pol in dset.pols])
+        nwf = 0
+        pred_time = 0.
+        for keys,data in dset.iter_pyuvdata(chunk_size=bl_chunk):
+            pred_start = time()
+            with hf.stage('pipeline/predict'):
+                # Any (Ntimes, Nfreqs) is covered by overlapping tiles of the trained shape
+                g = hf.tile_predict(data,predict,f_factor,pad_size,tile_shape=tile_shape,overlap=tile_overlap,
+                                    max_tiles=max_tiles,nch=ch_input,unfolded=True)
+                pred_unfold = np.argmax(g,axis=-1)
+            pred_time += time() - pred_start
+            with hf.stage('pipeline/write_put'):
+                writer.put(keys,pred_unfold)
+            for key,flag in zip(keys,pred_unfold):
+                nflagged[key[2]] += np.sum(flag)
+                nsamples[key[2]] += np.size(flag)
+            if save_plots and nwf == 0:
+                import matplotlib
+                matplotlib.use("AGG")
+                import matplotlib.pyplot as plt
+                plt.clf()
+                plt.imshow(np.log10(np.abs(data[0])*np.logical_not(pred_unfold[0])),aspect='auto',vmin=-4,vmax=0.)
+                plt.colorbar()
+                plt.savefig(os.path.basename(filename.rstrip('/'))+'_flags.png')
+            nwf += len(keys)
+        with hf.stage('pipeline/write_close'):
+            writer.close()
+        process_time = time() - time0
+        hf.instruments.add('pipeline/file',process_time,rss_before=rss0,rss_after=hf.peak_rss())
+    except Exception as e:
+        return {'file': os.path.abspath(filename), 'error': repr(e)}
+    finally:
+        if writer is not None:
+            # Stops the write thread and drops the partial output after a failure, no-op once closed
+            writer.close(save=False)
+    return {'file': os.path.abspath(filename),
+            'worker': os.getpid(),
+            'waterfalls': nwf,
+            'load_time': load_time,
+            'pred_time': pred_time,
+            'write_wait': writer.wait_time,
+            'process_time': process_time,
+            'waterfalls_per_s': nwf/process_time,
+            'output': os.path.abspath(outfile),
+            'flag_occupancy': float(sum(nflagged.values()))/max(1,sum(nsamples.values())),
+            'flag_occupancy_per_pol': dict([(pol,float(nflagged[pol])/max(1,nsamples[pol])) for pol in dset.pols]),
+            # This file's stage timings, merged by the parent instead of written to the manifest
+            'stages': hf.instruments.state(reset=True)}
+
+if __name__ == '__main__':
+    done = set()
+    if os.path.exists(manifest):
+        with open(manifest) as f:
+            done = set([json.loads(line)['file'] for line in f if line.strip()])
+    todo = [f for f in files if os.path.abspath(f) not in done]
+    print('{0} files, {1} already flagged, {2} to flag on {3} workers x {4} threads.'.format(len(files),len(files)-len(todo),len(todo),nworkers,nthreads))
 
     time0 = time()
-    ind = 0
-    print('N=%i number of baselines time: ' % 1,time() - time0)
-    ct = 0
-    batch_x = dset.predict_pyuvdata()#np.array([dset.predict_pyuvdata() for i in range(1)]).reshape(-1,2*(pad_size+2)+60, 2*pad_size+1024/f_factor,2)
-    print(np.shape(batch_x))
-    pred_start = time()
-    g = sess.run(RFI_guess, feed_dict={vis_input: batch_x, mode_bn: True})
-    print('Current Visibility: {0}'.format(ct))            
-    pred_unfold = map(hf.unfoldl,tf.reshape(tf.argmax(g,axis=-1),[-1,int(f_factor),int(2*(pad_size+2)+60), int(2*pad_size+1024/f_factor)]).eval(),[f_factor],[pad_size])
-    pred_time = time() - pred_start
-    if chtypes == 'AmpPhs':
-        thresh = 0.62 #0.329 real #0.08 sim 
+    if nworkers > 1:
+        pool = multiprocessing.Pool(min(nworkers,max(1,len(todo))),initializer=init_worker)
+        results = pool.imap_unordered(flag_file,todo)
     else:
-        thresh = 0.385 #0.385 real #0.126 sim
-    y_pred = np.array(pred_unfold[0]).reshape(-1,1024)
-    data = dset.uv.get_data((1,11))
-    
-    plt.imshow(np.log10(np.abs(data)*np.logical_not(y_pred)),aspect='auto',vmin=-4,vmax=0.)
-    plt.colorbar()
-    plt.savefig('AdamBMissedRFITest.png')
-    ct += 1
-#       y_pred = hf.hard_thresh(pred_unfold[:,64*ci_1:1024-64*ci_2],thresh=thresh).reshape(-1)
-    process_time = ((time() - time0)/60.)
-    print('Total processing time: {0} mins'.format(process_time))
-    print('Data throughput: {0} Vis/h/gpu'.format(1100./(process_time/60.)))
+        init_worker()
+        results = (flag_file(f) for f in todo)
+    nwf = 0
+    nfiles = 0
+    with open(manifest,'a') as mf:
+        for stats in results:
+            if 'error' in stats:
+                print('Failed {0}: {1}'.format(stats['file'],stats['error']))
+                continue
+            hf.instruments.merge(stats.pop('stages'))
+            # Only finished files are recorded, one line at a time
+            mf.write(json.dumps(stats)+'\n')
+            mf.flush()
+            nwf += stats['waterfalls']
+            nfiles += 1
+            print('{0}: {1} waterfalls, load {2:.1f} s, inference {3:.1f} s, write wait {4:.1f} s, {5:.2f} waterfalls/s, {6:.2f}% flagged'.format(
+                os.path.basename(stats['file'].rstrip('/')),stats['waterfalls'],stats['load_time'],stats['pred_time'],stats['write_wait'],
+                stats['waterfalls_per_s'],100.*stats['flag_occupancy']))
+    if nworkers > 1:
+        pool.close()
+        pool.join()
+    process_time = time() - time0
+    print('Total processing time: {0:.2f} mins'.format(process_time/60.))
+    if nfiles > 0:
+        print('Data throughput: {0:.2f} waterfalls/s over {1} files'.format(nwf/process_time,nfiles))
+        print(hf.instruments.summary())
+        hf.instruments.save(os.path.join(out_dir,'pipeline_stages.json'))
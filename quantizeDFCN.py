@@ -0,0 +1,138 @@
+from __future__ import division, print_function, absolute_import
+import numpy as np
+import tensorflow as tf
+import ml_rfi.helper_functions as hf
+from time import time
+import multiprocessing
+import h5py
+import json
+import sys
+import os
+from ml_rfi.AmpModel import AmpFCN
+from ml_rfi.AmpPhsModel import AmpPhsFCN
+
+args = sys.argv[1:]
+
+# Arguments order model_name chtypes frozen_file dset_file mode
+try:
+    model_name = args[0]
+except:
+    model_name = 'AmpPhsv9SimRealv13_64BSizeDynamicVis'
+try:
+    chtypes = args[1]
+except:
+    chtypes = 'AmpPhs'
+try:
+    frozen_file = args[2]
+except:
+    frozen_file = './'+model_name+'/frozen_model.pb'
+try:
+    dset_file = args[3]
+except:
+    dset_file = 'SimVis_2000_v911.h5'
+try:
+    quant_mode = args[4]     # 'int8' or 'float16'
+except:
+    quant_mode = 'int8'
+if chtypes == 'AmpPhs':
+    ch_input = 2
+else:
+    ch_input = 1
+pad_size = 16
+f_factor = 16
+calib_waterfalls = 16        # training waterfalls folded into the calibration sample
+eval_batch = 16              # waterfalls per forward pass, the quantized model is converted for eval_batch*f_factor patches
+nthreads = multiprocessing.cpu_count() # threads given to both the float32 session and the quantized interpreter
+max_f2_drop = 0.01           # largest F2 loss against the checkpoint that passes the regression check
+max_mcc_drop = 0.01          # largest MCC loss against the checkpoint that passes the regression check
+quant_file = os.path.splitext(frozen_file)[0]+'_'+quant_mode+'.tflite'
+
+if not os.path.exists(frozen_file):
+    raise ValueError("No frozen model found at "+frozen_file+", run exportDFCN.py first.")
+checkpoint,step = hf.latest_checkpoint('./'+model_name)
+if checkpoint is None:
+    raise ValueError("No Model Found. Quantization killed.")
+
+# The same 80/20 training/evaluation split of the simulated waterfalls as RFIDataset.load
+f = h5py.File(dset_file,'r')
+nwf = len(f['data'])
+train_end = int(nwf*.8)
+rng = np.random.RandomState(0)
+calib_inds = np.sort(rng.choice(train_end,size=min(calib_waterfalls,train_end),replace=False))
+calibration = hf.fold_batch(f['data'][list(calib_inds)],f_factor,pad_size,dtype=np.float32,nch=ch_input)
+
+start = time()
+model_content = hf.quantize_frozen_model(frozen_file,calibration,eval_batch*f_factor,mode=quant_mode)
+with open(quant_file,'wb') as qf:
+    qf.write(model_content)
+with open(quant_file+'.json','w') as qf:
+    json.dump({'frozen_model': frozen_file,
+               'mode': quant_mode,
+               'calibration_file': dset_file,
+               'calibration_patches': len(calibration),
+               'batch_size': eval_batch*f_factor,
+               'fold_factor': f_factor,
+               'pad_size': pad_size},qf,indent=1)
+print('Quantized {0} to {1} ({2}) in {3:.1f} s'.format(frozen_file,quant_file,quant_mode,time() - start))
+print('Model size {0:.2f} MB -> {1:.2f} MB'.format(os.path.getsize(frozen_file)/1e6,os.path.getsize(quant_file)/1e6))
+
+config = tf.ConfigProto(intra_op_parallelism_threads=nthreads,inter_op_parallelism_threads=1)
+# The baseline is the checkpoint as runDFCN.py and pipelineDFCN.py run it, with batch statistics
+with tf.Graph().as_default():
+    ckpt_input = tf.placeholder(tf.float32, shape=[None, None, None, ch_input])
+    mode_bn = tf.placeholder(tf.bool)
+    if chtypes == 'Amp':
+        ckpt_guess = AmpFCN(ckpt_input,mode_bn=mode_bn,d_out=0.)
+    elif chtypes == 'AmpPhs':
+        ckpt_guess = AmpPhsFCN(ckpt_input,mode_bn=mode_bn,d_out=0.)
+    saver = tf.train.Saver()
+    ckpt_sess = tf.Session(config=config)
+    ckpt_sess.run(tf.group(tf.global_variables_initializer(),tf.local_variables_initializer()))
+    saver.restore(ckpt_sess,checkpoint)
+sess,vis_input,RFI_guess = hf.load_frozen_model(frozen_file,config=config)
+quant = hf.QuantizedModel(quant_file,num_threads=nthreads)
+models = [('checkpoint',lambda batch_x: ckpt_sess.run(ckpt_guess,feed_dict={ckpt_input: batch_x,mode_bn: True})),
+          ('float32',lambda batch_x: sess.run(RFI_guess,feed_dict={vis_input: batch_x})),
+          (quant_mode,quant)]
+# Warm both paths up before timing
+warm = calibration[:eval_batch*f_factor]
+for name,run in models:
+    run(warm)
+
+# Confusion counts over the held out waterfalls, pooled, and the flags the quantized model changes
+counts = dict([(name,np.zeros(4)) for name,run in models])
+times = dict([(name,0.) for name,run in models])
+ndiff = 0
+nsamples = 0
+for i in range(train_end,nwf,eval_batch):
+    data = f['data'][i:i+eval_batch]
+    y_true = np.asarray(f['flag'][i:i+eval_batch]).astype(bool)
+    batch_x = hf.fold_batch(data,f_factor,pad_size,dtype=np.float32,nch=ch_input)
+    flags = {}
+    for name,run in models:
+        t0 = time()
+        g = run(batch_x)
+        times[name] += time() - t0
+        g = hf.unfoldl_batch(g.reshape(batch_x.shape[:3]+(-1,)),f_factor,pad_size)
+        flags[name] = np.argmax(g,axis=-1).astype(bool)
+        y_pred = flags[name]
+        counts[name] += [np.sum(y_true & y_pred),np.sum(~y_true & ~y_pred),np.sum(~y_true & y_pred),np.sum(y_true & ~y_pred)]
+    ndiff += np.sum(flags['checkpoint'] != flags[quant_mode])
+    nsamples += y_true.size
+f.close()
+sess.close()
+ckpt_sess.close()
+
+print('Held out waterfalls {0} to {1} of {2}'.format(train_end,nwf,dset_file))
+print('{0:10s} {1:>8s} {2:>8s} {3:>14s}'.format('','F2','MCC','waterfalls/s'))
+stats = {}
+for name,run in models:
+    tp,tn,fp,fn = counts[name]
+    stats[name] = (hf.f2(tp,tn,fp,fn),hf.MCC(tp,tn,fp,fn))
+    print('{0:10s} {1:8.4f} {2:8.4f} {3:14.1f}'.format(name,stats[name][0],stats[name][1],(nwf-train_end)/times[name]))
+print('Flags differing from the checkpoint: {0:.4f}%'.format(100.*ndiff/nsamples))
+f2_drop,mcc_drop,regressed = hf.accuracy_drop(counts['checkpoint'],counts[quant_mode],max_f2_drop,max_mcc_drop)
+if regressed:
+    print('Accuracy regression: F2 drop {0:.4f} (max {1}), MCC drop {2:.4f} (max {3})'.format(f2_drop,max_f2_drop,mcc_drop,max_mcc_drop))
+    sys.exit(1)
+print('Accuracy check passed: F2 drop {0:.4f}, MCC drop {1:.4f}'.format(f2_drop,mcc_drop))
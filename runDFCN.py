@@ -4,7 +4,6 @@ matplotlib.use("AGG")
 import matplotlib.pyplot as plt
 import numpy as np
 import tensorflow as tf
-from glob import glob
 import ml_rfi.helper_functions as hf
 from time import time
 import os
@@ -16,13 +15,13 @@ import h5py
 from ml_rfi.AmpModel import AmpFCN
 from ml_rfi.AmpPhsModel import AmpPhsFCN
 
-# Run on a single GPU
-os.environ["CUDA_VISIBLE_DEVICES"]="0"
-config = tf.ConfigProto()
-config.gpu_options.allow_growth = True
-
 args = sys.argv[1:]
 
+# Run on a single GPU, or on the CPU with a profile from tuneDFCN.py
+exec_profile = ''
+profile = hf.load_profile(exec_profile,device='gpu',gpu=0)
+config = hf.session_config(profile)
+
 stats = False
 waterfall_sample = False
 ROC = False
@@ -37,6 +36,38 @@ try:
     vdset = args[10]
 except:
     vdset = ''
+try:
+    stream_window = int(args[11])   # number of waterfalls held in memory, 0 loads everything
+except:
+    stream_window = 0
+try:
+    cache_dir = args[12]            # directory of the on-disk folded patch cache
+except:
+    cache_dir = None
+try:
+    ntowers = int(args[13])         # data-parallel training towers, one process and batch_size patches each
+except:
+    ntowers = 1
+try:
+    cluster_hosts = args[14].split(',') # host:port of one process per tower for multi-node training
+except:
+    cluster_hosts = []
+try:
+    task_index = int(args[15])      # this process's place in cluster_hosts, task 0 runs the training
+except:
+    task_index = 0
+tower_port = 2222                   # first localhost port of the tower processes started on this node
+target = ''
+if len(cluster_hosts) == 0 and ntowers > 1:
+    # Towers of one process would share its thread pools, so each gets a process of its own
+    cluster_hosts,config,tower_procs = hf.local_cluster(ntowers,config,port=tower_port)
+if len(cluster_hosts) > 0:
+    ntowers = len(cluster_hosts)
+    server = tf.train.Server(tf.train.ClusterSpec({'worker': cluster_hosts}),job_name='worker',task_index=task_index,config=config)
+    target = server.target
+    if task_index > 0:
+        # Only serves its tower's ops to task 0
+        server.join()
 tdset_type = 'Sim'        # type of training dataset used
 edset_type = 'Real'       # type of eval dataset used
 #mods = 'New'
@@ -48,11 +79,18 @@ pad_size = 16 #68
 ch_input = int(args[3])
 mode = args[4]
 expand = True
+augment = True               # augment batches as they are drawn instead of expanding the dataset up front
+prefetch_depth = 4           # number of training batches prepared ahead of the current step
+prefetch_workers = 2         # threads preparing training batches
+eval_batch = 16              # waterfalls folded into one forward pass in ensemble stats mode
+seed = 0                     # seed of all the dataset's randomness (split, expansion, batches, augmentation), None draws a fresh one
+sim_workers = 2              # simulator processes when training on the 'synthetic' dataset
+trace_steps = []             # training steps traced per layer with RunMetadata, e.g. range(100,110); none costs nothing
+keep_checkpoints = 5         # most recent checkpoints kept, besides the one with the best eval F1
 patchwise_train = False #np.logical_not(bool(args[5]))
 hybrid=bool(args[5])
 chtypes=args[6]
 model_name = chtypes+FCN_version+tdset_type+edset_type+tdset_version+'_'+'64'+'BSize'+mods
-model_dir = glob("./"+model_name+"/model_*")
 if hybrid:
     cut = False
     f_factor = 16
@@ -60,14 +98,13 @@ else:
     cut = False
     f_factor = 16#16
 
-try:
-    models2sort = [int(model_dir[i].split('/')[2].split('.')[0].split('_')[1]) for i in range(len(model_dir))]
-    model_ind = np.argmax(models2sort)
-    model = 'model_'+str(models2sort[model_ind])+'.ckpt'
-    start_step = int(model.split('_')[1].split('.ckpt')[0])
-    print(model)
-except:
-    start_step = 0
+# Newest checkpoint, from the model directory's index
+checkpoint,start_step = hf.latest_checkpoint('./'+model_name)
+if checkpoint is not None:
+    print(checkpoint)
+    if os.path.exists(checkpoint+'.sampler.npz') and hf.saved_seed(checkpoint+'.sampler.npz') is not None:
+        # The same split and expansion as the run being resumed, whose batches then continue
+        seed = hf.saved_seed(checkpoint+'.sampler.npz')
 
 print('Starting training at step %i' % start_step)
 
@@ -76,13 +113,22 @@ mode_bn = tf.placeholder(tf.bool)
 d_out = tf.placeholder(tf.float32)
 kernel_size = tf.placeholder(tf.int32)
 
+RFI_targets = tf.placeholder(tf.int32, shape=[None,None])#(2*(pad_size+2)+60)*(2*pad_size+1024/f_factor)])
+learn_rate = tf.placeholder(tf.float32, shape=[1])
+optimizer_gen = tf.train.AdamOptimizer(learning_rate=learn_rate[0])
+
 # Initialize Network
 if chtypes == 'Amp':
-    RFI_guess = AmpFCN(vis_input,mode_bn=mode_bn,d_out=d_out)
+    FCN = AmpFCN
 elif chtypes == 'AmpPhs':
-    RFI_guess = AmpPhsFCN(vis_input,mode_bn=mode_bn,d_out=d_out)
-RFI_targets = tf.placeholder(tf.int32, shape=[None,None])#(2*(pad_size+2)+60)*(2*pad_size+1024/f_factor)])
-learn_rate = tf.placeholder(tf.float32, shape=[1])
+    FCN = AmpPhsFCN
+if ntowers > 1:
+    # Every tower trains on its block of the batch, drawn from its own shard of the training
+    # indices, gradients are averaged before Adam applies them
+    RFI_guess,train_fcn = hf.data_parallel_model(FCN,vis_input,RFI_targets,optimizer_gen,hf.tower_devices(cluster_hosts),
+                                                 mode_bn=mode_bn,d_out=d_out)
+else:
+    RFI_guess = FCN(vis_input,mode_bn=mode_bn,d_out=d_out)
 
 # Output statistics and metrics
 argmax = tf.argmax(RFI_guess,axis=-1)
@@ -91,6 +137,8 @@ precision = tf.metrics.precision(labels=RFI_targets,predictions=argmax)
 batch_accuracy = hf.batch_accuracy(RFI_targets,argmax)
 f1 = 2.*precision[0]*recall[0]/(precision[0]+recall[0])
 f1 = tf.where(tf.is_nan(f1),tf.zeros_like(f1),f1)
+# Unfolded logits, flags and logit difference, fetched with RFI_guess
+post = hf.prediction_ops(RFI_guess,vis_input,f_factor,pad_size)
 loss = tf.losses.sparse_softmax_cross_entropy(labels=RFI_targets,logits=RFI_guess)
 
 # Add metrics to summary
@@ -101,10 +149,14 @@ tf.summary.scalar('F1',f1)
 tf.summary.scalar('batch_accuracy',batch_accuracy)
 summary = tf.summary.merge_all()
 
-optimizer_gen = tf.train.AdamOptimizer(learning_rate=learn_rate[0])
-fcn_vars = tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, scope='FCN')
-train_fcn = optimizer_gen.minimize(loss, var_list=fcn_vars)
+if ntowers == 1:
+    fcn_vars = tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, scope='FCN')
+    # Batch norm moving statistics are updated with every step, the frozen model folds them
+    with tf.control_dependencies(tf.get_collection(tf.GraphKeys.UPDATE_OPS)):
+        train_fcn = optimizer_gen.minimize(loss, var_list=fcn_vars)
 
+# Checkpoints are written in the background from a snapshot of the variables
+ckpt_manager = hf.CheckpointManager('./'+model_name,keep_last=keep_checkpoints)
 # Initialize the variables (i.e. assign their default value)                                                                                      
 init = tf.group(tf.global_variables_initializer(),tf.local_variables_initializer())
 # Save variables                                                                                                                                  
@@ -112,34 +164,45 @@ saver = tf.train.Saver()
 
 # Load dataset
 dset = hf.RFIDataset()
-dset_start_time = time()
-dset.load(tdset_version,vdset,batch_size,pad_size,hybrid=hybrid,chtypes=chtypes,fold_factor=f_factor,cut=cut,patchwise_train=patchwise_train,expand=expand)
-dset_load_time = (time() - dset_start_time)/dset.get_size() # per visibility
+dset.load(tdset_version,vdset,batch_size*ntowers,pad_size,hybrid=hybrid,chtypes=chtypes,fold_factor=f_factor,cut=cut,patchwise_train=patchwise_train,expand=expand,stream=stream_window > 0,window=stream_window,cache_dir=cache_dir,augment=augment,seed=seed,sim_workers=sim_workers,shards=ntowers)
 
-with tf.Session(config=config) as sess:    
+with tf.Session(target,config=config) as sess:    
     # Run the initializer                                                                                                                         
     sess.run(init)
     # Check to see if model exists                                                                                                                 
-    if len(model_dir) > 0:
+    if checkpoint is not None:
         print('Model exists. Loading last save.')
-        saver.restore(sess, './'+model_name+'/'+model)
-        print('Model '+'./'+model_name+'/'+model + ' loaded.')
+        # Also continues the batch order of the run that saved the checkpoint
+        ckpt_manager.restore(sess,saver,dataset=dset)
+        print('Model '+checkpoint + ' loaded.')
+        print('Resuming at training epoch {0}.'.format(dset.train_sampler.epoch))
     else:
         print('No Model Found.')
+    # Nothing may add ops from here on, so the graph and step time stay constant
+    sess.graph.finalize()
+    print('Graph ops: {0}'.format(len(sess.graph.get_operations())))
+    profiler = hf.LayerProfiler(trace_steps,'./'+model_name+'_profile/',graph=sess.graph)
     if mode == 'train':
         # Run training only session
         train_writer = tf.summary.FileWriter('./'+model_name+'_train/',sess.graph)
         lr = np.array([0.003])
+        train_queue = dset.prefetcher(depth=prefetch_depth,workers=prefetch_workers)
         for i in range(start_step, start_step+num_steps+1):
             # Prepare Input Data                                                                                                                  
-            batch_x, batch_targets = dset.next_train()
+            with hf.stage('train/batch_wait'):
+                batch_x, batch_targets = train_queue.next()
             # Training                                                                                                                           
             feed_dict = {vis_input: batch_x, RFI_targets: batch_targets,
                          learn_rate: lr, mode_bn: True, d_out: dropout}
-            _,loss_,s1,rec,pre,f1_,ba = sess.run([train_fcn,loss,summary,recall,precision,f1,batch_accuracy],feed_dict=feed_dict)
+            run_kwargs = profiler.options(i)
+            with hf.stage('train/step'):
+                _,loss_,s1,rec,pre,f1_,ba = sess.run([train_fcn,loss,summary,recall,precision,f1,batch_accuracy],feed_dict=feed_dict,**run_kwargs)
+            profiler.collect(i,run_kwargs)
             if i % 20 == 0:
                 # Save metrics every 20 steps
                 train_writer.add_summary(s1,i)
+                train_writer.add_summary(tf.Summary(value=[tf.Summary.Value(tag='input_bound_fraction',simple_value=train_queue.input_bound_fraction())]),i)
+                hf.instruments.add_summaries(train_writer,i)
                 train_writer.flush()
             if i % 100 == 0 or i == 1:
                 # Output to terminal every 100 steps
@@ -148,51 +211,74 @@ with tf.Session(config=config) as sess:
                 print('Precision: {0}'.format(pre[0]))
                 print('F1: {0}'.format(f1_))
                 print('RFI Class Accuracy: {0}'.format(ba))
+                print('Epoch: {0}'.format(dset.train_sampler.epoch))
+                print('Input-bound fraction: {0:.3f}'.format(train_queue.input_bound_fraction()))
+                train_step = hf.instruments.get('train/step')
+                print('Training throughput: {0:.1f} patches/s on {1} towers'.format(dset.batch_size*train_step.count/train_step.total,ntowers))
+                if dset.synthetic_stream is not None:
+                    sim_stats = dset.synthetic_stream.stats()
+                    print('Simulated {0} waterfalls: {1:.1f}/s per core, {2:.1f}/s total, {3} windows reused'.format(
+                        sim_stats['waterfalls'],sim_stats['per_core'],sim_stats['total'],sim_stats['reused_windows']))
             if i % 1000 == 0 and i != 0:
                 # Save model every 1000 steps
                 print('Saving model...')
-                save_path = saver.save(sess,'./'+model_name+'/model_%i.ckpt' % i)
+                with hf.stage('train/save'):
+                    # Blocks only for the variable snapshot, the files are written while training goes on.
+                    # The state from before the batches still queued, so a resumed run draws them again
+                    ckpt_manager.save(sess,i,metrics={'train_f1': f1_},samplers=dset.sampler_state(train_queue.pending_state()))
+                hf.instruments.save('./'+model_name+'_train/stages.json')
+        train_queue.stop()
+        ckpt_manager.wait()
+        if profiler.nsteps > 0:
+            print(profiler.summary())
     elif mode == 'eval':
         # Run evaluation only session
         eval_writer = tf.summary.FileWriter('./'+model_name+'_eval_'+vdset+'/',sess.graph)
         for i in range(start_step, start_step+num_steps+1):
             batch_x, batch_targets = dset.next_eval()
             feed_dict = {vis_input: batch_x, RFI_targets: batch_targets, mode_bn: True}
-            eval_class,rec,pre,f1_,s1,loss_ = sess.run([RFI_guess,recall,precision,f1,summary,loss],feed_dict=feed_dict)
+            with hf.stage('eval/step'):
+                eval_class,rec,pre,f1_,s1,loss_,acc = sess.run([RFI_guess,recall,precision,f1,summary,loss,batch_accuracy],feed_dict=feed_dict)
             print('recall: {0} precision: {1} f1: {2} '.format(rec,pre,f1_))
             if i % 10 == 0:
                 # Output to terminal every 10 steps
-                if 'acc' not in globals():
-                    acc = 0.
                 print('F1: {0}'.format(f1_))
                 print('Recall: {0}'.format(rec))
                 print('Precision: {0}'.format(pre))
-                acc = hf.batch_accuracy(batch_targets,tf.argmax(eval_class,axis=-1)).eval()
                 print('RFI Class Accuracy: {0}'.format(acc))
             if i % 20 == 0:
                 # Add metrics to summary and flush
                 eval_writer.add_summary(s1,i)
+                hf.instruments.add_summaries(eval_writer,i)
                 eval_writer.flush()
     elif mode == 'traineval':
         # Preferred mode, where training and evaluation happens concurrently, saving
         # summary statistics for both training and evaluation modes
-        batch_init = np.copy(batch_size)
+        batch_init = np.copy(batch_size*ntowers)
         lr = np.array([0.0003])
         train_writer = tf.summary.FileWriter('./'+model_name+'_train/',sess.graph)
         eval_writer = tf.summary.FileWriter('./'+model_name+'_eval_'+vdset+'/',sess.graph)
+        train_queue = dset.prefetcher(depth=prefetch_depth,workers=prefetch_workers)
         for i in range(start_step, start_step+num_steps+1):
-            batch_x_train, batch_targets_train = dset.next_train()
+            with hf.stage('train/batch_wait'):
+                batch_x_train, batch_targets_train = train_queue.next()
             feed_dict_train = {vis_input: batch_x_train, RFI_targets: batch_targets_train,
                                                   learn_rate: lr, mode_bn: True}
-            _,loss_,strain,rec,pre,f1_train,ba = sess.run([train_fcn,loss,summary,recall,precision,f1,batch_accuracy],feed_dict=feed_dict_train)
+            run_kwargs = profiler.options(i)
+            with hf.stage('train/step'):
+                _,loss_,strain,rec,pre,f1_train,ba = sess.run([train_fcn,loss,summary,recall,precision,f1,batch_accuracy],feed_dict=feed_dict_train,**run_kwargs)
+            profiler.collect(i,run_kwargs)
             if i % 20 == 0:
                 # Add training stats to summary and then roll into evaluation and do the same
                 train_writer.add_summary(strain,i)
+                train_writer.add_summary(tf.Summary(value=[tf.Summary.Value(tag='input_bound_fraction',simple_value=train_queue.input_bound_fraction())]),i)
+                hf.instruments.add_summaries(train_writer,i)
                 train_writer.flush()
 
                 batch_x_eval, batch_targets_eval = dset.next_eval()
                 feed_dict_eval = {vis_input: batch_x_eval, RFI_targets: batch_targets_eval, mode_bn: True}
-                eval_class,rec,pre,f1_eval,seval = sess.run([RFI_guess,recall,precision,f1,summary],feed_dict=feed_dict_eval)
+                with hf.stage('eval/step'):
+                    eval_class,rec,pre,f1_eval,seval = sess.run([RFI_guess,recall,precision,f1,summary],feed_dict=feed_dict_eval)
                 eval_writer.add_summary(seval,i)
                 eval_writer.flush()
                 
@@ -202,22 +288,47 @@ with tf.Session(config=config) as sess:
                 print('Eval F1 : %.9f' % f1_eval)
                 print('Recall: {0}'.format(rec[0]))
                 print('Precision: {0}'.format(pre[0]))
+                print('Input-bound fraction: {0:.3f}'.format(train_queue.input_bound_fraction()))
             if i % 5000 == 0 and i != 0:
                 # Save model every 1000 steps
                 print('Saving model...')
-                save_path = saver.save(sess,'./'+model_name+'/model_%i.ckpt' % i)
-                psize = np.random.choice([16,32])
-                fold_factor = np.random.choice([8,16,32])                
+                with hf.stage('train/save'):
+                    # Blocks only for the variable snapshot, the files are written while training goes on.
+                    # The state from before the batches still queued, so a resumed run draws them again
+                    ckpt_manager.save(sess,i,metrics={'f1': f1_eval,'train_f1': f1_train},samplers=dset.sampler_state(train_queue.pending_state()))
+                hf.instruments.save('./'+model_name+'_train/stages.json')
+                if dset.reload_thread is not None:
+                    # The previous generation is still building, finish it first
+                    train_queue.stop(rewind=True)
+                    dset.swap_reload()
+                    train_queue = dset.prefetcher(depth=prefetch_depth,workers=prefetch_workers)
+                # From the reload RandomState, which the prefetch threads never draw from
+                psize,fold_factor = dset.draw_geometry([16,32],[8,16,32])
                 print('Using a fold factor of {0} and padding size of {1}'.format(fold_factor,psize))
                 print('Changing input dimensions to {0} x {1}'.format(64+2*psize,2*psize + 1024/fold_factor))
                 print('Subsampling time but padding back to 60 time ints.')
-                dset.reload(fold_factor,psize,time_subsample=True)
+                # Training carries on with the current dataset while the next one is built
+                dset.reload_async(fold_factor,psize,time_subsample=True)
             if i % 5000 == 0 and i != 0:
                 # Optional increasing/decreasing batch size, preferred over decreasing learning rate
                 # See https://arxiv.org/abs/1711.00489
                 batch_init = int(batch_init*2)
                 dset.change_batch_size(new_bs=batch_init)
                 print('Decreasing batch size to {0}'.format(batch_init))
+                # Batches already drawn are drawn again at the new size
+                train_queue.stop(rewind=True)
+                train_queue = dset.prefetcher(depth=prefetch_depth,workers=prefetch_workers)
+            if dset.reload_ready():
+                # Swap generations at the step boundary, queued batches have the old input dimensions
+                train_queue.stop(rewind=True)
+                swap_time,build_time,both_nbytes = dset.swap_reload()
+                print('Step {0}: swapped in dataset built in {1:.1f} s, swap took {2:.3f} s'.format(i,build_time,swap_time))
+                print('Memory held by both dataset generations: {0:.1f} MB'.format(both_nbytes/1e6))
+                train_queue = dset.prefetcher(depth=prefetch_depth,workers=prefetch_workers)
+        train_queue.stop()
+        ckpt_manager.wait()
+        if profiler.nsteps > 0:
+            print(profiler.summary())
     else:
         # If no mode is specified it jumps into ensemble stats mode which is for understanding
         # how well the network performs on non-simulated data
@@ -260,83 +371,80 @@ with tf.Session(config=config) as sess:
         _MCC_ARR = []
         _F2_ARR = []
         best_thresh_arr = []
-        ps = 96
-        while ct != 18:
-            data_, batch_x, batch_targets = dset.next_predict()
+        # Ensemble ROC over every predicted waterfall
+        roc_all = hf.ROCAccumulator()
+        pred_times = []
+        if chtypes == 'AmpPhs':
+            thresh = 0.329#0.62 #0.329 real #0.08 sim 
+        else:
+            thresh = 0.452#0.385 #0.385 real #0.126 sim
+        # Whole evaluation set in order, eval_batch waterfalls per forward pass
+        for data_b, batch_x, batch_targets in dset.iter_predict(eval_batch):
             pred_start = time()
-            g = sess.run(RFI_guess, feed_dict={vis_input: batch_x, mode_bn: True})
-            #print('Current Visibility: {0}'.format(ct))            
-            pred_unfold = hf.unfoldl(tf.reshape(tf.argmax(g,axis=-1),[16,ps,ps]).eval(),padding=16)
-            #pred_unfold = hf.unfoldl(tf.reshape(g[:,:,1],[16,68,68]).eval())
-            pred_unfold_0 = hf.unfoldl(tf.reshape(g[:,:,0],[16,ps,ps]).eval(),padding=16)
-            pred_unfold_1 = hf.unfoldl(tf.reshape(g[:,:,1],[16,ps,ps]).eval(),padding=16)
-            pred_unfold_ = np.stack((pred_unfold_0,pred_unfold_1),axis=-1)
-            pred_time = time() - pred_start
-            target_unfold = hf.unfoldl(batch_targets.reshape(16,ps,ps),padding=16)
-            if chtypes == 'AmpPhs':
-                thresh = 0.329#0.62 #0.329 real #0.08 sim 
-            else:
-                thresh = 0.452#0.385 #0.385 real #0.126 sim
-            y_true = target_unfold[:,64*ci_1:1024-64*ci_2].reshape(-1)
-            y_pred = pred_unfold[:,64*ci_1:1024-64*ci_2].reshape(-1)
+            with hf.stage('predict/forward'):
+                flags_,logits_,logit_diff_ = sess.run([post['flags'],post['logits'],post['logit_diff']], feed_dict={vis_input: batch_x, mode_bn: True})
+            pred_time = (time() - pred_start)/len(data_b)
+            pred_times.append(pred_time)
+            target_unfold_b = hf.unfoldl_batch(batch_targets,f_factor,pad_size)
+            band = slice(64*ci_1,np.shape(target_unfold_b)[-1]-64*ci_2)
+            y_true = target_unfold_b[:,:,band].astype(bool)
+            y_pred = flags_[:,:,band].astype(bool)
 #            y_pred = hf.hard_thresh(pred_unfold[:,64*ci_1:1024-64*ci_2],thresh=thresh).reshape(-1)
 
-            try:
-                # Build confusion matrix
-                confusion_pred = confusion_matrix(y_true,y_pred.astype(int))
-                if np.shape(confusion_pred) == 1:
-                    tn = confusion_pred[0][0]
-                    fn = 1e-10
-                    tp = 1e-10
-                    fp = 1e-10
-                else:
-                    tn, fp, fn, tp = confusion_pred.ravel()
-            except:
-                ind+=1
-                continue
-            data_flux = np.abs(data_[:,64*ci_1:1024-64*ci_2])
-            targets_ = target_unfold.reshape(-1,1024)[:,64*ci_1:1024-64*ci_2]
-            #predicts_ = hf.unfoldl(tf.reshape(g[:,:,1],[16,68,68]).eval()).reshape(-1,1024)[:,64*ci_1:1024-64*ci_2]
-            predicts_0 = hf.unfoldl(tf.reshape(g[:,:,0],[16,ps,ps]).eval(),padding=16).reshape(-1,1024)[:,64*ci_1:1024-64*ci_2]
-            predicts_1 = hf.unfoldl(tf.reshape(g[:,:,1],[16,ps,ps]).eval(),padding=16).reshape(-1,1024)[:,64*ci_1:1024-64*ci_2]
-            predicts_ = predicts_1-predicts_0#np.where(predicts_1>predicts_0,predicts_1,0.)
+            # Per-waterfall confusion counts and stats for the whole batch
+            tp = 1.*np.sum(y_true & y_pred,axis=(1,2))
+            tn = 1.*np.sum(~y_true & ~y_pred,axis=(1,2))
+            fp = 1.*np.sum(~y_true & y_pred,axis=(1,2))
+            fn = 1.*np.sum(y_true & ~y_pred,axis=(1,2))
+            # Waterfalls with a single class present have no 2x2 confusion matrix and are skipped
+            valid = (tp+fp+fn > 0) & (tn+fp+fn > 0)
+            with np.errstate(divide='ignore',invalid='ignore'):
+                tpr = tp/(tp+fn) #recall
+                fpr = tp/(tp+fp) #precision/pos predictive value
+                npv = tn/(tn+fn) #neg predictive value
+                mcc = np.where((tp == 0) & (fn == 0),tp*tn - fp*fn,(tp*tn - fp*fn)/np.sqrt((tp+fp)*(tp+fn)*(tn+fp)*(tn+fn)))
+                acc = (tp+tn)/(tp+tn+fp+fn)
+                f2 = 5.*tpr*fpr/(4.*fpr + tpr)
             tp_sum = 1.#np.sum(np.where(targets_+predicts_ == 2,data_flux,np.zeros_like(data_flux)))
             fn_sum = 1.#np.sum(np.where(targets_-predicts_ == 1,data_flux,np.zeros_like(data_flux)))
-            tpr = tp/(1.*(tp+fn)) #recall
-            fpr = tp/(1.*(tp+fp)) #precision/pos predictive value
-            npv = tn/(1.*(tn+fn)) #neg predictive value
-            mcc = hf.MCC(tp,tn,fp,fn)
-            acc = (tp+tn)/(1.*(tp+tn+fp+fn))
-            print('tp: {0} tn: {1} fp: {2} fn: {3}'.format(tp,tn,fp,fn))
-            print('MCC: {}'.format(hf.MCC(tp,tn,fp,fn)))
-            ident_flux.append(tp_sum)
-            missed_flux.append(fn_sum)
-            fpr_arr.append(fpr)
-            tpr_arr.append(tpr)
-            npv_arr.append(npv)
-            mcc_arr.append(mcc)
-            acc_arr.append(acc)
-            f2_arr.append(5.*tpr*fpr/(4.*fpr + tpr))
-            # Save individual visibility samples that have been predicted on
-            if waterfall_sample:
-                np.savez('Real_{0}_SamplePredict_{1}.npz'.format(chtypes,ct),data=data_,target=target_unfold,prediction=pred_unfold_,f2=5.*tpr*fpr/(4.*fpr + tpr),recall=tpr,precision=fpr)
-#            np.savez('{0}_SamplePredict.npz'.format(chtypes),data=data_,target=target_unfold,prediction=hf.hard_thresh(pred_unfold,thresh=thresh),f2=5.*tpr*fpr/(4.*fpr + tpr),recall=tpr,precision=fpr)
-
-            ind+=1
-            ct+=1
-            if stats:
-                FPR_,TPR_,MCC_,F2_,best_thresh = hf.ROC_stats(targets_,predicts_.reshape(1,-1))
-                _FPR_ARR.append(FPR_)
-                _TPR_ARR.append(TPR_)
-                _MCC_ARR.append(MCC_)
-                _F2_ARR.append(F2_)
-                best_thresh_arr.append(best_thresh)
-                np.savez('ROC_curves_newSim_{0}.npz'.format(chtypes),TPR=_TPR_ARR,FPR=_FPR_ARR,MCC=_MCC_ARR,F2=_F2_ARR,best_thresh=np.nanmedian(best_thresh_arr))
+            ident_flux.extend([tp_sum]*int(np.sum(valid)))
+            missed_flux.extend([fn_sum]*int(np.sum(valid)))
+            fpr_arr.extend(fpr[valid])
+            tpr_arr.extend(tpr[valid])
+            npv_arr.extend(npv[valid])
+            mcc_arr.extend(mcc[valid])
+            acc_arr.extend(acc[valid])
+            f2_arr.extend(f2[valid])
+            ind += len(data_b)
+            for k in np.where(valid)[0]:
+                print('tp: {0} tn: {1} fp: {2} fn: {3}'.format(tp[k],tn[k],fp[k],fn[k]))
+                print('MCC: {}'.format(mcc[k]))
+                # Save individual visibility samples that have been predicted on
+                if waterfall_sample:
+                    np.savez('Real_{0}_SamplePredict_{1}.npz'.format(chtypes,ct),data=data_b[k],target=target_unfold_b[k],prediction=logits_[k],f2=f2[k],recall=tpr[k],precision=fpr[k])
+                ct+=1
+                if stats:
+                    targets_ = target_unfold_b[k][:,band]
+                    predicts_ = logit_diff_[k][:,band]
+                    FPR_,TPR_,MCC_,F2_,best_thresh = hf.ROC_stats(targets_,predicts_.reshape(1,-1))
+                    _FPR_ARR.append(FPR_)
+                    _TPR_ARR.append(TPR_)
+                    _MCC_ARR.append(MCC_)
+                    _F2_ARR.append(F2_)
+                    best_thresh_arr.append(best_thresh)
+                    roc_all.update(targets_,predicts_)
+            if stats and len(best_thresh_arr) > 0:
+                FPR_all,TPR_all,MCC_all,F2_all,best_thresh_all = roc_all.stats()
+                np.savez('ROC_curves_newSim_{0}.npz'.format(chtypes),TPR=_TPR_ARR,FPR=_FPR_ARR,MCC=_MCC_ARR,F2=_F2_ARR,best_thresh=np.nanmedian(best_thresh_arr),
+                         TPR_all=TPR_all,FPR_all=FPR_all,MCC_all=MCC_all,F2_all=F2_all,best_thresh_all=best_thresh_all)
+        print('Evaluated {0} of {1} waterfalls'.format(ct,ind))
 
         print('Accuracy: {0}'.format(np.nanmean(acc_arr)))
         print('Precision: {0}'.format(np.nanmean(fpr_arr)))
         print('Recall: {0}'.format(np.nanmean(tpr_arr)))
         print('F2: {0}'.format(np.nanmean(f2_arr)))
+        print('Graph ops: {0}, prediction latency first/last 5 waterfalls: {1:.4f}/{2:.4f} s'.format(
+            len(sess.graph.get_operations()),np.median(pred_times[:5]),np.median(pred_times[-5:])))
         
         if ROC:
             #        try:
@@ -362,4 +470,9 @@ with tf.Session(config=config) as sess:
                 mname['Identified Flux'][...] = ident_flux
                 mname['Missed Flux'][...] = missed_flux
                 f.close()
-        print('Prediction pipeline time per waterfall visibility: {0}'.format(pred_time+dset_load_time))
+        # Loading is shared by the whole dataset, inference by the waterfalls predicted
+        load_time = hf.instruments.get('dataset/load').total/dset.get_size()
+        forward_time = hf.instruments.get('predict/forward').total/max(1,ind)
+        print('Prediction pipeline time per waterfall visibility: {0}'.format(load_time+forward_time))
+    print(hf.instruments.summary())
+    hf.instruments.save('./'+model_name+'_'+mode+'_stages.json')
@@ -0,0 +1,109 @@
+from __future__ import division, print_function, absolute_import
+import numpy as np
+import tensorflow as tf
+import ml_rfi.helper_functions as hf
+from time import time
+import multiprocessing
+import platform
+import json
+import sys
+from ml_rfi.AmpModel import AmpFCN
+from ml_rfi.AmpPhsModel import AmpPhsFCN
+
+args = sys.argv[1:]
+
+# Arguments order chtypes batch_size out_file
+try:
+    chtypes = args[0]
+except:
+    chtypes = 'AmpPhs'
+try:
+    batch_size = int(args[1])   # patches per tower and step, as runDFCN.py
+except:
+    batch_size = 32
+try:
+    out_file = args[2]
+except:
+    out_file = 'scaling.json'
+if chtypes == 'AmpPhs':
+    ch_input = 2
+    FCN = AmpPhsFCN
+else:
+    ch_input = 1
+    FCN = AmpFCN
+patch_shape = (96,96) # fold_factor 16 and pad_size 16 patches
+warmup_steps = 3
+timed_steps = 10
+seed = 0
+tower_port = 2222
+ncpu = multiprocessing.cpu_count()
+tower_counts = [n for n in [1,2,4,8,16,32] if n <= ncpu]
+
+def step_rate(ntowers):
+    """
+    Training steps of runDFCN.py's graph with ntowers data-parallel towers on random patches,
+    one process per tower as runDFCN.py starts them, the cores split between the towers.
+    Output: patches per second
+    """
+    profile = hf.load_profile(device='cpu',intra_op_threads=ncpu)
+    config = hf.session_config(profile)
+    target = ''
+    if ntowers > 1:
+        cluster_hosts,config,tower_procs = hf.local_cluster(ntowers,config,port=tower_port)
+        server = tf.train.Server(tf.train.ClusterSpec({'worker': cluster_hosts}),job_name='worker',task_index=0,config=config)
+        target = server.target
+    tf.set_random_seed(seed)
+    vis_input = tf.placeholder(tf.float32, shape=[None,None,None,ch_input])
+    mode_bn = tf.placeholder(tf.bool)
+    RFI_targets = tf.placeholder(tf.int32, shape=[None,None])
+    optimizer = tf.train.AdamOptimizer(learning_rate=0.0003)
+    if ntowers > 1:
+        RFI_guess,train_op = hf.data_parallel_model(FCN,vis_input,RFI_targets,optimizer,hf.tower_devices(cluster_hosts),mode_bn=mode_bn,d_out=0.)
+    else:
+        RFI_guess = FCN(vis_input,mode_bn=mode_bn,d_out=0.)
+        loss = tf.losses.sparse_softmax_cross_entropy(labels=RFI_targets,logits=RFI_guess)
+        train_op = optimizer.minimize(loss,var_list=tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES,scope='FCN'))
+    rng = np.random.RandomState(seed)
+    nbatch = batch_size*ntowers
+    feed_dict = {vis_input: rng.randn(nbatch,patch_shape[0],patch_shape[1],ch_input).astype(np.float32),
+                 RFI_targets: (rng.rand(nbatch,patch_shape[0]*patch_shape[1]) > 0.95).astype(np.int32),
+                 mode_bn: True}
+    sess = tf.Session(target,config=config)
+    sess.run(tf.global_variables_initializer())
+    sess.graph.finalize()
+    for i in range(warmup_steps):
+        sess.run(train_op,feed_dict=feed_dict)
+    t0 = time()
+    for i in range(timed_steps):
+        sess.run(train_op,feed_dict=feed_dict)
+    return nbatch*timed_steps/(time() - t0)
+
+def queue_step_rate(out,ntowers):
+    out.put(step_rate(ntowers))
+
+def isolated_step_rate(ntowers):
+    # A fresh process per setting, so thread pools and OMP_NUM_THREADS start clean. Not a
+    # pool worker, which could not start the tower processes
+    out = multiprocessing.Queue()
+    proc = multiprocessing.Process(target=queue_step_rate,args=(out,ntowers))
+    proc.start()
+    rate = out.get()
+    proc.join()
+    return rate
+
+if __name__ == '__main__':
+    print('Data-parallel training of {0}FCN on {1} CPUs, {2} patches per tower'.format(chtypes,ncpu,batch_size))
+    print('towers   patches/s   speedup   efficiency')
+    results = []
+    for ntowers in tower_counts:
+        rate = isolated_step_rate(ntowers)
+        speedup = rate/results[0]['patches_per_s'] if len(results) > 0 else 1.
+        # Weak scaling: the ideal n towers train n times the patches of one in the same time
+        results.append({'towers': ntowers,'patches_per_s': rate,'speedup': speedup,'efficiency': speedup/ntowers})
+        print('{0:6d} {1:11.1f} {2:9.2f} {3:12.2f}'.format(ntowers,rate,speedup,speedup/ntowers))
+    with open(out_file,'w') as f:
+        json.dump({'chtypes': chtypes,
+                   'batch_size': batch_size,
+                   'machine': {'hostname': platform.node(),'processor': platform.processor(),'cpu_count': ncpu},
+                   'results': results},f,indent=1)
+    print('Results saved to '+out_file)
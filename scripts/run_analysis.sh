@@ -1,4 +1,4 @@
-# Arguments order Tdset_vers FCN_vers batch size ch_input mode hybrid chtypes dropouts ksize steps datatype
+# Arguments order Tdset_vers FCN_vers batch size ch_input mode hybrid chtypes dropouts ksize steps datatype stream_window cache_dir
 # list of anyalyses to run
 
 analysis='tversion' # runs model training/eval for Amp & Amp-Phs
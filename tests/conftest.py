@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The ml_rfi modules import each other by module name, as the scripts load them
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),'ml_rfi'))
@@ -0,0 +1,35 @@
+import os
+import pytest
+
+pytest.importorskip('tensorflow')
+from checkpoint import CheckpointManager
+
+class IndexOnlyManager(CheckpointManager):
+    def __init__(self,model_dir,keep_last,steps,best=None):
+        """
+        The index and files of saved checkpoints, without the graph and saver.
+        """
+        self.model_dir = model_dir
+        self.keep_last = keep_last
+        self.index = {'latest': max(steps),'best': best,'best_metric': 'f1','checkpoints': {}}
+        for step in steps:
+            filename = 'model_%i.ckpt' % step
+            self.index['checkpoints'][str(step)] = {'file': filename,'step': step,'time': 0.,'metrics': {}}
+            for ext in ['.index','.data-00000-of-00001','.sampler.npz']:
+                open(os.path.join(model_dir,filename+ext),'w').close()
+
+def saved_steps(model_dir):
+    return sorted(set([int(f.split('.')[0].split('_')[1]) for f in os.listdir(model_dir)]))
+
+@pytest.mark.parametrize('keep_last,best,kept',[(3,None,[5,6,7]),
+                                                (3,2,[2,5,6,7]),
+                                                (3,6,[5,6,7]),
+                                                (10,None,[1,2,3,4,5,6,7]),
+                                                (0,2,[2]),
+                                                (0,None,[7])])
+def test_retain(tmpdir,keep_last,best,kept):
+    manager = IndexOnlyManager(str(tmpdir),keep_last,[1,2,3,4,5,6,7],best=best)
+    manager.retain()
+    assert sorted([c['step'] for c in manager.index['checkpoints'].values()]) == kept
+    assert saved_steps(str(tmpdir)) == kept
+    assert len(os.listdir(str(tmpdir))) == 3*len(kept)
@@ -0,0 +1,229 @@
+import os
+import time
+import h5py
+import numpy as np
+import pytest
+import dataset
+from dataset import PatchCache,EpochSampler
+from preprocessing import fold_waterfalls
+
+def write_source(filename,n,seed=0):
+    rng = np.random.RandomState(seed)
+    with h5py.File(filename,'w') as f:
+        f.create_dataset('data',data=(rng.randn(n,60,1024) + 1j*rng.randn(n,60,1024)).astype(np.complex64),maxshape=(None,60,1024))
+        f.create_dataset('flag',data=(rng.rand(n,60,1024) > 0.9).astype(np.uint8),maxshape=(None,60,1024))
+
+def touch(filename):
+    # The size and mtime signature must change even within the clock's resolution
+    st = os.stat(filename)
+    os.utime(filename,(st.st_atime,st.st_mtime+10))
+
+@pytest.fixture
+def folded(monkeypatch):
+    """
+    Counts the waterfalls PatchCache folds.
+    """
+    counts = []
+    def counting_fold(data,labels,*args,**kwargs):
+        counts.append(len(data))
+        return fold_waterfalls(data,labels,*args,**kwargs)
+    monkeypatch.setattr(dataset,'fold_waterfalls',counting_fold)
+    return counts
+
+def open_cache(filename,cache_dir):
+    f = h5py.File(filename,'r')
+    cache = PatchCache(f,16,16,'AmpPhs',cache_dir=cache_dir,chunk_size=4)
+    return f,cache
+
+def assert_matches_source(f,cache):
+    data,labels = fold_waterfalls(f['data'][:],f['flag'][:],'AmpPhs',16,16,deterministic=True,dtype=np.float32)
+    np.testing.assert_array_equal(cache.data,data)
+    np.testing.assert_array_equal(cache.labels,labels)
+
+def test_patch_cache_reuse_and_append(tmpdir,folded):
+    source = str(tmpdir.join('sim.h5'))
+    cache_dir = str(tmpdir.join('cache'))
+    write_source(source,10)
+    f,cache = open_cache(source,cache_dir)
+    assert cache.n == 10 and sum(folded) == 10
+    assert_matches_source(f,cache)
+    f.close()
+    # Unchanged source: mapped, nothing folded
+    f,cache = open_cache(source,cache_dir)
+    assert sum(folded) == 10
+    assert_matches_source(f,cache)
+    f.close()
+    rng = np.random.RandomState(1)
+    with h5py.File(source,'a') as f:
+        f['data'].resize((13,60,1024))
+        f['flag'].resize((13,60,1024))
+        f['data'][10:] = (rng.randn(3,60,1024) + 1j*rng.randn(3,60,1024)).astype(np.complex64)
+        f['flag'][10:] = (rng.rand(3,60,1024) > 0.9).astype(np.uint8)
+    touch(source)
+    # Appended waterfalls: only they are folded
+    f,cache = open_cache(source,cache_dir)
+    assert cache.n == 13 and sum(folded) == 13
+    assert_matches_source(f,cache)
+    f.close()
+
+def test_patch_cache_refolds_from_changed_chunk(tmpdir,folded):
+    source = str(tmpdir.join('sim.h5'))
+    cache_dir = str(tmpdir.join('cache'))
+    write_source(source,10)
+    open_cache(source,cache_dir)[0].close()
+    with h5py.File(source,'a') as f:
+        f['flag'][5,0,0] = 1 - f['flag'][5,0,0]
+    touch(source)
+    # Waterfall 5 is in the second chunk of 4, so waterfalls 4 to 9 are refolded
+    f,cache = open_cache(source,cache_dir)
+    assert folded == [4,4,2,4,2]
+    assert_matches_source(f,cache)
+    f.close()
+
+def test_patch_cache_keyed_on_full_path(tmpdir):
+    cache_dir = str(tmpdir.join('cache'))
+    tmpdir.mkdir('a')
+    tmpdir.mkdir('b')
+    write_source(str(tmpdir.join('a','sim.h5')),4,seed=0)
+    write_source(str(tmpdir.join('b','sim.h5')),4,seed=1)
+    fa,ca = open_cache(str(tmpdir.join('a','sim.h5')),cache_dir)
+    fb,cb = open_cache(str(tmpdir.join('b','sim.h5')),cache_dir)
+    assert ca.path != cb.path
+    assert_matches_source(fa,ca)
+    assert_matches_source(fb,cb)
+    fa.close()
+    fb.close()
+
+@pytest.mark.parametrize('n,shards,batch_size',[(50,1,7),(11,3,6),(40,4,8)])
+def test_epoch_sampler_state_round_trip(n,shards,batch_size):
+    sampler = EpochSampler(n,seed=0,shards=shards)
+    for i in range(5):
+        sampler.sample(batch_size)
+    state = sampler.get_state()
+    expected = [sampler.sample(batch_size) for i in range(20)]
+    restored = EpochSampler(n,seed=123,shards=shards)
+    restored.set_state(state)
+    for batch in expected:
+        np.testing.assert_array_equal(restored.sample(batch_size),batch)
+    assert restored.epoch == sampler.epoch
+
+def test_epoch_sampler_state_before_first_batch():
+    sampler = EpochSampler(20,seed=4,shards=2)
+    restored = EpochSampler(20,seed=5,shards=2)
+    restored.set_state(sampler.get_state())
+    np.testing.assert_array_equal(restored.sample(6),sampler.sample(6))
+
+def test_epoch_sampler_covers_every_index_once_per_epoch():
+    sampler = EpochSampler(12,seed=1)
+    inds = np.concatenate([sampler.sample(4) for i in range(3)])
+    assert sorted(inds) == list(range(12))
+    assert sampler.epoch == 0
+    sampler.sample(4)
+    assert sampler.epoch == 1
+
+def test_epoch_sampler_shards():
+    sampler = EpochSampler(12,seed=2,shards=3)
+    for i in range(4):
+        batch = sampler.sample(6)
+        for k in range(3):
+            assert np.all(batch[2*k:2*k+2] % 3 == k)
+    with pytest.raises(ValueError):
+        sampler.sample(5)
+
+def test_epoch_sampler_changed_size_starts_new_permutation():
+    sampler = EpochSampler(30,seed=0)
+    sampler.sample(10)
+    resized = EpochSampler(20,seed=9)
+    resized.set_state(sampler.get_state())
+    assert resized.epoch == sampler.epoch
+    assert sorted(np.concatenate([resized.sample(10) for i in range(2)])) == list(range(20))
+
+def load_files(tmpdir,monkeypatch,nreal=4,nsim=6):
+    """
+    The real and simulated files RFIDataset.load opens for tdset 'v11', in a fresh directory.
+    """
+    write_source(str(tmpdir.join('SimVis_2000_v911.h5')),nreal,seed=1)
+    write_source(str(tmpdir.join('SimVis_1000_v11.h5')),nsim,seed=2)
+    monkeypatch.chdir(str(tmpdir))
+
+def loaded(seed,chtypes='AmpPhs',**kwargs):
+    dset = dataset.RFIDataset()
+    dset.load('v11','',8,16,chtypes=chtypes,fold_factor=16,seed=seed,**kwargs)
+    return dset
+
+def test_background_reload_is_reproducible(tmpdir,monkeypatch):
+    # A generation built while batches are drawn, with new streamed windows read from the
+    # dataset RandomState, equals one built after them
+    load_files(tmpdir,monkeypatch)
+    background = loaded(3,stream=True,window=2)
+    foreground = loaded(3,stream=True,window=2)
+    for dset in [background,foreground]:
+        for i in range(3):
+            dset.next_train()
+    assert background.draw_geometry([16,32],[8,16,32]) == foreground.draw_geometry([16,32],[8,16,32])
+    background.reload_async(16,16,time_subsample=True)
+    batches = [background.next_train() for i in range(10)]
+    background.swap_reload()
+    for batch in batches:
+        np.testing.assert_array_equal(foreground.next_train()[0],batch[0])
+    foreground.reload(16,16,time_subsample=True)
+    np.testing.assert_array_equal(background.train_data,foreground.train_data)
+    np.testing.assert_array_equal(background.train_labels,foreground.train_labels)
+    np.testing.assert_array_equal(background.next_train()[0],foreground.next_train()[0])
+
+@pytest.mark.parametrize('hybrid',[False,True])
+def test_cached_load_matches_uncached(tmpdir,monkeypatch,hybrid):
+    # The bootstrapped waterfalls are read from the patch cache in the order they were drawn
+    load_files(tmpdir,monkeypatch)
+    uncached = loaded(5,hybrid=hybrid)
+    cached = loaded(5,hybrid=hybrid,cache_dir=str(tmpdir.join('cache')))
+    for key in ['train_data','train_labels','eval_data','eval_labels']:
+        np.testing.assert_array_equal(getattr(cached,key),getattr(uncached,key))
+    np.testing.assert_array_equal(cached.next_train()[0],uncached.next_train()[0])
+
+def test_prefetcher_rewind_draws_discarded_batches_again(tmpdir,monkeypatch):
+    load_files(tmpdir,monkeypatch)
+    reference = loaded(7,augment=True)
+    expected = [reference.next_train() for i in range(6)]
+    dset = loaded(7,augment=True)
+    queue = dset.prefetcher(depth=4,workers=2)
+    batches = [queue.next() for i in range(2)]
+    # Let the workers fill the queue before it is thrown away
+    while queue.ndrawn < 2 + queue.depth:
+        time.sleep(0.01)
+    queue.stop(rewind=True)
+    queue = dset.prefetcher(depth=4,workers=2)
+    batches += [queue.next() for i in range(4)]
+    queue.stop()
+    for batch,batch_expected in zip(batches,expected):
+        np.testing.assert_allclose(batch[0],batch_expected[0],rtol=1e-6)
+        np.testing.assert_array_equal(batch[1],batch_expected[1])
+
+class FakeUVDataset():
+    def get_size(self):
+        return 2
+
+def test_flag_writer_close_without_saving(tmpdir):
+    filename = str(tmpdir.join('flags.dfcn.h5'))
+    writer = dataset.FlagWriter(FakeUVDataset(),filename,mode='replace')
+    writer.put([(0,1,'xx')],np.zeros((1,60,1024),dtype=bool))
+    writer.close(save=False)
+    assert not writer.thread.is_alive()
+    assert not os.path.exists(filename)
+    # A second close, e.g. from a finally block, does nothing
+    writer.close()
+    writer = dataset.FlagWriter(FakeUVDataset(),filename,mode='replace')
+    writer.put([(0,1,'xx'),(0,2,'xx')],np.ones((2,60,1024),dtype=bool))
+    writer.close()
+    writer.close(save=False)
+    keys,flags = dataset.read_flag_file(filename)
+    assert keys == [(0,1,'xx'),(0,2,'xx')] and flags.all()
+
+@pytest.mark.parametrize('chtypes',['AmpPhs','Amp'])
+def test_patchwise_load_folds_to_the_training_geometry(tmpdir,monkeypatch,chtypes):
+    # The strided waterfalls are folded with the same fold factor and pad size as the rest
+    load_files(tmpdir,monkeypatch)
+    plain = loaded(9,chtypes=chtypes)
+    strided = loaded(9,chtypes=chtypes,patchwise_train=True)
+    assert np.shape(strided.train_data)[1:] == np.shape(plain.train_data)[1:]
+    assert strided.train_len + strided.eval_len == 2*6*16
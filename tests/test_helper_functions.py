@@ -0,0 +1,22 @@
+import os
+import sys
+import subprocess
+import pytest
+
+ml_rfi = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),'ml_rfi')
+
+def run(code):
+    # A fresh interpreter, this one may already have TensorFlow loaded
+    return subprocess.check_output([sys.executable,'-c','import sys; sys.path.insert(0,{0!r}); '.format(ml_rfi)+code]).decode().split()
+
+def test_import_does_not_load_tensorflow():
+    assert run('import helper_functions as hf; hf.RFIDataset; hf.fold_batch; print("tensorflow" in sys.modules)') == ['False']
+
+def test_unknown_name_raises_attribute_error():
+    pytest.importorskip('tensorflow')
+    assert run('import helper_functions as hf; print(hasattr(hf,"no_such_name"))') == ['False']
+
+def test_tensorflow_names_resolve_on_use():
+    pytest.importorskip('tensorflow')
+    code = 'import helper_functions as hf, layers, checkpoint; print(hf.stacked_layer is layers.stacked_layer); print(hf.CheckpointManager is checkpoint.CheckpointManager)'
+    assert run(code) == ['True','True']
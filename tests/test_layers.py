@@ -0,0 +1,101 @@
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+from layers import prediction_ops,tf_unfoldl,quantize_frozen_model,QuantizedModel,data_parallel_model
+from dataset import EpochSampler
+from preprocessing import fold_batch,unfoldl_batch
+
+def waterfalls(n,seed=0):
+    rng = np.random.RandomState(seed)
+    return (rng.randn(n,60,1024) + 1j*rng.randn(n,60,1024)).astype(np.complex64)
+
+def test_prediction_ops_graph_stays_constant():
+    # Stand-in for the network: flattened two class logits from the amplitude channel
+    graph = tf.Graph()
+    with graph.as_default():
+        vis_input = tf.placeholder(tf.float32,shape=[None,None,None,2])
+        amp = vis_input[...,0]
+        sh = tf.shape(amp)
+        RFI_guess = tf.reshape(tf.stack([-amp,amp],axis=-1),[sh[0],sh[1]*sh[2],2])
+        post = prediction_ops(RFI_guess,vis_input,16,16)
+    graph.finalize()
+    nops = len(graph.get_operations())
+    with tf.Session(graph=graph) as sess:
+        for i,nb in enumerate([1,3,2,3,1]):
+            batch = fold_batch(waterfalls(nb,seed=i),16,16,dtype=np.float32,nch=2)
+            flags,logits,logit_diff = sess.run([post['flags'],post['logits'],post['logit_diff']],feed_dict={vis_input: batch})
+            assert len(graph.get_operations()) == nops
+            amp = unfoldl_batch(batch[...,0],16,16)
+            np.testing.assert_allclose(logits,np.stack([-amp,amp],axis=-1))
+            np.testing.assert_allclose(logit_diff,2*amp)
+            np.testing.assert_array_equal(flags,(amp > 0).astype(np.int64))
+
+@pytest.mark.parametrize('fold_factor,padding,trailing',[(16,16,()),(8,32,(2,)),(32,2,(3,))])
+def test_tf_unfoldl_matches_unfoldl_batch(fold_factor,padding,trailing):
+    rng = np.random.RandomState(1)
+    folded = rng.randn(*((2*fold_factor,60+2*(padding+2),1024//fold_factor+2*padding)+trailing)).astype(np.float32)
+    with tf.Graph().as_default(), tf.Session() as sess:
+        x = tf.placeholder(tf.float32,shape=[None,None,None]+list(trailing))
+        unfolded = sess.run(tf_unfoldl(x,fold_factor,padding),feed_dict={x: folded})
+    np.testing.assert_array_equal(unfolded,unfoldl_batch(folded,fold_factor,padding))
+
+def tiny_frozen_model(filename,weights):
+    # A 1x1 convolution of the input channels to two class logits, with the exported node names
+    graph = tf.Graph()
+    with graph.as_default():
+        vis_input = tf.placeholder(tf.float32,shape=[None,8,6,2],name='vis_input')
+        logits = tf.nn.conv2d(vis_input,tf.constant(weights[None,None]),strides=[1,1,1,1],padding='SAME')
+        tf.identity(tf.reshape(logits,[-1,8*6,2]),name='RFI_guess')
+    with open(filename,'wb') as f:
+        f.write(graph.as_graph_def().SerializeToString())
+
+@pytest.mark.parametrize('mode',['float16','int8'])
+def test_quantized_model_pads_and_splits_batches(tmpdir,mode):
+    rng = np.random.RandomState(2)
+    weights = rng.randn(2,2).astype(np.float32)
+    frozen_file = str(tmpdir.join('frozen_model.pb'))
+    tiny_frozen_model(frozen_file,weights)
+    patches = rng.randn(10,8,6,2).astype(np.float32)
+    quant_file = str(tmpdir.join('model.tflite'))
+    with open(quant_file,'wb') as f:
+        f.write(quantize_frozen_model(frozen_file,patches,4,mode=mode))
+    quant = QuantizedModel(quant_file,num_threads=1)
+    assert quant.batch_size == 4
+    # 10 patches run as batches of 4, 4 and 2 zero padded to 4
+    logits = quant(patches)
+    assert np.shape(logits) == (10,8*6,2)
+    expected = np.dot(patches,weights).reshape(10,8*6,2)
+    np.testing.assert_allclose(logits,expected,atol=0.1 if mode == 'int8' else 1e-2)
+    # Every patch gets the same logits whichever batch and position it is run in
+    for n in [1,3,4,5]:
+        np.testing.assert_array_equal(quant(patches[-n:]),logits[-n:])
+
+@pytest.mark.parametrize('ntowers,batch_size',[(2,8),(3,12),(4,4)])
+def test_data_parallel_blocks_are_sampler_shards(ntowers,batch_size):
+    # Tower k must train on shard k of the sampler, which is every index i with i % ntowers == k
+    sampler = EpochSampler(50,seed=3,shards=ntowers)
+    tower_inputs = []
+    def model(vis_input,reuse=None):
+        tower_inputs.append(vis_input)
+        with tf.variable_scope('FCN',reuse=reuse):
+            w = tf.get_variable('w',[],initializer=tf.ones_initializer())
+        x = tf.reshape(vis_input[...,0]*w,[-1,4*3])
+        return tf.stack([-x,x],axis=-1)
+    with tf.Graph().as_default(), tf.Session() as sess:
+        vis_input = tf.placeholder(tf.float32,shape=[None,4,3,1])
+        targets = tf.placeholder(tf.int32,shape=[None,4*3])
+        logits,train_op = data_parallel_model(model,vis_input,targets,tf.train.GradientDescentOptimizer(0.),['/cpu:0']*ntowers)
+        sess.run(tf.global_variables_initializer())
+        for step in range(3):
+            inds = sampler.sample(batch_size)
+            # Each patch holds its sample index
+            batch = np.ones((batch_size,4,3,1),dtype=np.float32)*inds[:,None,None,None]
+            feed = {vis_input: batch,targets: np.zeros((batch_size,4*3),dtype=np.int32)}
+            blocks,out,_ = sess.run([tower_inputs,logits,train_op],feed_dict=feed)
+            for k,block in enumerate(blocks):
+                served = block[:,0,0,0].astype(int)
+                np.testing.assert_array_equal(served,inds[k*batch_size//ntowers:(k+1)*batch_size//ntowers])
+                assert np.all(served % ntowers == k)
+            # Logits come back in batch order
+            np.testing.assert_array_equal(out[:,0,1],inds)
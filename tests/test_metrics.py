@@ -0,0 +1,80 @@
+import numpy as np
+import pytest
+from metrics import ROCAccumulator,ROC_stats,hard_thresh,MCC,accuracy_drop
+
+thresholds = np.linspace(-1,4.,30)
+
+def reference_ROC_stats(ground_truth,logits,thresholds=thresholds):
+    """
+    The confusion matrix per threshold ROC_stats that ROCAccumulator replaced.
+    """
+    truth = np.reshape(ground_truth,[-1]).astype(bool)
+    FPR,TPR,MCC_arr,F2 = [],[],[],[]
+    for thresh in thresholds:
+        pred = hard_thresh(logits,thresh=thresh).reshape(-1).astype(bool)
+        tp = np.sum(truth & pred)
+        tn = np.sum(~truth & ~pred)
+        fp = np.sum(~truth & pred)
+        fn = np.sum(truth & ~pred)
+        with np.errstate(divide='ignore',invalid='ignore'):
+            recall = tp/(1.*(tp+fn))
+            precision = tp/(1.*(tp+fp))
+            TPR.append(recall)
+            FPR.append(fp/(1.*(fp+tn)))
+            MCC_arr.append(MCC(tp,tn,fp,fn))
+            F2.append(5.*recall*precision/(4.*precision + recall))
+    return FPR,TPR,MCC_arr,F2,thresholds[np.nanargmax(F2)]
+
+def sample(n,seed):
+    rng = np.random.RandomState(seed)
+    truth = rng.rand(n) > 0.8
+    # RFI logits higher on average, with scores spread over the thresholds
+    logits = np.where(truth,rng.randn(n) + 1.,rng.randn(n) - 2.)
+    return truth.astype(np.uint8),logits
+
+def assert_stats_equal(stats,expected):
+    for values,ref in zip(stats[:4],expected[:4]):
+        np.testing.assert_allclose(values,ref,rtol=1e-12)
+    assert stats[4] == expected[4]
+
+@pytest.mark.parametrize('seed',[0,1,2])
+def test_roc_stats_matches_confusion_matrices(seed):
+    truth,logits = sample(5000,seed)
+    assert_stats_equal(ROC_stats(truth,logits.reshape(1,-1)),reference_ROC_stats(truth,logits))
+
+def test_roc_accumulator_equals_one_pass():
+    truth,logits = sample(6000,3)
+    roc = ROCAccumulator(thresholds)
+    for i in range(0,6000,1000):
+        roc.update(truth[i:i+1000].reshape(10,100),logits[i:i+1000].reshape(10,100))
+    assert_stats_equal(roc.stats(),reference_ROC_stats(truth,logits))
+
+def test_roc_accumulator_counts():
+    truth,logits = sample(1000,4)
+    roc = ROCAccumulator(thresholds)
+    roc.update(truth,logits)
+    tp,tn,fp,fn = roc.counts()
+    np.testing.assert_array_equal(tp + tn + fp + fn,np.full(len(thresholds),1000))
+    np.testing.assert_array_equal(tp + fn,np.full(len(thresholds),np.sum(truth)))
+
+@pytest.mark.parametrize('thresh',[np.linspace(0,1,11)[::-1],
+                                   np.array([0.3,0.05,0.9,0.5,0.51,0.2]),
+                                   np.random.RandomState(5).permutation(np.linspace(-1,4.,30))])
+def test_roc_stats_in_threshold_order(thresh):
+    truth,logits = sample(3000,6)
+    assert_stats_equal(ROC_stats(truth,logits,thresholds=thresh),reference_ROC_stats(truth,logits,thresholds=thresh))
+
+def test_accuracy_drop_gate():
+    baseline = [900.,9000.,50.,100.]
+    # Identical counts, and a candidate that is better, pass
+    assert accuracy_drop(baseline,baseline) == (0.,0.,False)
+    f2_drop,mcc_drop,regressed = accuracy_drop(baseline,[950.,9000.,50.,50.])
+    assert f2_drop < 0 and mcc_drop < 0 and not regressed
+    # A few more missed flags cost F2 and MCC, within or beyond the maximum drops
+    candidate = [880.,9000.,50.,120.]
+    f2_drop,mcc_drop,regressed = accuracy_drop(baseline,candidate)
+    assert 0 < f2_drop < 0.02 and 0 < mcc_drop < 0.02
+    assert regressed == (f2_drop > 0.01 or mcc_drop > 0.01)
+    assert not accuracy_drop(baseline,candidate,max_f2_drop=f2_drop,max_mcc_drop=mcc_drop)[2]
+    assert accuracy_drop(baseline,candidate,max_f2_drop=f2_drop,max_mcc_drop=mcc_drop/2)[2]
+    assert accuracy_drop(baseline,candidate,max_f2_drop=f2_drop/2,max_mcc_drop=mcc_drop)[2]
@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+from preprocessing import fold,foldl,unfoldl,fold_batch,foldl_batch,unfoldl_batch,fold_waterfalls,tile_predict
+
+def waterfalls(n,shape=(60,1024),seed=0):
+    rng = np.random.RandomState(seed)
+    return (rng.randn(n,*shape) + 1j*rng.randn(n,*shape)).astype(np.complex64)
+
+@pytest.mark.parametrize('fold_factor,padding',[(16,16),(8,32),(32,2)])
+def test_foldl_unfoldl_round_trip(fold_factor,padding):
+    labels = (np.random.RandomState(1).rand(60,1024) > 0.9).astype(np.uint8)
+    folded = foldl(labels,fold_factor,padding)
+    assert np.shape(folded) == (fold_factor,60+2*(padding+2),1024//fold_factor+2*padding)
+    np.testing.assert_array_equal(unfoldl(folded,fold_factor,padding),labels)
+
+def test_batch_round_trip_matches_single():
+    labels = (np.random.RandomState(2).rand(3,60,1024) > 0.9).astype(np.uint8)
+    folded = foldl_batch(labels,16,16)
+    np.testing.assert_array_equal(folded,np.concatenate([foldl(l,16,16) for l in labels]))
+    np.testing.assert_array_equal(unfoldl_batch(folded,16,16),labels)
+
+def test_fold_batch_deterministic_matches_fold():
+    data = waterfalls(2)
+    expected = np.concatenate([fold(d,16,16,deterministic=True) for d in data])
+    np.testing.assert_allclose(fold_batch(data,16,16,deterministic=True),expected)
+
+@pytest.mark.parametrize('chtypes,channels',[('Amp',[0]),('AmpPhs',[0,1]),('AmpPhs2',[0,1,2]),('Phs',[1])])
+def test_fold_waterfalls_channels(chtypes,channels):
+    data = waterfalls(3)
+    labels = (np.random.RandomState(3).rand(3,60,1024) > 0.9).astype(np.uint8)
+    f_data,f_labels = fold_waterfalls(data,labels,chtypes,16,16,deterministic=True,chunk_size=2)
+    expected = fold_batch(data,16,16,deterministic=True,dtype=np.float32)
+    np.testing.assert_array_equal(f_data,expected[...,channels])
+    np.testing.assert_array_equal(f_labels,foldl_batch(labels,16,16))
+
+@pytest.mark.parametrize('shape',[(60,1024),(150,2048),(137,1500),(40,700)])
+def test_tile_predict_stitches_tiles(shape):
+    # The phase channel of unit amplitude waterfalls is sin(phase), so a predictor
+    # returning it must be stitched back into the waterfall's own sin(phase)
+    rng = np.random.RandomState(3)
+    phase = rng.uniform(-1.5,1.5,size=(2,)+shape)
+    data = np.exp(1j*phase)
+    ntiles = []
+    def predict(batch):
+        ntiles.append(len(batch)//16)
+        return batch[...,1:2]
+    logits = tile_predict(data,predict,fold_factor=16,padding=16,max_tiles=3,nch=2)
+    assert np.shape(logits) == (2,)+shape+(1,)
+    assert max(ntiles) <= 3
+    np.testing.assert_allclose(logits[...,0],np.sin(phase),atol=1e-5)
+
+def test_tile_predict_rejects_bad_tiles():
+    with pytest.raises(ValueError):
+        tile_predict(waterfalls(1),lambda x: x,fold_factor=16,tile_shape=(60,1000))
+    with pytest.raises(ValueError):
+        tile_predict(waterfalls(1),lambda x: x,overlap=(60,128))
@@ -0,0 +1,145 @@
+from __future__ import division, print_function, absolute_import
+import numpy as np
+import tensorflow as tf
+import ml_rfi.helper_functions as hf
+from time import time
+import multiprocessing
+import platform
+import json
+import sys
+import os
+from ml_rfi.AmpModel import AmpFCN
+from ml_rfi.AmpPhsModel import AmpPhsFCN
+
+args = sys.argv[1:]
+
+# Arguments order model_name chtypes frozen_file profile_file model_kind
+try:
+    model_name = args[0]
+except:
+    model_name = 'AmpPhsv9SimRealv13_64BSizeDynamicVis'
+try:
+    chtypes = args[1]
+except:
+    chtypes = 'AmpPhs'
+try:
+    frozen_file = args[2]
+except:
+    frozen_file = './'+model_name+'/frozen_model.pb'
+try:
+    profile_file = args[3]
+except:
+    profile_file = 'cpu_profile.json'
+try:
+    model_kind = args[4]     # 'checkpoint' or 'frozen', the model pipelineDFCN.py will flag with
+except:
+    model_kind = 'checkpoint'
+if chtypes == 'AmpPhs':
+    ch_input = 2
+else:
+    ch_input = 1
+pad_size = 16
+f_factor = 16
+tile_shape = (60,1024)
+tile_overlap = (20,128)
+bl_chunk = 16 # synthetic waterfalls flagged per task
+chunks_per_worker = 2 # timed tasks per worker for each setting
+ncpu = multiprocessing.cpu_count()
+worker_counts = [n for n in [1,2,4,8,16,32] if n <= ncpu] # concurrent sessions on the box
+inter_threads = [1,2]
+tile_counts = [4,8,16] # max_tiles, tiles folded per sess.run
+checkpoint = None
+if model_kind == 'checkpoint':
+    checkpoint,step = hf.latest_checkpoint('./'+model_name)
+    if checkpoint is None:
+        raise ValueError("No Model Found. Tuning killed.")
+elif model_kind == 'frozen':
+    if not os.path.exists(frozen_file):
+        raise ValueError("No frozen model found at "+frozen_file+", run exportDFCN.py first.")
+else:
+    raise ValueError('Model kind %s is not supported, use checkpoint or frozen' % model_kind)
+
+def init_worker(profile):
+    """
+    Loads the model into a session configured by profile and warms it up on a chunk
+    of synthetic waterfalls.
+    """
+    global sess, feed, vis_input, RFI_guess, max_tiles, waterfalls
+    config = hf.session_config(profile)
+    if checkpoint is None:
+        sess,vis_input,RFI_guess = hf.load_frozen_model(frozen_file,config=config)
+        feed = {}
+    else:
+        vis_input = tf.placeholder(tf.float32, shape=[None, None, None, ch_input])
+        mode_bn = tf.placeholder(tf.bool)
+        if chtypes == 'Amp':
+            RFI_guess = AmpFCN(vis_input,mode_bn=mode_bn,d_out=0.)
+        elif chtypes == 'AmpPhs':
+            RFI_guess = AmpPhsFCN(vis_input,mode_bn=mode_bn,d_out=0.)
+        saver = tf.train.Saver()
+        sess = tf.Session(config=config)
+        saver.restore(sess, checkpoint)
+        feed = {mode_bn: True}
+    sess.graph.finalize()
+    max_tiles = profile['max_tiles']
+    rng = np.random.RandomState(os.getpid())
+    waterfalls = (rng.randn(bl_chunk,60,1024) + 1j*rng.randn(bl_chunk,60,1024)).astype(np.complex64)
+    flag(0)
+
+def predict(batch_x):
+    feed_dict = dict(feed)
+    feed_dict[vis_input] = batch_x
+    g = sess.run(RFI_guess, feed_dict=feed_dict)
+    return g.reshape(np.shape(batch_x)[:3]+(-1,))
+
+def flag(i):
+    """
+    Flags the worker's chunk of synthetic waterfalls as pipelineDFCN.py does.
+    Output: number of waterfalls flagged
+    """
+    g = hf.tile_predict(waterfalls,predict,f_factor,pad_size,tile_shape=tile_shape,overlap=tile_overlap,
+                        max_tiles=max_tiles,nch=ch_input)
+    return len(g)
+
+def throughput(profile):
+    """
+    Waterfalls per second over all the workers of a profile flagging concurrently.
+    """
+    nworkers = profile['nworkers']
+    pool = multiprocessing.Pool(nworkers,initializer=init_worker,initargs=(profile,))
+    # Untimed round, so every session is built and warm before timing starts
+    pool.map(flag,range(nworkers),chunksize=1)
+    t0 = time()
+    nwf = np.sum(pool.map(flag,range(nworkers*chunks_per_worker),chunksize=1))
+    elapsed = time() - t0
+    pool.close()
+    pool.join()
+    return nwf/elapsed
+
+if __name__ == '__main__':
+    settings = []
+    for nworkers in worker_counts:
+        for intra in sorted(set([max(1,ncpu//nworkers),max(1,ncpu//(2*nworkers))])):
+            for inter in inter_threads:
+                for max_tiles in tile_counts:
+                    settings.append(hf.load_profile(device='cpu',nworkers=nworkers,intra_op_threads=intra,
+                                                    inter_op_threads=inter,max_tiles=max_tiles,model_kind=model_kind))
+    print('Tuning {0} on {1} CPUs over {2} settings'.format(frozen_file if checkpoint is None else checkpoint,ncpu,len(settings)))
+    print('workers  intra  inter  max_tiles  waterfalls/s')
+    results = []
+    for profile in settings:
+        rate = throughput(profile)
+        results.append(dict(profile,waterfalls_per_s=rate))
+        print('{0:7d} {1:6d} {2:6d} {3:10d} {4:13.2f}'.format(profile['nworkers'],profile['intra_op_threads'],
+                                                           profile['inter_op_threads'],profile['max_tiles'],rate))
+    best = int(np.argmax([r['waterfalls_per_s'] for r in results]))
+    with open(profile_file,'w') as f:
+        json.dump({'profile': settings[best],
+                   'waterfalls_per_s': results[best]['waterfalls_per_s'],
+                   'model': frozen_file if checkpoint is None else checkpoint,
+                   'machine': {'hostname': platform.node(),'processor': platform.processor(),'cpu_count': ncpu},
+                   'results': results},f,indent=1)
+    print('Best: {0} workers x {1} intra-op threads, {2} inter-op threads, max_tiles {3}: {4:.2f} waterfalls/s'.format(
+        settings[best]['nworkers'],settings[best]['intra_op_threads'],settings[best]['inter_op_threads'],
+        settings[best]['max_tiles'],results[best]['waterfalls_per_s']))
+    print('Profile saved to '+profile_file)